@@ -36,6 +36,34 @@
 # are missing which means that it is not recommended to wave solder
 # these parts.
 #
+# The footprints are built with the tools/fpgen.py module. The footprints
+# drawn the same way (see CapacitorTemplate) are filled into a template
+# compiled once; the others are rendered in memory by a pool of worker
+# processes (one per CPU by default, use "go.py -j N" to change that).
+# Every footprint file is written in one go.
+#
+# Only the footprints whose table data or generator code changed since
+# the last run are regenerated; the hashes of the generated footprints
+# are kept in the .go.manifest file. Use "go.py --force" to regenerate
+# everything.
+#
+# Besides the footprints for the soldering methods listed in the tables,
+# the footprints for the IPC-7351 density levels computed from the part
+# dimensions can be generated with "go.py -d ABC" (or "-d most,nominal,least").
+# These are named after the level: C_0603_Most, C_0603_Nominal, C_0603_Least.
+#
+# Instead of the tables below, the footprints can be generated from
+# CSV or JSON tables given on the command line ("go.py kemet.csv"),
+# into a library named after the table file (kemet.pretty). The tables
+# are laid out as described in fpgen.TableSchema, with the fields listed
+# in capacitor_schema. All the rows are checked before generating
+# anything, and the checked tables are cached in .<file>.idx files.
+#
+# "go.py --report times.json" writes a JSON report with the time spent
+# computing, serializing and writing every footprint, and the sizes of
+# the files. "go.py -j 1 --profile gen.prof" saves cProfile statistics
+# of the run, for use with pstats.
+#
 
 # Original 3D shapes were borrowed from the terrific collection made by
 # kcswalter@tiscali.it and enhanced a little.
@@ -187,134 +215,217 @@ tantalum_chip_capacitors = {
 # Polarity mark offset from pad margin
 PMOFS = 0.3 / 2
 
-import os, time, math
-from shutil import copyfile
-from glob import glob
+import os, sys
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), "..", "tools"))
+import fpgen
 
+# The build manifest, see fpgen.LoadManifest ()
+MANIFEST = ".go.manifest"
 
-# Round to nearest 0.05 multiple (for courtyard)
-def round005 (x):
-    # For negative values, do floor(), for positive, do ceil()
-    if x < 0:
-        return (math.floor (x * 20.0 + 0.01)) / 20.0
-    else:
-        return (math.ceil (x * 20.0 - 0.01)) / 20.0
+
+# The layout of the capacitor tables, for loading them from files
+capacitor_schema = fpgen.TableSchema (
+    part = (("L", float, True), ("W", float, True), ("T", float, False),
+        ("W1", float, False), ("H", float, False), ("H1", float, False),
+        ("Size", str, False), ("InchSize", str, False), ("Pol", bool, False)),
+    variants = ("Hand", "Reflow", "Wave"),
+    pads = (("Z", float, True), ("G", float, True), ("X", float, True),
+        ("Y", float, True), ("C", float, True)),
+    rules = (
+        (lambda G, Y, Z: abs (G + Y * 2 - Z) > 1E-6,
+            "G + Y*2 != Z (%(G)g + %(Y)g*2 != %(Z)g)"),
+        (lambda X, Y: (X <= 0) | (Y <= 0), "bad pad size %(Y)g x %(X)g"),
+    ))
 
 
-def _GenerateCapacitor (dirmod, dir3d, dim, mod, cap, pads):
-    compn = "C_%s%s_%s" % \
+def CapacitorName (dim, mod, cap):
+    return "C_%s%s_%s" % \
         (dim, ("_Size-%s" % cap ["Size"].replace (' ', '-')) \
          if cap.has_key ("Size") else "", mod)
-    fn = "%s/%s.kicad_mod" % (dirmod, compn)
 
-    print ("Generating capacitor %s" % compn)
 
-    # Sanity check for table data
-    if abs (pads ['G'] + pads ['Y'] * 2 - pads ['Z']) > 1E-6:
-        print ("Table error: G + Y*2 != Z (%g + %g*2 = %g != %g)" % \
-            (pads ['G'], pads ['Y'], pads ['G'] + pads ['Y'] * 2, pads ['Z']))
-        return
+def CapacitorFile (job):
+    dirmod, dir3d, dim, mod, cap, pads = job
+    return "%s/%s.kicad_mod" % (dirmod, CapacitorName (dim, mod, cap))
 
-    f = open (fn, "w")
 
+def CapacitorGeometry (L, W, C, X, Y, Z, G):
+    """
+    Compute the coordinates of a capacitor footprint
+    (or, with arrays, of many footprints at once).
+    """
     # KLC #6.7
-    clearance = 0.15 if cap ['W'] < 1.0 else 0.25
-
-    f.write ("(module %s (layer F.Cu)\n" % (compn))
+    clearance = fpgen.Where (W < 1.0, 0.15, 0.25)
 
-    f.write ("  (descr \"Capacitor SMD %s,%s %s soldering\")\n" % \
-        (dim, (" Size %s," % cap ["Size"]) if cap.has_key ("Size") else "", mod))
+    # Body outline and polarity mark
+    l2 = L / 2
+    w2 = W / 2
+    ph2 = X / 2 + PMOFS
 
-    f.write ("  (tags \"capacitor %s%s%s %s\")\n" % (dim,
-        (" " + cap["InchSize"]) if cap.has_key ("InchSize") else "",
-        (" " + cap["Size"]) if cap.has_key ("Size") else "",
-        mod.lower ()))
+    # Courtyard
+    cl2 = Z / 2 + clearance
+    cw2 = fpgen.Maximum (W, X) / 2 + clearance
+
+    return {
+        'refy': fpgen.Maximum (W, X) / 2 + clearance + 0.2 + 1.0/2,
+        'px': C / 2, 'pw': Y, 'ph': X,
+        'l2': l2, 'w2': w2, 'ph2': ph2, 'sides': w2 > ph2,
+        'xl': Z / 2 + PMOFS, 'xr': G / 2 - PMOFS,
+        'cx1': fpgen.Round005 (-cl2), 'cy1': fpgen.Round005 (-cw2),
+        'cx2': fpgen.Round005 (+cl2), 'cy2': fpgen.Round005 (+cw2),
+    }
+
+
+def CapacitorRow (job):
+    dirmod, dir3d, dim, mod, cap, pads = job
+    return (CapacitorGeometry, (cap ['L'], cap ['W'],
+        pads ['C'], pads ['X'], pads ['Y'], pads ['Z'], pads ['G']))
+
+
+def CapacitorTemplate (job, g):
+    """
+    Return the template key of a capacitor footprint and its strings,
+    for RenderCapacitor (). The key tells how the footprint is drawn;
+    it is None if the table data is wrong, so that the footprint is
+    rendered and the error is reported.
+    """
+    dirmod, dir3d, dim, mod, cap, pads = job
+    compn = CapacitorName (dim, mod, cap)
+    texts = {
+        'name': compn,
+        'descr': "Capacitor SMD %s,%s %s" % \
+            (dim, (" Size %s," % cap ["Size"]) if cap.has_key ("Size") else "",
+             fpgen.VariantText (mod)),
+        'tags': "capacitor %s%s%s %s" % (dim,
+            (" " + cap["InchSize"]) if cap.has_key ("InchSize") else "",
+            (" " + cap["Size"]) if cap.has_key ("Size") else "",
+            mod.lower ()),
+        'model': "%s/C_%s%s.wrl" % (dir3d, dim,
+            ("_Size-%s" % cap ["Size"].replace (' ', '-')) if cap.has_key ("Size") else ""),
+    }
+    if abs (pads ['G'] + pads ['Y'] * 2 - pads ['Z']) > 1E-6:
+        return (None, texts)
+    return ((g ['sides'], cap.has_key ('Pol') and cap ['Pol']), texts)
+
+
+def RenderCapacitor (job, g):
+    """
+    Build a capacitor footprint.
+    job is a tuple (dirmod, dir3d, dim, mod, cap, pads) as returned
+    by CapacitorJobs (), g is its geometry from CapacitorGeometry ()
+    with the strings from CapacitorTemplate ().
+    Returns a tuple (file name, footprint, error message). If the table
+    data is wrong, the footprint is None.
+    """
+    dirmod, dir3d, dim, mod, cap, pads = job
+    fn = CapacitorFile (job)
 
-    f.write ("  (attr smd)\n")
+    # Sanity check for table data
+    if abs (pads ['G'] + pads ['Y'] * 2 - pads ['Z']) > 1E-6:
+        return (fn, None, "Table error: G + Y*2 != Z (%g + %g*2 = %g != %g)" % \
+            (pads ['G'], pads ['Y'], pads ['G'] + pads ['Y'] * 2, pads ['Z']))
 
-    refy = (cap ['W'] if cap ['W'] > pads ['X'] else pads ['X']) / 2 + clearance + 0.2 + 1.0/2
-    f.write ("""\
-  (fp_text reference REF** (at 0 %g) (layer F.SilkS)
-    (effects (font (size 1 1) (thickness 0.15)))
-  )
-""" % (-refy))
+    fp = fpgen.NewFootprint (g ['name'], g ['descr'], g ['tags'])
+    items = fp.items
 
+    items.append (fpgen.Text ("reference", "REF**", 0, -g ['refy'], "F.SilkS"))
     # I opt for value at (0,0) since this is handy when printing the Fab layer
-    f.write ("""\
-  (fp_text value %s (at 0 0) (layer F.Fab)
-    (effects (font (size 1 1) (thickness 0.15)))
-  )
-""" % (compn))
+    items.append (fpgen.Text ("value", g ['name'], 0, 0, "F.Fab"))
 
     # --- === Pads === --- #
-    f.write ("  (pad 1 smd rect (at %g 0) (size %g %g) (layers F.Cu F.Paste F.Mask))\n" % \
-        (-pads ['C']/2, pads ['Y'], pads ['X']))
-    f.write ("  (pad 2 smd rect (at %g 0) (size %g %g) (layers F.Cu F.Paste F.Mask))\n" % \
-        (+pads ['C']/2, pads ['Y'], pads ['X']))
+    layers = ("F.Cu", "F.Paste", "F.Mask")
+    items.append (fpgen.Pad ("1", -g ['px'], 0, g ['pw'], g ['ph'], layers))
+    items.append (fpgen.Pad ("2", +g ['px'], 0, g ['pw'], g ['ph'], layers))
 
     # Body outline
-    l2 = cap ['L'] / 2
-    w2 = cap ['W'] / 2
-    ph2 = pads ['X'] / 2 + PMOFS
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-        (-l2, -w2, +l2, -w2))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-        (-l2, +w2, +l2, +w2))
-    if w2 > ph2:
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (-l2, -w2, -l2, -ph2))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (-l2, +ph2, -l2, +w2))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (+l2, -w2, +l2, -ph2))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (+l2, +ph2, +l2, +w2))
+    l2, w2, ph2 = g ['l2'], g ['w2'], g ['ph2']
+    items.append (fpgen.Line (-l2, -w2, +l2, -w2, "F.SilkS", "0.15"))
+    items.append (fpgen.Line (-l2, +w2, +l2, +w2, "F.SilkS", "0.15"))
+    if g ['sides']:
+        items.append (fpgen.Line (-l2, -w2, -l2, -ph2, "F.SilkS", "0.15"))
+        items.append (fpgen.Line (-l2, +ph2, -l2, +w2, "F.SilkS", "0.15"))
+        items.append (fpgen.Line (+l2, -w2, +l2, -ph2, "F.SilkS", "0.15"))
+        items.append (fpgen.Line (+l2, +ph2, +l2, +w2, "F.SilkS", "0.15"))
 
     # Draw polarity mark
     if cap.has_key ('Pol') and cap ['Pol']:
-        xl = pads ['Z'] / 2 + PMOFS
-        xr = pads ['G'] / 2 - PMOFS
+        xl, xr = g ['xl'], g ['xr']
 
         # Vertical line along the right margin of the left pad
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (-xr, -w2, -xr, +w2))
+        items.append (fpgen.Line (-xr, -w2, -xr, +w2, "F.SilkS", "0.15"))
 
         # Two lines along the top and bottom margins
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (-xl, -ph2, -xr, -ph2))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (-xl, +ph2, -xr, +ph2))
+        items.append (fpgen.Line (-xl, -ph2, -xr, -ph2, "F.SilkS", "0.15"))
+        items.append (fpgen.Line (-xl, +ph2, -xr, +ph2, "F.SilkS", "0.15"))
 
         # Draw a line along the left margin of the pad
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width 0.15))\n" % \
-            (-xl, +ph2, -xl, -ph2))
+        items.append (fpgen.Line (-xl, +ph2, -xl, -ph2, "F.SilkS", "0.15"))
 
     # Courtyard
-    l2 = pads ['Z'] / 2 + clearance
-    w2 = (cap ['W'] if cap ['W'] > pads ['X'] else pads ['X']) / 2 + clearance
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (-l2), round005 (-w2), round005 (+l2), round005 (-w2)))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (-l2), round005 (+w2), round005 (+l2), round005 (+w2)))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (-l2), round005 (-w2), round005 (-l2), round005 (+w2)))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (+l2), round005 (-w2), round005 (+l2), round005 (+w2)))
-
-    fn3d = "%s/C_%s%s.wrl" % (dir3d, dim,
-        ("_Size-%s" % cap ["Size"].replace (' ', '-')) if cap.has_key ("Size") else "")
-    f.write ("""\
-  (model %s
-    (at (xyz 0 0 0))
-    (scale (xyz 1 1 1))
-    (rotate (xyz 0 0 0))
-  )
-)
-""" % fn3d)
-    f.close ()
-
-
-def GenerateCapacitor (dim, cap, dest):
+    items.extend (fpgen.Rect (g ['cx1'], g ['cy1'], g ['cx2'], g ['cy2'],
+        "F.CrtYd", "0.05"))
+
+    items.append (fpgen.Model (g ['model']))
+    return (fn, fp, None)
+
+
+def HandPads (pads):
+    """
+    Derive the hand soldering pads from the reflow pads: add 25% size
+    to them and move the pads from each other so that the internal
+    clearance G stays the same. Returns a new dictionary.
+    """
+    hand = pads.copy ()
+    hand ['C'] = pads ['C'] + pads ['Y'] * 0.25
+    hand ['Z'] = pads ['Z'] + pads ['Y'] * 0.25 * 2
+    hand ['X'] = pads ['X'] * 1.25
+    hand ['Y'] = pads ['Y'] * 1.25
+    return hand
+
+
+def IPCPads (L, W, T, level):
+    """
+    Compute the pads for an IPC-7351 density level ("A", "B" or "C")
+    from the body length, the terminal width and length.
+    Returns a new dictionary; works with arrays as well.
+    """
+    Z, G, X = fpgen.IPCChipPads (L, W, T, level)
+    return { 'Z': Z, 'G': G, 'X': X, 'Y': (Z - G) / 2, 'C': (Z + G) / 2 }
+
+
+def IPCDimensions (cap):
+    """
+    Return the IPCPads () dimensions of a capacitor, or None
+    if the length of the terminals (T) is not known.
+    """
+    if not cap.has_key ('T'):
+        return None
+    return (cap ['L'], cap.get ('W1', cap ['W']), cap ['T'])
+
+
+def DerivePads (cap, ipc = ()):
+    """
+    Return the list of (variant, pads) for a capacitor: the pads
+    from the table, the automatic hand soldering pads if the table
+    has none, and the IPC density level variants computed for the
+    whole table by fpgen.IPCVariants (). The table entry is not modified.
+    """
+    res = []
+    for mod in [ "Hand", "Reflow", "Wave" ]:
+        if cap.has_key (mod):
+            res.append ((mod, cap [mod]))
+
+    if (not cap.has_key ("Hand")) and (cap.has_key ("Reflow")):
+        res.append (("Hand", HandPads (cap ["Reflow"])))
+
+    return res + list (ipc)
+
+
+def CapacitorJobs (table, dest, levels = ()):
+    """
+    Return the list of footprints to generate for a table of capacitors
+    as arguments for RenderCapacitor ().
+    """
     dirmod = dest + ".pretty"
     if not os.access (dirmod, os.R_OK):
         os.mkdir (dirmod, 0755)
@@ -323,81 +434,46 @@ def GenerateCapacitor (dim, cap, dest):
     if not os.access (dir3d, os.R_OK):
         os.mkdir (dir3d, 0755)
 
-    for mod in [ "Hand", "Reflow", "Wave" ]:
-        if cap.has_key (mod):
-            _GenerateCapacitor (dirmod, dir3d,
-                dim, mod, cap, cap [mod])
+    ipc = fpgen.IPCVariants (table, levels, IPCDimensions, IPCPads)
 
-    if (not cap.has_key ("Hand")) and (cap.has_key ("Reflow")):
-        # Automatically generate hand soldering pads
-        # Use "Reflow" pads but add 25% size to them and move pads
-        # from each out so that the internal cleaning G stays the same
-        pads = cap ["Reflow"]
-        pads ['C'] += pads ['Y'] * 0.25
-        pads ['Z'] += pads ['Y'] * 0.25 * 2
-        pads ['X'] *= 1.25
-        pads ['Y'] *= 1.25
-        _GenerateCapacitor (dest + ".pretty", dest + ".3dshapes",
-            dim, "Hand", cap, pads)
-
-
-def PlaceModule (modfn, cx, cy, off):
-    for l in file (modfn, "r").readlines ():
-        off.write (l)
-        if (l.strip () [0:8] == "(module "):
-            off.write ("  (at %g %g)\n" % (cx, cy))
-
-
-def GenerateTestBoard (ifn, ofn):
-    iff = file (ifn, "r")
-    off = file (ofn, "w")
-
-    # Place by 16 components in a row
-    # Put Reflow in 1st row, Wave in 2nd, Hand in 3rd row, then start all again.
-    cnum = 0
-    prevcompn = None
-    for l in iff.readlines ():
-        if l [0] == '@':
-            # Special mark where the content of a pretty lib should be inserted
-            mods = glob ("%s/*.kicad_mod" % l.strip () [1:])
-            mods.sort ()
-            for modfn in mods:
-                if modfn.find ("_Reflow.") >= 0:
-                    col = 0
-                    compn = modfn.replace ("Reflow", "")
-                elif modfn.find ("_Wave.") >= 0:
-                    col = 1
-                    compn = modfn.replace ("Wave", "")
-                elif modfn.find ("_Hand.") >= 0:
-                    col = 2
-                    compn = modfn.replace ("Hand", "")
-                else:
-                    # Don't know what is this, ignore
-                    continue
-
-                if compn != prevcompn:
-                    if not (prevcompn is None):
-                        cnum += 1
-                    prevcompn = compn
-
-                cy = 20 + (cnum & 15) * 10
-                cx = 20 + (cnum / 16) * 15 * 4 + col * 15
-
-                PlaceModule (modfn, cx, cy, off)
-        else:
-            off.write (l)
-
-    iff.close ()
-    off.close ()
+    jobs = []
+    for dim,cap in table.items ():
+        jobs.extend ([(dirmod, dir3d, dim, mod, cap, pads)
+            for mod, pads in DerivePads (cap, ipc [dim])])
+    return jobs
 
 
 # --- === main === --- #
 
-for dim,cap in ceramic_chip_capacitors.items ():
-    GenerateCapacitor (dim, cap, "Capacitors_SMD")
+def Main (options, args):
+    """
+    Generate the footprints and the test board, see fpgen.Main ().
+    """
+    if options.force:
+        manifest = {}
+    else:
+        manifest = fpgen.LoadManifest (MANIFEST)
+
+    if len (args):
+        tables = fpgen.LoadTables (capacitor_schema, args)
+    else:
+        tables = [(ceramic_chip_capacitors, "Capacitors_SMD"),
+                  (tantalum_chip_capacitors, "Capacitors_Tantalum_SMD")]
+
+    jobs = []
+    for table, dest in tables:
+        jobs.extend (CapacitorJobs (table, dest, options.density))
+
+    changed = fpgen.Generate ("capacitor", jobs, CapacitorFile, CapacitorRow,
+        RenderCapacitor, CapacitorTemplate, options.jobs, manifest)
+
+    # Generate the test board
+    if not len (args):
+        fpgen.UpdateTestBoard ("Capacitors_gen.kicad_pcb.template",
+            "Capacitors_gen.kicad_pcb", manifest, changed)
+
+    fpgen.SaveManifest (MANIFEST, manifest)
 
-for dim,cap in tantalum_chip_capacitors.items ():
-    GenerateCapacitor (dim, cap, "Capacitors_Tantalum_SMD")
 
-# Generate the test board
-GenerateTestBoard ("Capacitors_gen.kicad_pcb.template", "Capacitors_gen.kicad_pcb")
+if __name__ == "__main__":
+    fpgen.Main (Main)
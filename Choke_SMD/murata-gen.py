@@ -13,6 +13,37 @@
 #     which are built from two adjoining pads of different sizes)
 # C - secondary pad width
 #
+# The parts are described by the body length L and width W; the length
+# of the terminals T, if known, allows to compute the IPC-7351 pads.
+#
+# The footprints are built with the tools/fpgen.py module. The footprints
+# drawn the same way (see InductorTemplate) are filled into a template
+# compiled once; the others are rendered in memory by a pool of worker
+# processes (one per CPU by default, use "murata-gen.py -j N" to change
+# that).
+# Only the footprints whose table data or generator code changed since
+# the last run are regenerated; the hashes of the generated footprints
+# are kept in the .murata-gen.manifest file. Use "murata-gen.py --force"
+# to regenerate everything.
+#
+# Besides the footprints for the soldering methods listed in the tables,
+# the footprints for the IPC-7351 density levels can be generated with
+# "murata-gen.py -d ABC" (or "-d most,nominal,least") for the parts with
+# known terminal length T. These are named after the level, for example
+# Choke_LQM18F_Nominal.
+#
+# Instead of the tables below, the footprints can be generated from
+# CSV or JSON tables given on the command line ("murata-gen.py lq.csv"),
+# into a library named after the table file (lq.pretty). The tables are
+# laid out as described in fpgen.TableSchema, with the fields listed in
+# inductor_schema. All the rows are checked before generating anything,
+# and the checked tables are cached in .<file>.idx files.
+#
+# "murata-gen.py --report times.json" writes a JSON report with the time spent
+# computing, serializing and writing every footprint, and the sizes of
+# the files. "murata-gen.py -j 1 --profile gen.prof" saves cProfile statistics
+# of the run, for use with pstats.
+#
 
 murata_power_inductors = {
     'LQM18F':
@@ -310,175 +341,239 @@ murata_rf_inductors = {
         },
 }
 
-import os, time, math
-from shutil import copyfile
-from glob import glob
+import os, sys
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), "..", "tools"))
+import fpgen
 
+# The build manifest, see fpgen.LoadManifest ()
+MANIFEST = ".murata-gen.manifest"
+
+
+# The layout of the inductor tables, for loading them from files
+inductor_schema = fpgen.TableSchema (
+    part = (("L", float, True), ("W", float, True), ("T", float, False),
+        ("Size", str, False), ("Pol", bool, False), ("3dshape", str, False)),
+    variants = ("Hand", "Reflow", "Flow", "Wave"),
+    pads = (("a", float, True), ("b", float, True), ("c", float, True),
+        ("d", float, False), ("B", float, False), ("C", float, "B")),
+    rules = (
+        (lambda a, b: a >= b, "a >= b (%(a)g >= %(b)g)"),
+        (lambda b, B: b >= B, "b >= B (%(b)g >= %(B)g)"),
+    ))
 
-# Round to nearest 0.05 multiple (for courtyard)
-def round005 (x):
-    # For negative values, do floor(), for positive, do ceil()
-    if x < 0:
-        return (math.floor (x * 20.0 + 0.01)) / 20.0
-    else:
-        return (math.ceil (x * 20.0 - 0.01)) / 20.0
 
+def InductorName (dim, mod, ind):
+    return "Choke_%s_%s" % (dim, mod)
 
-def _GenerateInductor (dirmod, dir3d, dim, mod, ind, pads):
-    compn = "Choke_%s_%s" % (dim, mod)
-    fn = "%s/%s.kicad_mod" % (dirmod, compn)
 
-    print ("Generating inductor %s" % compn)
+def InductorFile (job):
+    dirmod, dir3d, dim, mod, ind, pads = job
+    return "%s/%s.kicad_mod" % (dirmod, InductorName (dim, mod, ind))
 
-    f = open (fn, "w")
 
+def InductorGeometry (L, W, a, b, c, d, B, C):
+    """
+    Compute the coordinates of an inductor footprint
+    (or, with arrays, of many footprints at once).
+    d is 0 for pads without the masked part, B and C equal b and c
+    if there's no second set of pads.
+    """
     # KLC #6.7
-    clearance = 0.15 if ind ['W'] < 1.0 else 0.25
+    clearance = fpgen.Where (W < 1.0, 0.15, 0.25)
     # Use thin lines for outline of very small components
-    linew = 0.1 if ind ['W'] < 1.0 else 0.15
+    linew = fpgen.Where (W < 1.0, 0.1, 0.15)
     # Silk clearance from pads
-    silkc = round005 (linew / 2)
+    silkc = fpgen.Round005 (linew / 2)
 
-    f.write ("(module %s (layer F.Cu)\n" % (compn))
-
-    f.write ("  (descr \"Inductor SMD %s,%s %s soldering\")\n" % \
-        (dim, (" Size %s," % ind ["Size"]) if ind.has_key ("Size") else "", mod))
-
-    f.write ("  (tags \"inductor %s%s %s\")\n" % (dim,
-        (" " + ind["Size"]) if ind.has_key ("Size") else "",
-        mod.lower ()))
-
-    f.write ("  (attr smd)\n")
-
-    refy = ind ['W'] if ind ['W'] > pads ['c'] else pads ['c']
-    if pads.has_key ('d') and pads ['d'] > refy:
-        refy = pads ['d']
-    refy = refy / 2 + clearance + 0.2 + 1.0/2
-    f.write ("""\
-  (fp_text reference REF** (at 0 %g) (layer F.SilkS)
-    (effects (font (size 1 1) (thickness 0.15)))
-  )
-""" % (-refy))
+    # Body outline
+    l2 = L / 2
+    w2 = W / 2
+    ph2 = c / 2 + silkc
 
+    # Courtyard
+    cl2 = B / 2 + clearance
+    cw2 = fpgen.Maximum (fpgen.Maximum (W, c), d) / 2 + clearance
+
+    return {
+        'linew': linew,
+        'refy': fpgen.Maximum (fpgen.Maximum (W, c), d) / 2 + clearance + 0.2 + 1.0/2,
+        'px': (b + a) / 4, 'pl': (b - a) / 2,
+        'px2': (B + b) / 4, 'pl2': (B - b) / 2,
+        'c': c, 'd': d, 'C': C,
+        'l2': l2, 'w2': w2, 'ph2': ph2, 'sides': w2 > ph2,
+        'xl': b / 2 + silkc, 'xr': a / 2 - silkc,
+        'cx1': fpgen.Round005 (-cl2), 'cy1': fpgen.Round005 (-cw2),
+        'cx2': fpgen.Round005 (+cl2), 'cy2': fpgen.Round005 (+cw2),
+    }
+
+
+def InductorRow (job):
+    dirmod, dir3d, dim, mod, ind, pads = job
+    return (InductorGeometry, (ind ['L'], ind ['W'], pads ['a'], pads ['b'],
+        pads ['c'], pads.get ('d', 0.0), pads.get ('B', pads ['b']),
+        pads.get ('C', pads ['c'])))
+
+
+def InductorTemplate (job, g):
+    """
+    Return the template key of an inductor footprint and its strings,
+    for RenderInductor (). The key tells how the footprint is drawn.
+    """
+    dirmod, dir3d, dim, mod, ind, pads = job
+    texts = {
+        'name': InductorName (dim, mod, ind),
+        'descr': "Inductor SMD %s,%s %s" % \
+            (dim, (" Size %s," % ind ["Size"]) if ind.has_key ("Size") else "",
+             fpgen.VariantText (mod)),
+        'tags': "inductor %s%s %s" % (dim,
+            (" " + ind["Size"]) if ind.has_key ("Size") else "",
+            mod.lower ()),
+        'model': "%s/Choke_%s.wrl" % (dir3d,
+            ind ['3dshape'] if ind.has_key ('3dshape') else dim),
+    }
+    key = (pads.has_key ('d') and pads ['d'] > pads ['c'], pads.has_key ('B'),
+        g ['sides'], ind.has_key ('Pol') and ind ['Pol'])
+    return (key, texts)
+
+
+def RenderInductor (job, g):
+    """
+    Build an inductor footprint.
+    job is a tuple (dirmod, dir3d, dim, mod, ind, pads) as returned
+    by InductorJobs (), g is its geometry from InductorGeometry ()
+    with the strings from InductorTemplate ().
+    Returns a tuple (file name, footprint, error message).
+    """
+    dirmod, dir3d, dim, mod, ind, pads = job
+    fn = InductorFile (job)
+
+    fp = fpgen.NewFootprint (g ['name'], g ['descr'], g ['tags'])
+    items = fp.items
+
+    linew = fpgen.Num (g ['linew'], "%.2f")
+
+    items.append (fpgen.Text ("reference", "REF**", 0, -g ['refy'], "F.SilkS"))
     # I opt for value at (0,0) since this is handy when printing the Fab layer
-    f.write ("""\
-  (fp_text value %s (at 0 %g) (layer F.Fab)
-    (effects (font (size 1 1) (thickness 0.15)))
-  )
-""" % (compn, +refy))
+    items.append (fpgen.Text ("value", g ['name'], 0, +g ['refy'], "F.Fab"))
 
     # --- === Pads === --- #
 
-    px = (pads ['b'] + pads ['a']) / 4
-    pl = (pads ['b'] - pads ['a']) / 2
+    px, pl = g ['px'], g ['pl']
     if pads.has_key ('d') and pads ['d'] > pads ['c']:
         # pads partialy covered with mask
-        f.write ("  (pad 1 smd rect (at %g 0) (size %g %g) (layers F.Cu))\n" % \
-            (-px, pl, pads ['d']))
-        f.write ("  (pad \"\" smd rect (at %g 0) (size %g %g) (layers F.Mask F.Paste))\n" % \
-            (-px, pl, pads ['c']))
-        f.write ("  (pad 2 smd rect (at %g 0) (size %g %g) (layers F.Cu))\n" % \
-            (+px, pl, pads ['d']))
-        f.write ("  (pad \"\" smd rect (at %g 0) (size %g %g) (layers F.Mask F.Paste))\n" % \
-            (+px, pl, pads ['c']))
+        items.append (fpgen.Pad ("1", -px, 0, pl, g ['d'], ("F.Cu",)))
+        items.append (fpgen.Pad ("", -px, 0, pl, g ['c'], ("F.Mask", "F.Paste")))
+        items.append (fpgen.Pad ("2", +px, 0, pl, g ['d'], ("F.Cu",)))
+        items.append (fpgen.Pad ("", +px, 0, pl, g ['c'], ("F.Mask", "F.Paste")))
     else:
-        f.write ("  (pad 1 smd rect (at %g 0) (size %g %g) (layers F.Cu F.Paste F.Mask))\n" % \
-            (-px, pl, pads ['c']))
-        f.write ("  (pad 2 smd rect (at %g 0) (size %g %g) (layers F.Cu F.Paste F.Mask))\n" % \
-            (+px, pl, pads ['c']))
+        items.append (fpgen.Pad ("1", -px, 0, pl, g ['c'], ("F.Cu", "F.Paste", "F.Mask")))
+        items.append (fpgen.Pad ("2", +px, 0, pl, g ['c'], ("F.Cu", "F.Paste", "F.Mask")))
 
     # Second set of pads, if defined
     if pads.has_key ('B'):
-        px = (pads ['B'] + pads ['b']) / 4
-        pl = (pads ['B'] - pads ['b']) / 2
-        f.write ("  (pad 1 smd rect (at %g 0) (size %g %g) (layers F.Cu F.Paste F.Mask))\n" % \
-            (-px, pl, pads ['C']))
-        f.write ("  (pad 2 smd rect (at %g 0) (size %g %g) (layers F.Cu F.Paste F.Mask))\n" % \
-            (+px, pl, pads ['C']))
+        px, pl = g ['px2'], g ['pl2']
+        items.append (fpgen.Pad ("1", -px, 0, pl, g ['C'], ("F.Cu", "F.Paste", "F.Mask")))
+        items.append (fpgen.Pad ("2", +px, 0, pl, g ['C'], ("F.Cu", "F.Paste", "F.Mask")))
 
     # Body outline on F.Fab
-    l2 = ind ['L'] / 2
-    w2 = ind ['W'] / 2
-    ph2 = pads ['c'] / 2 + silkc
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.Fab) (width %.2f))\n" % \
-        (-l2, -w2, +l2, -w2, linew))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.Fab) (width %.2f))\n" % \
-        (-l2, +w2, +l2, +w2, linew))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.Fab) (width %.2f))\n" % \
-        (-l2, -w2, -l2, +w2, linew))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.Fab) (width %.2f))\n" % \
-        (+l2, -w2, +l2, +w2, linew))
+    l2, w2, ph2 = g ['l2'], g ['w2'], g ['ph2']
+    items.extend (fpgen.Rect (-l2, -w2, +l2, +w2, "F.Fab", linew))
 
     # Body outline on F.SilkS
-    xl = pads ['b'] / 2 + silkc
-    xr = pads ['a'] / 2 - silkc
-
-    if w2 > ph2:
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-l2, -w2, +l2, -w2, linew))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-l2, +w2, +l2, +w2, linew))
-
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-l2, -w2, -l2, -ph2, linew))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-l2, +ph2, -l2, +w2, linew))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (+l2, -w2, +l2, -ph2, linew))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (+l2, +ph2, +l2, +w2, linew))
+    xl, xr = g ['xl'], g ['xr']
+
+    if g ['sides']:
+        items.append (fpgen.Line (-l2, -w2, +l2, -w2, "F.SilkS", linew))
+        items.append (fpgen.Line (-l2, +w2, +l2, +w2, "F.SilkS", linew))
+
+        items.append (fpgen.Line (-l2, -w2, -l2, -ph2, "F.SilkS", linew))
+        items.append (fpgen.Line (-l2, +ph2, -l2, +w2, "F.SilkS", linew))
+        items.append (fpgen.Line (+l2, -w2, +l2, -ph2, "F.SilkS", linew))
+        items.append (fpgen.Line (+l2, +ph2, +l2, +w2, "F.SilkS", linew))
     else:
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-xr, -w2, +xr, -w2, linew))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-xr, +w2, +xr, +w2, linew))
+        items.append (fpgen.Line (-xr, -w2, +xr, -w2, "F.SilkS", linew))
+        items.append (fpgen.Line (-xr, +w2, +xr, +w2, "F.SilkS", linew))
 
     # Draw polarity mark
     if ind.has_key ('Pol') and ind ['Pol']:
         # Vertical line along the right margin of the left pad
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-xr, -ph2, -xr, +ph2, linew))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.Fab) (width %.2f))\n" % \
-            (-xr, -w2, -xr, +w2, linew))
+        items.append (fpgen.Line (-xr, -ph2, -xr, +ph2, "F.SilkS", linew))
+        items.append (fpgen.Line (-xr, -w2, -xr, +w2, "F.Fab", linew))
 
         # Two lines along the top and bottom margins
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-xl, -ph2, -xr, -ph2, linew))
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-xl, +ph2, -xr, +ph2, linew))
+        items.append (fpgen.Line (-xl, -ph2, -xr, -ph2, "F.SilkS", linew))
+        items.append (fpgen.Line (-xl, +ph2, -xr, +ph2, "F.SilkS", linew))
 
         # Draw a line along the left margin of the pad
-        f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.SilkS) (width %.2f))\n" % \
-            (-xl, +ph2, -xl, -ph2, linew))
+        items.append (fpgen.Line (-xl, +ph2, -xl, -ph2, "F.SilkS", linew))
 
     # Courtyard
-    l2 = (pads ['B'] if pads.has_key ('B') else pads ['b']) / 2 + clearance
-    w2 = ind ['W'] if ind ['W'] > pads ['c'] else pads ['c']
-    if pads.has_key ('d') and pads ['d'] > w2:
-        w2 = pads ['d']
-    w2 = w2 / 2 + clearance
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (-l2), round005 (-w2), round005 (+l2), round005 (-w2)))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (-l2), round005 (+w2), round005 (+l2), round005 (+w2)))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (-l2), round005 (-w2), round005 (-l2), round005 (+w2)))
-    f.write ("  (fp_line (start %g %g) (end %g %g) (layer F.CrtYd) (width 0.05))\n" % \
-        (round005 (+l2), round005 (-w2), round005 (+l2), round005 (+w2)))
-
-    fn3d = "%s/Choke_%s.wrl" % (dir3d, ind ['3dshape'] if ind.has_key ('3dshape') else dim)
-    f.write ("""\
-  (model %s
-    (at (xyz 0 0 0))
-    (scale (xyz 1 1 1))
-    (rotate (xyz 0 0 0))
-  )
-)
-""" % fn3d)
-    f.close ()
-
-
-def GenerateInductor (dim, ind, dest):
+    items.extend (fpgen.Rect (g ['cx1'], g ['cy1'], g ['cx2'], g ['cy2'],
+        "F.CrtYd", "0.05"))
+
+    items.append (fpgen.Model (g ['model']))
+    return (fn, fp, None)
+
+
+def HandPads (pads):
+    """
+    Derive the hand soldering pads from the reflow pads: add 25% length
+    and 10% width and move the pads from each other so that the internal
+    clearance stays the same. Returns a new dictionary.
+    """
+    hand = pads.copy ()
+    hand ['b'] = pads ['b'] * 1.25
+    hand ['c'] = pads ['c'] * 1.10
+    if pads.has_key ('B'):
+        hand ['B'] = pads ['B'] * 1.25
+    if pads.has_key ('C'):
+        hand ['C'] = pads ['C'] * 1.10
+    return hand
+
+
+def IPCPads (L, W, T, level):
+    """
+    Compute the pads for an IPC-7351 density level ("A", "B" or "C")
+    from the body length, the terminal width and length.
+    Returns a new dictionary; works with arrays as well.
+    """
+    b, a, c = fpgen.IPCChipPads (L, W, T, level)
+    return { 'a': a, 'b': b, 'c': c }
+
+
+def IPCDimensions (ind):
+    """
+    Return the IPCPads () dimensions of an inductor, or None
+    if the length of the terminals (T) is not known.
+    """
+    if not ind.has_key ('T'):
+        return None
+    return (ind ['L'], ind ['W'], ind ['T'])
+
+
+def DerivePads (ind, ipc = ()):
+    """
+    Return the list of (variant, pads) for an inductor: the pads
+    from the table, the automatic hand soldering pads if the table
+    has none, and the IPC density level variants computed for the
+    whole table by fpgen.IPCVariants (). The table entry is not modified.
+    """
+    res = []
+    for mod in [ "Hand", "Reflow", "Flow", "Wave" ]:
+        if ind.has_key (mod):
+            res.append ((mod, ind [mod]))
+
+    if (not ind.has_key ("Hand")) and (ind.has_key ("Reflow")):
+        res.append (("Hand", HandPads (ind ["Reflow"])))
+
+    return res + list (ipc)
+
+
+def InductorJobs (table, dest, levels = ()):
+    """
+    Return the list of footprints to generate for a table of inductors
+    as arguments for RenderInductor ().
+    """
     dirmod = dest + ".pretty"
     if not os.access (dirmod, os.R_OK):
         os.mkdir (dirmod, 0755)
@@ -487,91 +582,47 @@ def GenerateInductor (dim, ind, dest):
     if not os.access (dir3d, os.R_OK):
         os.mkdir (dir3d, 0755)
 
-    for mod in [ "Hand", "Reflow", "Flow", "Wave" ]:
-        if ind.has_key (mod):
-            _GenerateInductor (dirmod, dir3d,
-                dim, mod, ind, ind [mod])
+    ipc = fpgen.IPCVariants (table, levels, IPCDimensions, IPCPads)
 
-    if (not ind.has_key ("Hand")) and (ind.has_key ("Reflow")):
-        # Automatically generate hand soldering pads
-        # Use "Reflow" pads but add 25% length and 10% width and move pads
-        # from each out so that the internal cleaning stays the same
-        pads = ind ["Reflow"]
-        pads ['b'] *= 1.25
-        pads ['c'] *= 1.10
-        if pads.has_key ('B'):
-            pads ['B'] *= 1.25
-        if pads.has_key ('C'):
-            pads ['C'] *= 1.10
-        _GenerateInductor (dest + ".pretty", dest + ".3dshapes",
-            dim, "Hand", ind, pads)
-
-
-def PlaceModule (modfn, cx, cy, off):
-    for l in file (modfn, "r").readlines ():
-        off.write (l)
-        if (l.strip () [0:8] == "(module "):
-            off.write ("  (at %g %g)\n" % (cx, cy))
-
-
-def GenerateTestBoard (ifn, ofn):
-    iff = file (ifn, "r")
-    off = file (ofn, "w")
-
-    # Place by 16 components in a row
-    # Put Reflow in 1st row, Wave/Reflow in 2nd, Hand in 3rd row, then start all again.
-    cnum = 0
-    prevcompn = None
-    noname_column = 0
-    for l in iff.readlines ():
-        if l [0] == '@':
-            # Special mark where the content of a pretty lib should be inserted
-            mods = glob ("%s/*.kicad_mod" % l.strip () [1:])
-            mods.sort ()
-            for modfn in mods:
-                if modfn.find ("_Reflow.") >= 0:
-                    col = 0
-                    compn = modfn.replace ("Reflow", "")
-                elif modfn.find ("_Flow.") >= 0:
-                    col = 1
-                    compn = modfn.replace ("Flow", "")
-                elif modfn.find ("_Wave.") >= 0:
-                    col = 1
-                    compn = modfn.replace ("Wave", "")
-                elif modfn.find ("_Hand.") >= 0:
-                    col = 2
-                    compn = modfn.replace ("Hand", "")
-                else:
-                    col = noname_column
-                    noname_column ^= 1
-                    compn = modfn
-
-                if compn != prevcompn:
-                    if not (prevcompn is None):
-                        cnum += 1
-                    prevcompn = compn
-
-                cy = 20 + (cnum % 18) * 10
-                cx = 20 + (cnum / 18) * 14 * 4 + col * 14
-
-                PlaceModule (modfn, cx, cy, off)
-        else:
-            off.write (l)
-
-    iff.close ()
-    off.close ()
+    jobs = []
+    for dim,ind in table.items ():
+        jobs.extend ([(dirmod, dir3d, dim, mod, ind, pads)
+            for mod, pads in DerivePads (ind, ipc [dim])])
+    return jobs
 
 
 # --- === main === --- #
 
-for dim,ind in murata_power_inductors.items ():
-    GenerateInductor (dim, ind, "Choke_SMD")
+def Main (options, args):
+    """
+    Generate the footprints and the test board, see fpgen.Main ().
+    """
+    if options.force:
+        manifest = {}
+    else:
+        manifest = fpgen.LoadManifest (MANIFEST)
+
+    if len (args):
+        tables = fpgen.LoadTables (inductor_schema, args)
+    else:
+        tables = [(murata_power_inductors, "Choke_SMD"),
+                  (murata_general_inductors, "Choke_SMD"),
+                  (murata_rf_inductors, "Choke_SMD")]
+
+    jobs = []
+    for table, dest in tables:
+        jobs.extend (InductorJobs (table, dest, options.density))
+
+    changed = fpgen.Generate ("inductor", jobs, InductorFile, InductorRow,
+        RenderInductor, InductorTemplate, options.jobs, manifest)
+
+    # Generate the test board, with the hand-made footprints too
+    if not len (args):
+        fpgen.UpdateTestBoard ("Choke_SMD.kicad_pcb.template",
+            "Choke_SMD.kicad_pcb", manifest, changed, True)
 
-for dim,ind in murata_general_inductors.items ():
-    GenerateInductor (dim, ind, "Choke_SMD")
+    fpgen.SaveManifest (MANIFEST, manifest)
 
-for dim,ind in murata_rf_inductors.items ():
-    GenerateInductor (dim, ind, "Choke_SMD")
 
-# Generate the test board
-GenerateTestBoard ("Choke_SMD.kicad_pcb.template", "Choke_SMD.kicad_pcb")
+if __name__ == "__main__":
+    fpgen.Main (Main)
@@ -45,6 +45,7 @@ from bpy.props import (CollectionProperty,
                        BoolProperty,
                        EnumProperty,
                        FloatProperty,
+                       IntProperty,
                        PointerProperty,
                        )
 from bpy_extras.io_utils import (ExportHelper,
@@ -77,12 +78,72 @@ class ExportKiCadVRMLPrefs(PropertyGroup, ExportKiCadVRMLOrientationHelper):
             default=True,
             )
 
+    use_weld = BoolProperty(
+            name="Weld vertices",
+            description="Merge the vertices which are the same at the output precision "
+                "and drop the triangles which collapse",
+            default=False,
+            )
+
+    use_batch = BoolProperty(
+            name="Group by material",
+            description="Write the faces of all objects as one shape per material "
+                "instead of one shape per object",
+            default=False,
+            )
+
+    use_lod = BoolProperty(
+            name="Low detail copy",
+            description="Also export a decimated copy of the model to a _lod.wrl file "
+                "next to the full one",
+            default=False,
+            )
+
+    lod_ratio = FloatProperty(
+            name="LOD ratio",
+            description="The part of the triangles kept in the low detail copy",
+            min=0.01, max=1.0,
+            default=0.25,
+            )
+
+    lod_triangles = IntProperty(
+            name="LOD triangles",
+            description="The number of triangles in the low detail copy, "
+                "overrides the ratio if not zero",
+            min=0,
+            default=0,
+            )
+
     global_scale = FloatProperty(
             name="Scale",
             min=0.01, max=1000.0,
             default=0.393700,
             )
 
+def export_keywords(prefs):
+    """ Return the export_kicad.save() keywords for the export preferences
+    of a scene. The global matrix is a new one on every call."""
+    from mathutils import Matrix
+
+    keywords = {
+        "use_selection": prefs.use_selection,
+        "use_mesh_modifiers": prefs.use_mesh_modifiers,
+        "use_origin_to_center": prefs.use_origin_to_center,
+        "use_weld": prefs.use_weld,
+        "use_batch": prefs.use_batch,
+        "use_lod": prefs.use_lod,
+        "lod_ratio": prefs.lod_ratio,
+        "lod_triangles": prefs.lod_triangles,
+    }
+
+    global_matrix = axis_conversion(to_forward=prefs.axis_forward,
+                                    to_up=prefs.axis_up,
+                                    ).to_4x4() * Matrix.Scale(prefs.global_scale, 4)
+    keywords["global_matrix"] = global_matrix
+
+    return keywords
+
+
 class ExportKiCadVRML(Operator, ExportHelper):
     """Export mesh objects as a VRML2, colors and texture coordinates"""
     bl_idname = "export_scene.kicadvrml2"
@@ -94,21 +155,11 @@ class ExportKiCadVRML(Operator, ExportHelper):
 
     def execute(self, context):
         from . import export_kicad
-        from mathutils import Matrix
 
         prefs = context.scene.export_kicad_vrml_prefs
 
-        keywords = {
-            "filepath": self.filepath,
-            "use_selection": prefs.use_selection,
-            "use_mesh_modifiers": prefs.use_mesh_modifiers,
-            "use_origin_to_center": prefs.use_origin_to_center,
-        }
-
-        global_matrix = axis_conversion(to_forward=prefs.axis_forward,
-                                        to_up=prefs.axis_up,
-                                        ).to_4x4() * Matrix.Scale(prefs.global_scale, 4)
-        keywords["global_matrix"] = global_matrix
+        keywords = export_keywords(prefs)
+        keywords["filepath"] = self.filepath
 
         return export_kicad.save(self, context, **keywords)
 
@@ -120,6 +171,12 @@ class ExportKiCadVRML(Operator, ExportHelper):
         layout.prop (prefs, "use_selection")
         layout.prop (prefs, "use_mesh_modifiers")
         layout.prop (prefs, "use_origin_to_center")
+        layout.prop (prefs, "use_weld")
+        layout.prop (prefs, "use_batch")
+        layout.prop (prefs, "use_lod")
+        if prefs.use_lod:
+            layout.prop (prefs, "lod_ratio")
+            layout.prop (prefs, "lod_triangles")
 
         row = layout.row()
         layout.prop (prefs, "axis_forward")
@@ -0,0 +1,230 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8-80 compliant>
+
+# Export all the models of a .blend file to the .3dshapes directories
+# next to it, with the export settings saved in the scene. This is run
+# by tools/kicad-blender-export, or by hand in Blender background mode:
+#
+#   blender -b --factory-startup foo.blend \
+#       --python io_scene_kicad/batch.py -- [--force]
+#
+# Every top-level visible mesh object is a model, exported together with
+# its children. The model goes to the .wrl file which already has the
+# object name in it (Crystal_MC-146.wrl for object MC-146) in any of the
+# .3dshapes directories. The "kicad_model" custom property of the object,
+# if set, is the file name relative to the .blend file directory. Other
+# objects (helpers, reference objects) are not exported, with a warning.
+#
+# The hashes of the exported objects are kept in a hidden file next to
+# the .blend file (.foo.blend.idx), and models whose objects, materials,
+# modifiers and export settings did not change are not exported again,
+# unless --force is given.
+
+import bpy
+import hashlib
+import json
+import os
+import re
+import sys
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import io_scene_kicad
+from io_scene_kicad import export_kicad
+
+
+class Reporter:
+    """ Stands for the export operator, printing its reports."""
+    def __init__(self):
+        self.errors = 0
+
+    def report(self, type, message):
+        if 'ERROR' in type:
+            self.errors += 1
+        sys.stderr.write("%s: %s\n" % (", ".join(sorted(type)), message))
+
+
+def cache_file(blend):
+    return os.path.join(os.path.dirname(blend),
+                        ".%s.idx" % os.path.basename(blend))
+
+
+def file_hash(fn):
+    f = open(fn, 'rb')
+    h = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    return h
+
+
+def hierarchy(obj):
+    """ Return the object and all its descendants."""
+    objects = [obj]
+    for child in sorted(obj.children, key=lambda x: x.name):
+        objects.extend(hierarchy(child))
+    return objects
+
+
+def model_files(obj, dirs):
+    """ Find the .wrl files where an object may be exported: the file
+    set by its "kicad_model" property, or the existing files with the
+    object name in them. It's clear where to export the object only if
+    there's just one."""
+    fn = obj.get("kicad_model")
+    if not (fn is None):
+        return [os.path.join(os.path.dirname(bpy.data.filepath), fn)]
+
+    matches = []
+    for dn in dirs:
+        for fn in sorted(os.listdir(dn)):
+            stem, ext = os.path.splitext(fn)
+            if (ext != ".wrl") or stem.endswith("_lod"):
+                continue
+            if (stem == obj.name) or stem.endswith("_" + obj.name):
+                return [os.path.join(dn, fn)]
+            if re.search(r"(^|_)%s(_|$)" % re.escape(obj.name), stem):
+                matches.append(os.path.join(dn, fn))
+    return matches
+
+
+def rna_values(x):
+    """ Return the values of the simple properties of a Blender struct,
+    and the names of the data blocks it points to."""
+    values = []
+    for p in x.bl_rna.properties:
+        if p.type == 'COLLECTION':
+            continue
+        v = getattr(x, p.identifier)
+        if p.type == 'POINTER':
+            v = getattr(v, "name", None)
+        elif getattr(p, "is_array", False):
+            v = tuple(v)
+        values.append((p.identifier, v))
+    return values
+
+
+def model_hash(objects, keywords, exporter):
+    """ Return the hash of everything which makes up an exported model:
+    the object transforms, mesh data, materials and modifiers, the export
+    keywords and the exporter itself."""
+    h = hashlib.sha1(exporter.encode())
+    for k in sorted(keywords):
+        v = keywords[k]
+        if k == "global_matrix":
+            v = [tuple(r) for r in v]
+        h.update(repr((k, v)).encode())
+
+    for obj in objects:
+        h.update(repr((obj.name, obj.type, obj.hide,
+                       [tuple(r) for r in obj.matrix_world])).encode())
+        for m in obj.modifiers:
+            h.update(repr(rna_values(m)).encode())
+        if obj.type != 'MESH':
+            continue
+
+        me = obj.data
+        for items, attr, n, t in ((me.vertices, "co", 3, 'f'),
+                                  (me.loops, "vertex_index", 1, 'i'),
+                                  (me.polygons, "loop_total", 1, 'i'),
+                                  (me.polygons, "material_index", 1, 'i')):
+            a = array(t, [0]) * (len(items) * n)
+            items.foreach_get(attr, a)
+            h.update(a.tobytes())
+        for m in me.materials:
+            if m is None:
+                h.update(b"None")
+            else:
+                h.update(export_kicad.material_fields(m).encode())
+
+    return h.hexdigest()
+
+
+def export_models(force=False):
+    blend = bpy.data.filepath
+    base = os.path.dirname(blend)
+    dirs = sorted([os.path.join(base, x) for x in os.listdir(base)
+                   if x.endswith(".3dshapes") and os.path.isdir(os.path.join(base, x))])
+
+    try:
+        f = open(cache_file(blend), 'r')
+        cache = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        cache = {}
+    old = cache.get("models", {})
+    models = {}
+
+    f = open(export_kicad.__file__, 'r', encoding='utf-8')
+    exporter = f.read()
+    f.close()
+
+    io_scene_kicad.register()
+    scene = bpy.context.scene
+    prefs = scene.export_kicad_vrml_prefs
+    reporter = Reporter()
+
+    for obj in sorted(scene.objects, key=lambda x: x.name):
+        if (obj.type != 'MESH') or obj.hide or not (obj.parent is None):
+            continue
+
+        fns = model_files(obj, dirs)
+        if len(fns) == 0:
+            # Not a model, or a new one without the kicad_model property
+            reporter.report({'WARNING'}, "%s: no model file for %s, not exported"
+                            % (blend, obj.name))
+            continue
+        if len(fns) > 1:
+            reporter.report({'ERROR'}, "%s: don't know where to export %s: %s"
+                            % (blend, obj.name, ", ".join(fns)))
+            continue
+        fn = fns[0]
+
+        objects = hierarchy(obj)
+        keywords = io_scene_kicad.export_keywords(prefs)
+        keywords["use_selection"] = True
+        key = model_hash(objects, keywords, exporter)
+        rfn = os.path.relpath(fn, base)
+
+        if not force and (old.get(obj.name) == [rfn, key]) and os.path.exists(fn):
+            models[obj.name] = old[obj.name]
+            print("Unchanged %s" % fn)
+            continue
+
+        print("Exporting %s to %s" % (obj.name, fn))
+        context = type("Context", (), {"scene": scene, "selected_objects": objects})
+        if export_kicad.save(reporter, context, filepath=fn, **keywords) == {'FINISHED'}:
+            models[obj.name] = [rfn, key]
+
+    # Unless there were failures, the driver skips Blender next time
+    # if the .blend file is unchanged
+    cache = {"models": models}
+    if reporter.errors == 0:
+        cache["blend"] = file_hash(blend)
+        cache["exporter"] = hashlib.sha1(exporter.encode()).hexdigest()
+    f = open(cache_file(blend), 'w')
+    json.dump(cache, f, indent=1, sort_keys=True)
+    f.close()
+
+    return reporter.errors == 0
+
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if not export_models("--force" in argv):
+        sys.exit(1)
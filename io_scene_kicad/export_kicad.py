@@ -25,81 +25,230 @@ import mathutils
 import os
 from bpy_extras import object_utils
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def bmesh_arrays(bm):
+    """ Return the vertex coordinates, the triangle vertex indices and
+    the triangle material indices of a triangulated bmesh as flat lists.
+    With NumPy, BMesh has no foreach_get(), so the data is copied to
+    a temporary mesh and fetched from there."""
+    if numpy is None:
+        co = []
+        for v in bm.verts:
+            co.extend(v.co[:])
+        # Snap rounding errors to zero
+        co = [0 if abs(x) < 0.00001 else x for x in co]
+        idx = [v.index for f in bm.faces for v in f.verts[:3]]
+        mat = [f.material_index for f in bm.faces]
+        return co, idx, mat
+
+    me = bpy.data.meshes.new("KiCadVRMLExport")
+    try:
+        bm.to_mesh(me)
+        co = numpy.empty(len(me.vertices) * 3, dtype=numpy.float32)
+        me.vertices.foreach_get("co", co)
+        # The loops of a triangle are its vertices in order
+        idx = numpy.empty(len(me.loops), dtype=numpy.int32)
+        me.loops.foreach_get("vertex_index", idx)
+        mat = numpy.empty(len(me.polygons), dtype=numpy.int16)
+        me.polygons.foreach_get("material_index", mat)
+    finally:
+        bpy.data.meshes.remove(me)
+
+    # Snap rounding errors to zero
+    co[numpy.abs(co) < 0.00001] = 0
+    return co.tolist(), idx.tolist(), mat.tolist()
+
+
+def split_materials(co, idx, mat):
+    """ Split the arrays of a mesh by the material indices of the triangles.
+    Returns a list of (material index, co, idx) with the vertices of each
+    part renumbered, in the order the materials are first used."""
+    order = []
+    parts = {}
+    for t in range(len(mat)):
+        m = mat[t]
+        if not (m in parts):
+            parts[m] = []
+            order.append(m)
+        parts[m].extend(idx[t * 3:t * 3 + 3])
+
+    if len(order) < 2:
+        return [(m, co, idx) for m in order]
+
+    result = []
+    for m in order:
+        remap = {}
+        pco = []
+        pidx = []
+        for i in parts[m]:
+            j = remap.get(i)
+            if j is None:
+                j = remap[i] = len(remap)
+                pco.extend(co[i * 3:i * 3 + 3])
+            pidx.append(j)
+        result.append((m, pco, pidx))
+    return result
+
+
+def weld(points, idx):
+    """ Merge the vertices which are written the same, drop the triangles
+    which collapse because of that and the vertices no longer used.
+    Returns the new points and triangle vertex indices."""
+    index = {}
+    remap = [index.setdefault(p, len(index)) for p in points]
+    points = [None] * len(index)
+    for p, i in index.items():
+        points[i] = p
+
+    tris = []
+    used = [False] * len(points)
+    for k in range(0, len(idx), 3):
+        a, b, c = remap[idx[k]], remap[idx[k + 1]], remap[idx[k + 2]]
+        if (a != b) and (b != c) and (a != c):
+            tris.extend((a, b, c))
+            used[a] = used[b] = used[c] = True
+
+    if not all(used):
+        remap = []
+        n = 0
+        for u in used:
+            remap.append(n)
+            n += u
+        points = [p for p, u in zip(points, used) if u]
+        tris = [remap[i] for i in tris]
+    return points, tris
+
+
+def save_geometry(fw, co, idx, use_weld):
+    """ Write the point and coordIndex arrays, formatting all the numbers
+    of each of them at once."""
+    points = (("%.6g %.6g %.6g\0" * (len(co) // 3)) % tuple(co)).split("\0")[:-1]
+    if use_weld:
+        points, idx = weld(points, idx)
+
+    fw('\t\tcoord Coordinate { point [ ')
+    if len(points):
+        fw("\n\t\t\t" + ",\n\t\t\t".join(points))
+    fw(' ]\n')  # end 'point[]'
+    fw('\t\t}\n')  # end 'Coordinate'
+
+    fw('\t\tcoordIndex [ ')
+    if len(idx):
+        fw(("\n\t\t\t%d, %d, %d, -1," * (len(idx) // 3))[:-1] % tuple(idx))
+    fw(' ]\n')  # end 'coordIndex[]'
 
-def save_bmesh(fw, bm, materials):
+
+def save_bmesh(fw, bm, materials, use_weld=False):
 
     base_src = os.path.dirname(bpy.data.filepath)
     base_dst = os.path.dirname(fw.__self__.name)
 
+    # Export only the first material (one material per submesh limit)
+    material = None
+    for m in materials:
+        if not (m is None):
+            material = m
+            break
+
+    co, idx, mat = bmesh_arrays(bm)
+    save_shape(fw, material, co, idx, use_weld)
+
+
+def material_fields(m):
+    """ Return the fields of the VRML Material node for a Blender material."""
+    emissive_color = list (m.diffuse_color[:])
+    for x in range (len (emissive_color)):
+        emissive_color [x] *= m.emit
+    return ("\t\t\tdiffuseColor %.3g %.3g %.3g\n" % m.diffuse_color[:] +
+            "\t\t\temissiveColor %.3g %.3g %.3g\n" % tuple (emissive_color) +
+            "\t\t\tspecularColor %.3g %.3g %.3g\n" % m.specular_color[:] +
+            "\t\t\tambientIntensity %.3g\n" % m.ambient +
+            "\t\t\ttransparency %.3g\n" % (1-m.alpha) +
+            "\t\t\tshininess %.3g\n" % m.specular_intensity)
+
+
+def save_shape(fw, material, co, idx, use_weld, material_def=None):
+    """ Write a Shape with the given material (may be None) and geometry.
+    If material_def is given, the Material node is named with DEF."""
     fw('Shape {\n')
     fw('\tappearance Appearance {\n')
-    fw('\t\tmaterial Material {\n')
+    if material_def is None:
+        fw('\t\tmaterial Material {\n')
+    else:
+        fw('\t\tmaterial DEF %s Material {\n' % material_def)
 
-    # Export only the first material (one material per submesh limit)
-    for m in materials:
-        if m is None:
-            continue
-        fw('\t\t\t# Material %r\n' % materialid(m.name))
-        fw("\t\t\tdiffuseColor %.3g %.3g %.3g\n" % m.diffuse_color[:])
-        emissive_color = list (m.diffuse_color[:])
-        for x in range (len (emissive_color)):
-            emissive_color [x] *= m.emit
-        fw("\t\t\temissiveColor %.3g %.3g %.3g\n" % tuple (emissive_color))
-        fw("\t\t\tspecularColor %.3g %.3g %.3g\n" % m.specular_color[:])
-        fw("\t\t\tambientIntensity %.3g\n" % m.ambient)
-        fw("\t\t\ttransparency %.3g\n" % (1-m.alpha))
-        fw("\t\t\tshininess %.3g\n" % m.specular_intensity)
-        break
+    if not (material is None):
+        fw('\t\t\t# Material %r\n' % materialid(material.name))
+        fw(material_fields(material))
 
     fw('\t\t}\n')  # end 'Material'
     fw('\t}\n')  # end 'Appearance'
 
     fw('\tgeometry IndexedFaceSet {\n')
-    fw('\t\tcoord Coordinate { point [ ')
-    v = None
-    vn = len (bm.verts)
-    for v in bm.verts:
-        vn -= 1
-        # Snap rounding errors to zero
-        if abs (v.co [0]) < 0.00001:
-            v.co [0] = 0
-        if abs (v.co [1]) < 0.00001:
-            v.co [1] = 0
-        if abs (v.co [2]) < 0.00001:
-            v.co [2] = 0
-        fw("\n\t\t\t%.6g %.6g %.6g%s" % (v.co[0], v.co [1], v.co [2], \
-            "," if vn > 0 else ""))
-    del v
-    fw(' ]\n')  # end 'point[]'
-    fw('\t\t}\n')  # end 'Coordinate'
-
-    fw('\t\tcoordIndex [ ')
-    f = fv = None
-    nf = len (bm.faces)
-    for f in bm.faces:
-        fv = f.verts[:]
-        nf -= 1
-        fw("\n\t\t\t%d, %d, %d, -1%s" % \
-            (fv[0].index, fv[1].index, fv[2].index, "," if nf > 0 else ""))
-    del f, fv
-    fw(' ]\n')  # end 'coordIndex[]'
-
+    save_geometry(fw, co, idx, use_weld)
     fw('\t}\n')  # end 'IndexedFaceSet'
     fw('}\n')  # end 'Shape'
 
 
-def save_object(fw, global_matrix,
-                scene, obj,
-                use_mesh_modifiers):
+def count_triangles(scene, obj, use_mesh_modifiers):
+    """ Return the number of triangles of the mesh decimated_mesh() works
+    on: the mesh with its modifiers applied if use_mesh_modifiers is true,
+    otherwise the mesh data of the object."""
+    if not use_mesh_modifiers:
+        return sum([len(p.vertices) - 2 for p in obj.data.polygons])
+
+    me = obj.to_mesh(scene, True, 'PREVIEW', calc_tessface=False)
+    try:
+        return sum([len(p.vertices) - 2 for p in me.polygons])
+    finally:
+        bpy.data.meshes.remove(me)
+
+
+def decimated_mesh(scene, obj, ratio, use_mesh_modifiers):
+    """ Return a mesh of the object reduced to the given ratio of triangles
+    by edge collapsing, with a temporary Decimate modifier added on top
+    of the others. If use_mesh_modifiers is false, the other modifiers
+    are disabled meanwhile."""
+    disabled = []
+    if not use_mesh_modifiers:
+        for m in obj.modifiers:
+            if m.show_viewport:
+                m.show_viewport = False
+                disabled.append(m)
+
+    mod = obj.modifiers.new("KiCadVRMLDecimate", 'DECIMATE')
+    try:
+        mod.decimate_type = 'COLLAPSE'
+        mod.ratio = ratio
+        mod.use_collapse_triangulate = True
+        me = obj.to_mesh(scene, True, 'PREVIEW', calc_tessface=False)
+    finally:
+        obj.modifiers.remove(mod)
+        for m in disabled:
+            m.show_viewport = True
+    return me
 
+
+def object_bmesh(global_matrix, scene, obj, use_mesh_modifiers,
+                 lod_ratio=None):
+    """ Return a triangulated bmesh of the object in the exported
+    coordinates, and the materials of its mesh."""
     assert(obj.type == 'MESH')
 
-    if use_mesh_modifiers:
+    if use_mesh_modifiers or not (lod_ratio is None):
         is_editmode = (obj.mode == 'EDIT')
         if is_editmode:
             bpy.ops.object.editmode_toggle()
 
-        me = obj.to_mesh(scene, True, 'PREVIEW', calc_tessface=False)
+        if lod_ratio is None:
+            me = obj.to_mesh(scene, True, 'PREVIEW', calc_tessface=False)
+        else:
+            me = decimated_mesh(scene, obj, lod_ratio, use_mesh_modifiers)
         bm = bmesh.new()
         bm.from_mesh(me)
 
@@ -119,10 +268,68 @@ def save_object(fw, global_matrix,
     bmesh.ops.triangulate(bm, faces=bm.faces)
     bm.transform(global_matrix * obj.matrix_world)
 
-    save_bmesh(fw, bm, me.materials)
+    return bm, me.materials
+
+
+def save_object(fw, global_matrix,
+                scene, obj,
+                use_mesh_modifiers,
+                use_weld=False,
+                lod_ratio=None):
+
+    bm, materials = object_bmesh(global_matrix, scene, obj,
+                                 use_mesh_modifiers, lod_ratio)
+
+    save_bmesh(fw, bm, materials, use_weld)
 
     bm.free()
 
+
+def save_batched(fw, global_matrix, scene, objects,
+                 use_mesh_modifiers, use_weld=False, lod_ratio=None):
+    """ Write the faces of all the objects grouped by material, one Shape
+    per material. Materials which differ only by name (like 'Metal' and
+    'Metal.001' after appending objects from other files) are merged."""
+    shapes = {}
+    order = []
+    for obj in objects:
+        bm, materials = object_bmesh(global_matrix, scene, obj,
+                                     use_mesh_modifiers, lod_ratio)
+        co, idx, mat = bmesh_arrays(bm)
+        bm.free()
+
+        for m, pco, pidx in split_materials(co, idx, mat):
+            material = None
+            if m < len(materials):
+                material = materials[m]
+            if material is None:
+                key = None
+            else:
+                key = material_fields(material)
+
+            shape = shapes.get(key)
+            if shape is None:
+                shape = shapes[key] = (material, [], [])
+                order.append(key)
+            base = len(shape[1]) // 3
+            shape[1].extend(pco)
+            shape[2].extend([i + base for i in pidx])
+
+    names = set()
+    for key in order:
+        material, co, idx = shapes[key]
+        if material is None:
+            save_shape(fw, None, co, idx, use_weld)
+            continue
+
+        name = vrmlid(material.name)
+        n = 1
+        while name in names:
+            n += 1
+            name = "%s_%d" % (vrmlid(material.name), n)
+        names.add(name)
+        save_shape(fw, material, co, idx, use_weld, name)
+
 def vrmlid(n):
     """ Transform a object ID into something VRML can swallow"""
     return '_' + n.replace ('.', '_').replace (' ','_')
@@ -131,13 +338,44 @@ def materialid(n):
     """ Transform a material name for VRML compatibility, but no leading '_', we might reimport wrl and keep material names."""
     return n.replace ('.', '_').replace (' ','-')
     
+def write_file(filepath, objects, global_matrix, scene,
+               use_mesh_modifiers, use_weld, use_batch=False,
+               lod_ratio=None):
+    """ Write the mesh objects to a .wrl file, decimated to lod_ratio
+    of their triangles if it is given."""
+    file = open(filepath, 'w', encoding='utf-8')
+    fw = file.write
+    fw('#VRML V2.0 utf8\n')
+    fw('#modeled using blender3d http://blender.org\n')
+
+    if use_batch:
+        save_batched(fw, global_matrix, scene, objects,
+                     use_mesh_modifiers, use_weld, lod_ratio)
+    else:
+        for obj in objects:
+            fw("\n# %r\nDEF %s Transform {\nchildren [\n" % (obj.name, vrmlid (obj.name)))
+            save_object(fw, global_matrix,
+                        scene, obj,
+                        use_mesh_modifiers,
+                        use_weld,
+                        lod_ratio)
+            fw("]\n}\n")
+
+    file.close()
+
+
 def save(operator,
          context,
          filepath="",
          global_matrix=None,
          use_selection=False,
          use_mesh_modifiers=True,
-         use_origin_to_center=True):
+         use_origin_to_center=True,
+         use_weld=False,
+         use_batch=False,
+         use_lod=False,
+         lod_ratio=0.25,
+         lod_triangles=0):
 
     scene = context.scene
 
@@ -179,21 +417,24 @@ and are part of different hierarchies.
         if not (top is None):
             global_matrix *= mathutils.Matrix.Translation (-toploc)
 
-    file = open(filepath, 'w', encoding='utf-8')
-    fw = file.write
-    fw('#VRML V2.0 utf8\n')
-    fw('#modeled using blender3d http://blender.org\n')
-
-    for obj in objects:
-        if (obj.type != 'MESH') or obj.hide:
-            continue
-
-        fw("\n# %r\nDEF %s Transform {\nchildren [\n" % (obj.name, vrmlid (obj.name)))
-        save_object(fw, global_matrix,
-                    scene, obj,
-                    use_mesh_modifiers)
-        fw("]\n}\n")
-
-    file.close()
+    objects = [obj for obj in objects
+               if (obj.type == 'MESH') and not obj.hide]
+
+    write_file(filepath, objects, global_matrix, scene,
+               use_mesh_modifiers, use_weld, use_batch)
+
+    if use_lod:
+        # A triangle budget is shared by all objects in proportion
+        # to their size
+        if lod_triangles > 0:
+            total = sum([count_triangles(scene, obj, use_mesh_modifiers)
+                         for obj in objects])
+            if total > 0:
+                lod_ratio = min(1.0, float(lod_triangles) / total)
+
+        # The low detail model goes alongside the full one
+        base, ext = os.path.splitext(filepath)
+        write_file(base + "_lod" + ext, objects, global_matrix, scene,
+                   use_mesh_modifiers, use_weld, use_batch, lod_ratio)
 
     return {'FINISHED'}
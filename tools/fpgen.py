@@ -0,0 +1,1362 @@
+#!/usr/bin/python
+"""
+This module contains the code shared by the footprint generators
+(Capacitors_gen/go.py, Choke_SMD/murata-gen.py and alike).
+
+A generator is a thin front-end with the dimension tables: it turns
+every table entry into a list of jobs, computes the geometry of all
+the jobs at once with a function passed to Vectorize () and builds
+a Footprint object for every job with the helper functions below.
+Generate () takes care of skipping the footprints which did not change
+(see LoadManifest ()), spreading the work over a pool of processes
+and writing the footprint files; GenerateTestBoard () places all the
+footprints on a test board. Main () runs the generator, optionally
+writing a JSON report with the time spent on every footprint (see
+report) and profiling it.
+
+The geometry functions are written with plain arithmetic and the
+Maximum (), Where () and Round005 () helpers, so they can be called
+either with the numbers of a single job, or with NumPy arrays holding
+the numbers of all jobs. If NumPy is installed, Vectorize () uses the
+latter, computing the coordinates for a whole table family in one go.
+"""
+
+import sys, os, math, time
+import hashlib, marshal, types
+import csv, json
+import multiprocessing
+import optparse
+import cProfile
+
+import kicad
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# --- === Geometry === --- #
+
+# Round to nearest 0.05 multiple (for courtyard)
+def round005 (x):
+    # For negative values, do floor(), for positive, do ceil()
+    if x < 0:
+        return (math.floor (x * 20.0 + 0.01)) / 20.0
+    else:
+        return (math.ceil (x * 20.0 - 0.01)) / 20.0
+
+
+def Round005 (x):
+    """
+    round005 () for a number or an array of numbers.
+    """
+    if isinstance (x, float):
+        return round005 (x)
+    return numpy.where (x < 0, numpy.floor (x * 20.0 + 0.01) / 20.0,
+        numpy.ceil (x * 20.0 - 0.01) / 20.0)
+
+
+def Maximum (a, b):
+    """
+    The larger of two numbers, or element-wise maximum of two arrays.
+    """
+    if isinstance (a, float) and isinstance (b, float):
+        return a if a > b else b
+    return numpy.maximum (a, b)
+
+
+def Where (cond, a, b):
+    """
+    a if cond is true, b otherwise; element-wise for arrays.
+    """
+    if isinstance (cond, bool):
+        return a if cond else b
+    return numpy.where (cond, a, b)
+
+
+def Vectorize (func, rows):
+    """
+    Compute the geometry of many footprints.
+
+    func -- a function which takes the numbers describing a footprint
+        and returns a dictionary with the computed values.
+    rows -- a list of tuples of the arguments for func.
+
+    Returns a list of dictionaries, one per row. With NumPy, func is
+    called just once with arrays made of the columns of rows.
+    """
+    rows = [tuple ([float (x) for x in row]) for row in rows]
+    if (numpy is None) or (len (rows) < 2):
+        return [func (*row) for row in rows]
+
+    n = len (rows)
+    res = func (*[numpy.array (x) for x in zip (*rows)])
+    cols = [(k, numpy.broadcast_to (v, (n,)).tolist ()) for k, v in res.items ()]
+    return [dict ([(k, v [i]) for k, v in cols]) for i in xrange (n)]
+
+
+def Evaluate (func, rows):
+    """
+    Like Vectorize (), but for a function returning a single value.
+    Returns the list of values, one per row.
+    """
+    rows = [tuple ([float (x) for x in row]) for row in rows]
+    if (numpy is None) or (len (rows) < 2):
+        return [func (*row) for row in rows]
+
+    res = func (*[numpy.array (x) for x in zip (*rows)])
+    return numpy.broadcast_to (res, (len (rows),)).tolist ()
+
+
+# IPC-7351B solder fillet goals for rectangular and square-end chip
+# components (capacitors, resistors, inductors): (toe, heel, side) for
+# the density levels A (most), B (nominal) and C (least). The second
+# table is for the chips smaller than 1608 metric (0603 inch).
+ipc_chip_fillets = {
+    "A": (0.55, 0.00, 0.05),
+    "B": (0.35, 0.00, 0.00),
+    "C": (0.15, 0.00, -0.05),
+}
+ipc_small_chip_fillets = {
+    "A": (0.30, 0.00, 0.05),
+    "B": (0.20, 0.00, 0.00),
+    "C": (0.10, 0.00, -0.05),
+}
+
+# The names of the density levels
+ipc_levels = (("A", "Most"), ("B", "Nominal"), ("C", "Least"))
+
+
+def IPCChipPads (L, W, T, level):
+    """
+    Compute the land pattern of a chip component for an IPC-7351
+    density level from its nominal body length L, terminal width W and
+    terminal length T. Returns a tuple (Z, G, X): the span of the pads,
+    the gap between them and the pad width. The pad length is (Z - G) / 2
+    and the distance between the pad centers is (Z + G) / 2.
+    Tolerances are not known, so they are not taken into account.
+    """
+    toe = Where (L < 1.6, ipc_small_chip_fillets [level][0], ipc_chip_fillets [level][0])
+    heel = Where (L < 1.6, ipc_small_chip_fillets [level][1], ipc_chip_fillets [level][1])
+    side = Where (L < 1.6, ipc_small_chip_fillets [level][2], ipc_chip_fillets [level][2])
+    return (L + toe * 2, L - T * 2 - heel * 2, W + side * 2)
+
+
+def IPCVariants (table, levels, dims, pads):
+    """
+    Compute the pads for the IPC-7351 density levels for all the parts
+    of a table at once.
+
+    levels -- the density levels, e.g. "ABC".
+    dims -- a function returning (L, W, T) for a part (see IPCChipPads ()),
+        or None if the part dimensions are not known.
+    pads -- a function (L, W, T, level) returning the pads dictionary,
+        written like a geometry function for Vectorize ().
+
+    Returns a dictionary mapping part names to lists of (variant, pads).
+    """
+    names = []
+    rows = []
+    for name, part in sorted (table.items ()):
+        row = dims (part)
+        if not (row is None):
+            names.append (name)
+            rows.append (row)
+
+    res = dict ([(name, []) for name in table.keys ()])
+    for level, mod in ipc_levels:
+        if level in levels:
+            for name, x in zip (names, Vectorize (
+                    lambda L, W, T: pads (L, W, T, level), rows)):
+                res [name].append ((mod, x))
+    return res
+
+
+def VariantText (mod):
+    """
+    Describe a footprint variant: "Reflow soldering",
+    "IPC-7351 density level B (nominal)" etc.
+    """
+    for level, name in ipc_levels:
+        if mod == name:
+            return "IPC-7351 density level %s (%s)" % (level, name.lower ())
+    return "%s soldering" % mod
+
+
+# --- === Footprint model === --- #
+
+def Num (x, fmt = None):
+    """
+    Format a number for a footprint file ("%g" unless another format
+    is given). Strings are left as is, so that a generator can use its
+    own format where needed.
+    """
+    if isinstance (x, str):
+        if isinstance (x, Slot) and not (fmt is None):
+            return x.Format (fmt)
+        return x
+    return (fmt or "%g") % x
+
+
+def NewFootprint (name, descr, tags, attr = "smd"):
+    """
+    Create an empty footprint with description, tags and attributes.
+    """
+    fp = kicad.Footprint (name)
+    fp.items.append (["descr", '"%s"' % descr])
+    fp.items.append (["tags", '"%s"' % tags])
+    if attr:
+        fp.items.append (["attr", attr])
+    return fp
+
+
+def Text (kind, text, x, y, layer):
+    """
+    A reference, value or user text using the default font.
+    """
+    return kicad.FpText (["fp_text", kind, kicad.Quote (text),
+        ["at", Num (x), Num (y)], ["layer", layer],
+        ["effects", ["font", ["size", "1", "1"], ["thickness", "0.15"]]]])
+
+
+def Pad (number, x, y, w, h, layers, type = "smd", shape = "rect"):
+    return kicad.Pad (["pad", kicad.Quote (number), type, shape,
+        ["at", Num (x), Num (y)], ["size", Num (w), Num (h)],
+        ["layers"] + list (layers)])
+
+
+def Line (x1, y1, x2, y2, layer, width):
+    return kicad.FpLine (["fp_line", ["start", Num (x1), Num (y1)],
+        ["end", Num (x2), Num (y2)], ["layer", layer], ["width", Num (width)]])
+
+
+def Rect (x1, y1, x2, y2, layer, width):
+    """
+    The four lines of a rectangle: top, bottom, left and right.
+    """
+    return [Line (x1, y1, x2, y1, layer, width),
+            Line (x1, y2, x2, y2, layer, width),
+            Line (x1, y1, x1, y2, layer, width),
+            Line (x2, y1, x2, y2, layer, width)]
+
+
+def Model (path):
+    """
+    A 3D model at the footprint origin, not scaled and not rotated.
+    """
+    return kicad.Model (["model", path,
+        ["at", ["xyz", "0", "0", "0"]],
+        ["scale", ["xyz", "1", "1", "1"]],
+        ["rotate", ["xyz", "0", "0", "0"]]])
+
+
+def _Atoms (node, keyword):
+    """
+    Return the atoms of the "(keyword ...)" sub-expression of a node.
+    """
+    for x in node:
+        if isinstance (x, list) and (x [:1] == [keyword]):
+            return x [1:]
+    return []
+
+
+def _BoxTerms (fp, layers = None):
+    """
+    Return the x and y coordinates of the points making the bounding box
+    of the lines, arcs, pads and text anchors of a footprint (or of the
+    items on the given layers only), as two lists of terms (kind, atoms):
+
+    ("", (a,)) -- the value of the atom a.
+    ("+", (a, b)), ("-", (a, b)) -- a plus or minus half of b.
+    ("+r", (a, b, c, d)), ("-r", (a, b, c, d)) -- a plus or minus
+        the distance between the points (a, b) and (c, d).
+    """
+    xs = []
+    ys = []
+    for x in fp.items:
+        if isinstance (x, kicad.Pad):
+            node = x.node
+            if not (layers is None) and not [l for l in _Atoms (node, "layers")
+                if kicad.Unquote (l) in layers]:
+                continue
+            at = _Atoms (node, "at")
+            w, h = _Atoms (node, "size") [:2]
+            if (len (at) > 2) and (int (float (at [2])) % 180 != 0):
+                w, h = h, w
+            xs.extend ((("-", (at [0], w)), ("+", (at [0], w))))
+            ys.extend ((("-", (at [1], h)), ("+", (at [1], h))))
+        elif isinstance (x, (kicad.FpLine, kicad.FpArc, kicad.FpText)):
+            node = x.node
+            if not (layers is None) and \
+               not (kicad.Unquote (_Atoms (node, "layer") [0]) in layers):
+                continue
+            if isinstance (x, kicad.FpText):
+                at = _Atoms (node, "at")
+                xs.append (("", (at [0],)))
+                ys.append (("", (at [1],)))
+                continue
+            x1, y1 = _Atoms (node, "start") [:2]
+            x2, y2 = _Atoms (node, "end") [:2]
+            if isinstance (x, kicad.FpLine):
+                xs.extend ((("", (x1,)), ("", (x2,))))
+                ys.extend ((("", (y1,)), ("", (y2,))))
+            else:
+                # The arc is somewhere on the circle around the start point
+                xs.extend ((("-r", (x1, y1, x2, y2)), ("+r", (x1, y1, x2, y2))))
+                ys.extend ((("-r", (y1, x1, y2, x2)), ("+r", (y1, x1, y2, x2))))
+    return xs, ys
+
+
+def _TermValue (term, value):
+    kind, atoms = term
+    if kind == "":
+        return value (atoms [0])
+    if kind [1:] == "r":
+        a, b, c, d = [value (x) for x in atoms]
+        r = math.hypot (c - a, d - b)
+    else:
+        a = value (atoms [0])
+        r = value (atoms [1]) / 2
+    if kind [0] == "-":
+        return a - r
+    return a + r
+
+
+def FootprintBox (fp, layers = None):
+    """
+    Return the bounding box (x1, y1, x2, y2) of the lines, arcs, pads
+    and text anchors of a footprint, or of the items on the given layers
+    only. Returns None if there are no such items.
+    """
+    xs, ys = _BoxTerms (fp, layers)
+    if not len (xs):
+        return None
+    xs = [_TermValue (x, float) for x in xs]
+    ys = [_TermValue (y, float) for y in ys]
+    return (min (xs), min (ys), max (xs), max (ys))
+
+
+def FootprintBoxes (fp):
+    """
+    Return the bounding boxes of a footprint as a tuple (outline, courtyard).
+    If the footprint has no courtyard, it is the outline.
+    """
+    box = FootprintBox (fp)
+    crtyd = FootprintBox (fp, ("F.CrtYd",))
+    if crtyd is None:
+        crtyd = box
+    return (box, crtyd)
+
+
+# --- === Footprint templates === --- #
+
+class Slot (str):
+    """
+    A placeholder for a geometry value or a string of a footprint, used
+    to build its template. It is a marker string which is put into the
+    footprint model as is, so a slot can be passed anywhere a formatted
+    number or a string is expected; a geometry slot can also be negated.
+    """
+
+    def __new__ (cls, name, sign = "", fmt = "%g"):
+        self = str.__new__ (cls, "\0%s%s|%s\0" % (sign, name, fmt))
+        self.name = name
+        self.sign = sign
+        self.fmt = fmt
+        return self
+
+
+    def __neg__ (self):
+        return Slot (self.name, "-" [:len (self.sign) ^ 1], self.fmt)
+
+
+    def __pos__ (self):
+        return self
+
+
+    def Format (self, fmt):
+        return Slot (self.name, self.sign, fmt)
+
+
+def _BoxCode (fp, layers):
+    """
+    Return the Python expression computing the bounding box of
+    a template footprint from its geometry values g, see FootprintBox ().
+    """
+    def atom (x):
+        if isinstance (x, Slot):
+            return "%sg [%r]" % (x.sign, x.name)
+        return repr (float (x))
+
+    def term (t):
+        kind, atoms = t
+        a = [atom (x) for x in atoms]
+        if kind == "":
+            return a [0]
+        if kind [1:] == "r":
+            return "%s %s math.hypot (%s - %s, %s - %s)" % \
+                (a [0], kind [0], a [2], a [0], a [3], a [1])
+        return "%s %s %s / 2" % (a [0], kind, a [1])
+
+    xs, ys = _BoxTerms (fp, layers)
+    if not len (xs):
+        return "None"
+    return "(min (%s), min (%s), max (%s), max (%s))" % \
+        (", ".join ([term (x) for x in xs]), ", ".join ([term (y) for y in ys]),
+         ", ".join ([term (x) for x in xs]), ", ".join ([term (y) for y in ys]))
+
+
+def CompileTemplate (render, job, g):
+    """
+    Compile the template of the footprints drawn the same way as the one
+    of the given job: the footprint is rendered with slots in place of
+    the geometry values and strings (the booleans are kept, since they
+    tell how to draw it), and its text is turned into a format string.
+    The template is compiled into two functions of the geometry values
+    and strings: one filling them into the format in a single operation,
+    and one computing the bounding boxes (see FootprintBoxes ()).
+
+    Returns a tuple (fill, boxes) of these functions, or None if the job
+    can't be rendered.
+    """
+    sg = {}
+    for name, x in g.items ():
+        if isinstance (x, bool):
+            sg [name] = x
+        else:
+            sg [name] = Slot (name)
+    fn, fp, error = render (job, sg)
+    if fp is None:
+        return None
+
+    parts = fp.Format ().split ("\0")
+    fmt = [parts [0].replace ("%", "%%")]
+    values = []
+    quoted = parts [0].count ('"') & 1
+    for i in xrange (1, len (parts), 2):
+        sign, spec = parts [i][:1], parts [i]
+        if sign == "-":
+            spec = spec [1:]
+        else:
+            sign = ""
+        name, vfmt = spec.split ("|", 1)
+        if isinstance (g [name], str):
+            # A string outside quotes has to be quoted if necessary
+            if quoted:
+                values.append ("g [%r]" % name)
+            else:
+                values.append ("quote (g [%r])" % name)
+            vfmt = "%s"
+        else:
+            values.append ("%sg [%r]" % (sign, name))
+        fmt.append (vfmt)
+        fmt.append (parts [i + 1].replace ("%", "%%"))
+        quoted ^= parts [i + 1].count ('"') & 1
+    fill = eval ("lambda g: %r %% (%s)" % ("".join (fmt), "".join (
+        [x + ", " for x in values])), {"quote": kicad.Quote})
+
+    box = _BoxCode (fp, None)
+    crtyd = _BoxCode (fp, ("F.CrtYd",))
+    if crtyd == "None":
+        crtyd = "box"
+    boxes = eval ("lambda g: (lambda box: (box, %s)) (%s)" % (crtyd, box),
+        {"math": math})
+    return (fill, boxes)
+
+
+# --- === Build manifest === --- #
+
+def Canonical (x):
+    """
+    Return a representation of the table data which does not depend
+    on the order of dictionary keys.
+    """
+    if isinstance (x, dict):
+        return "{%s}" % ", ".join (["%r: %s" % (k, Canonical (x [k]))
+            for k in sorted (x.keys ())])
+    if isinstance (x, (list, tuple)):
+        return "(%s)" % ", ".join ([Canonical (y) for y in x])
+    return repr (x)
+
+
+def _CodeData (co):
+    # Leave out the line numbers, so that editing the tables
+    # above the code doesn't change its version
+    return (co.co_code, co.co_names, co.co_varnames,
+        tuple ([_CodeData (x) if isinstance (x, types.CodeType) else x
+            for x in co.co_consts]))
+
+
+def _CodeNames (co):
+    names = set (co.co_names)
+    for x in co.co_consts:
+        if isinstance (x, types.CodeType):
+            names.update (_CodeNames (x))
+    return names
+
+
+def _IsData (x):
+    if isinstance (x, (bool, int, long, float, str, unicode, types.NoneType)):
+        return True
+    if isinstance (x, (list, tuple)):
+        return all ([_IsData (y) for y in x])
+    if isinstance (x, dict):
+        return all ([_IsData (k) and _IsData (v) for k, v in x.items ()])
+    return False
+
+
+def _GlobalData (func):
+    """
+    Return the values of the global constants (numbers, strings and
+    containers of them) a function reads, either by name or as attributes
+    of a module, e.g. PMOFS or fpgen.ipc_levels.
+    """
+    g = func.func_globals
+    names = sorted (_CodeNames (func.func_code))
+    data = []
+    for name in names:
+        if not g.has_key (name):
+            continue
+        x = g [name]
+        if x is None:
+            # An optional module which is not installed
+            continue
+        if isinstance (x, types.ModuleType):
+            for attr in names:
+                y = getattr (x, attr, None)
+                if hasattr (x, attr) and _IsData (y):
+                    data.append ("%s.%s = %s" % (name, attr, Canonical (y)))
+        elif _IsData (x):
+            data.append ("%s = %s" % (name, Canonical (x)))
+    return data
+
+
+def CodeVersion (*funcs):
+    """
+    Return the hash of the compiled code of the given functions
+    (or methods) and of the global constants they read.
+    """
+    h = hashlib.sha1 ()
+    for func in funcs:
+        func = getattr (func, "im_func", func)
+        h.update (marshal.dumps (_CodeData (func.func_code)))
+        h.update ("\n".join (_GlobalData (func)))
+    return h.hexdigest ()
+
+
+def LoadManifest (fn):
+    """
+    Load the build manifest: a dictionary mapping the generated file
+    names to the hashes of the data they were generated from.
+    """
+    manifest = {}
+    try:
+        f = open (fn, "r")
+    except IOError:
+        return manifest
+    for l in f.readlines ():
+        l = l.rstrip ("\n").split (" ", 1)
+        if len (l) == 2:
+            manifest [l [1]] = l [0]
+    f.close ()
+    return manifest
+
+
+def SaveManifest (fn, manifest):
+    tfn = "%s.%d" % (fn, os.getpid ())
+    f = open (tfn, "w")
+    for x in sorted (manifest.keys ()):
+        f.write ("%s %s\n" % (manifest [x], x))
+    f.close ()
+    os.rename (tfn, fn)
+
+
+# The code that makes the footprint text, part of every footprint hash
+model_code = (round005, Round005, Maximum, Where, Vectorize, Num, VariantText,
+    Slot.__new__, Slot.__neg__, Slot.Format, _BoxTerms, _BoxCode,
+    CompileTemplate,
+    NewFootprint, Text, Pad, Line, Rect, Model,
+    kicad.Quote, kicad.FormatSExpr, kicad.FpItem.Format, kicad.FpText.Format,
+    kicad.Model.Format, kicad.Footprint.Format)
+
+
+# --- === Dimension tables === --- #
+
+def _Flag (x):
+    if isinstance (x, bool):
+        return x
+    x = str (x).strip ().lower ()
+    if x in ("1", "true", "yes", "y"):
+        return True
+    if x in ("", "0", "false", "no", "n"):
+        return False
+    raise ValueError ("not a flag")
+
+
+def _Str (x):
+    if isinstance (x, unicode):
+        return x.encode ("utf-8")
+    if not isinstance (x, str):
+        raise ValueError ("not a string")
+    return x
+
+
+class TableSchema (object):
+    """
+    The description of a dimension table, used to load the tables from
+    CSV and JSON files. A table is a dictionary mapping part names to
+    dictionaries with the part dimensions and attributes; the pad
+    dimensions for every soldering method ("variant") are dictionaries
+    too, e.g. { '0603': { 'L': 1.6, 'W': 0.8, 'Reflow': { 'Z': 2.2 ... }}}.
+
+    In a JSON file the table is written just like that. In a CSV file
+    every part is a row: the first column ("Name") holds the part name,
+    the pad dimensions go to columns named "Variant.Field" (such as
+    "Reflow.Z") and empty cells stand for missing values.
+
+    part -- (field, type, required) for the part fields; type is float,
+        str or bool. Instead of true or false, required may be the name
+        of another field which makes this one required.
+    variants -- the names of the variants.
+    pads -- (field, type, required) for the fields of every variant.
+    rules -- (function, message) for the consistency checks. A rule is
+        checked for every variant having all the fields named after
+        the function arguments (part or pad fields); the function
+        returns true if the values are wrong, and the message is
+        formatted with a dictionary of the values.
+
+    The rules are checked for all the rows at once (see Evaluate ()).
+    Loaded tables are cached in a marshal file next to the table file,
+    so a big table is parsed and checked only when it changes.
+    """
+    cache_magic = "FPGT"
+    cache_version = 1
+
+    converters = { float: float, str: _Str, bool: _Flag }
+
+
+    def __init__(self, part, variants, pads, rules = ()):
+        self.part = part
+        self.variants = variants
+        self.pads = pads
+        self.rules = rules
+
+
+    def Version (self):
+        """
+        Return the hash of the schema, including the rules code.
+        """
+        return hashlib.sha1 (Canonical ((self.part, self.variants, self.pads,
+            [x [1] for x in self.rules])) + CodeVersion (*[x [0] for x in self.rules])).hexdigest ()
+
+
+    def _Convert (self, name, x, fields, errors):
+        """
+        Convert and check the fields of a part or of a variant.
+        """
+        res = {}
+        converters = self.converters
+        for field, type, required in fields:
+            v = x.pop (field, None)
+            if (v is None) or (v == ""):
+                if required is True:
+                    errors.append ("%s: missing %s" % (name, field))
+                elif required and (x.has_key (required) or res.has_key (required)):
+                    errors.append ("%s: missing %s (required with %s)" % (name, field, required))
+                continue
+            try:
+                res [field] = converters [type] (v)
+            except (ValueError, TypeError):
+                errors.append ("%s: bad %s value %r" % (name, field, v))
+        return res
+
+
+    def Check (self, rows):
+        """
+        Convert the raw table (values may be strings) and check it.
+        Returns the table and the list of error messages.
+        """
+        table = {}
+        errors = []
+        for name, x in rows:
+            x = dict (x)
+            part = self._Convert (name, x, self.part, errors)
+            for v in self.variants:
+                pads = x.pop (v, None)
+                if pads is None:
+                    continue
+                if not isinstance (pads, dict):
+                    errors.append ("%s: %s is not a set of pad dimensions" % (name, v))
+                    continue
+                pads = dict (pads)
+                part [v] = self._Convert ("%s %s" % (name, v), pads, self.pads, errors)
+                for field in pads.keys ():
+                    errors.append ("%s %s: unknown field %s" % (name, v, field))
+            for field in x.keys ():
+                errors.append ("%s: unknown field %s" % (name, field))
+            if table.has_key (name):
+                errors.append ("%s: duplicate part" % name)
+            table [name] = part
+
+        # Check the rules for all the variants at once
+        variants = []
+        for name in sorted (table.keys ()):
+            part = table [name]
+            for v in self.variants:
+                if part.has_key (v):
+                    variants.append (("%s %s" % (name, v), part, part [v]))
+
+        pad_fields = set ([x [0] for x in self.pads])
+        for func, message in self.rules:
+            args = func.func_code.co_varnames [:func.func_code.co_argcount]
+            cols = []
+            for x in args:
+                if x in pad_fields:
+                    cols.append ([pads.get (x) for name, part, pads in variants])
+                else:
+                    cols.append ([part.get (x) for name, part, pads in variants])
+            rows = [(i, row) for i, row in enumerate (zip (*cols)) if not (None in row)]
+            bad = Evaluate (func, [row for i, row in rows])
+            for (i, row), b in zip (rows, bad):
+                if b:
+                    name, part, pads = variants [i]
+                    values = part.copy ()
+                    values.update (pads)
+                    errors.append ("%s: %s" % (name, message % values))
+
+        return table, errors
+
+
+    def CacheFile (self, fn):
+        fn = os.path.realpath (fn)
+        return os.path.join (os.path.dirname (fn), ".%s.idx" % os.path.basename (fn))
+
+
+    def Load (self, fn, cache = True):
+        """
+        Load a table from a .csv or .json file. Raises ValueError
+        with all the problems found in the table, if any.
+        """
+        f = open (fn, "rb")
+        text = f.read ()
+        f.close ()
+
+        key = hashlib.sha1 (self.Version () + text).hexdigest ()
+        if cache:
+            try:
+                f = open (self.CacheFile (fn), "rb")
+                magic, version, ckey, table = marshal.load (f)
+                f.close ()
+                if (magic == self.cache_magic) and (version == self.cache_version) \
+                   and (ckey == key):
+                    return table
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+
+        try:
+            if fn.lower ().endswith (".json"):
+                rows = json.loads (text)
+                if not isinstance (rows, dict):
+                    raise ValueError ("not a dictionary of parts")
+                rows = [(_Str (k), v) for k, v in sorted (rows.items ())]
+                for name, x in rows:
+                    if not isinstance (x, dict):
+                        raise ValueError ("%s: not a dictionary" % name)
+                    for k in x.keys ():
+                        if isinstance (x [k], dict):
+                            x [_Str (k)] = dict ([(_Str (a), b) for a, b in x.pop (k).items ()])
+                        else:
+                            x [_Str (k)] = x.pop (k)
+            else:
+                rows = self.ReadCSV (text)
+        except (ValueError, csv.Error), e:
+            raise ValueError ("%s: %s" % (fn, e))
+
+        table, errors = self.Check (rows)
+        if len (errors):
+            raise ValueError ("".join (["\n%s: %s" % (fn, x) for x in errors]) [1:])
+
+        if cache:
+            cfn = self.CacheFile (fn)
+            tfn = "%s.%d" % (cfn, os.getpid ())
+            try:
+                f = open (tfn, "wb")
+                marshal.dump ((self.cache_magic, self.cache_version, key, table), f)
+                f.close ()
+                os.rename (tfn, cfn)
+            except (IOError, OSError):
+                try:
+                    os.unlink (tfn)
+                except OSError:
+                    pass
+
+        return table
+
+
+    def ReadCSV (self, text):
+        """
+        Split CSV text into (name, dictionary) rows.
+        """
+        lines = csv.reader (text.splitlines ())
+        try:
+            header = [x.strip () for x in lines.next ()]
+        except StopIteration:
+            return []
+        if header [:1] != ["Name"]:
+            raise ValueError ("the first column must be \"Name\"")
+
+        columns = [tuple (x.split (".", 1)) if "." in x else (None, x)
+            for x in header [1:]]
+        rows = []
+        for l in lines:
+            if (len (l) == 0) or (l [0].strip () == ""):
+                continue
+            if len (l) > len (header):
+                raise ValueError ("line %d: too many columns" % lines.line_num)
+            x = {}
+            for (variant, field), v in zip (columns, l [1:]):
+                v = v.strip ()
+                if v == "":
+                    continue
+                if variant is None:
+                    x [field] = v
+                else:
+                    x.setdefault (variant, {}) [field] = v
+            rows.append ((l [0].strip (), x))
+        return rows
+
+
+# --- === Generation === --- #
+
+def OptionParser ():
+    """
+    Return the command line parser with the options common
+    to all the generators.
+    """
+    op = optparse.OptionParser (usage = "%prog [options] [TABLE.csv|TABLE.json ...]")
+    op.add_option ("-j", "--jobs", dest="jobs", default=None, type="int",
+        help="Render footprints using N processes", metavar="N")
+    op.add_option ("-f", "--force", dest="force", action="store_true", default=False,
+        help="Regenerate all footprints, even those which did not change")
+    op.add_option ("-d", "--density", dest="density", default="",
+        type="string", action="callback", callback=_DensityOption,
+        help="Also generate the IPC-7351 density LEVELS: any of A (most),"
+            " B (nominal) and C (least), e.g. \"ABC\" or \"most,nominal\"",
+        metavar="LEVELS")
+    op.add_option ("--report", dest="report", default=None, type="string",
+        help="Write a JSON report of the time spent generating every footprint"
+            " to FILE", metavar="FILE")
+    op.add_option ("--profile", dest="profile", default=None, type="string",
+        help="Profile the generator with cProfile and save the statistics"
+            " to FILE", metavar="FILE")
+    return op
+
+
+def _DensityOption (option, opt, value, parser):
+    levels = ""
+    names = dict ([(name.lower (), level) for level, name in ipc_levels])
+    for x in value.replace (",", " ").split ():
+        if names.has_key (x.lower ()):
+            levels += names [x.lower ()]
+        elif len ([c for c in x.upper () if not (c in "ABC")]) == 0:
+            levels += x.upper ()
+        else:
+            raise optparse.OptionValueError ("%s: unknown density level %s" % (opt, x))
+    parser.values.density = levels
+
+
+def LoadTables (schema, fns):
+    """
+    Load the tables given on the command line. Returns a list of tuples
+    (table, library name); the library is named after the table file.
+    Displays all the problems found in the tables and aborts execution
+    if there are any.
+    """
+    start = time.time ()
+    tables = []
+    failed = False
+    for fn in fns:
+        try:
+            tables.append ((schema.Load (fn), os.path.splitext (os.path.basename (fn)) [0]))
+        except (IOError, ValueError), e:
+            for l in str (e).split ("\n"):
+                sys.stderr.write ("ERROR: %s\n" % l)
+            failed = True
+    if failed:
+        sys.exit (-1)
+    Stage ("load", time.time () - start)
+    return tables
+
+
+def _Render (args):
+    # Footprint objects don't cross process boundaries, their text does
+    filename, render, template, job, g = args
+    start = time.time ()
+    key, texts = template (job, g)
+    g.update (texts)
+    if not (key is None):
+        key = (render, key)
+        if not templates.has_key (key):
+            templates [key] = CompileTemplate (render, job, g)
+        t = templates [key]
+        if not (t is None):
+            text = t [0] (g)
+            return (filename (job), text, None, t [1] (g),
+                (0, 0, time.time () - start))
+
+    fn, fp, error = render (job, g)
+    built = time.time ()
+    if fp is None:
+        return (fn, None, error, None, (0, built - start, 0))
+    text = fp.Format ()
+    return (fn, text, error, FootprintBoxes (fp),
+        (0, built - start, time.time () - built))
+
+
+# The footprint templates compiled by this process: (render, key) -> template
+templates = {}
+
+
+def RenderJobs (jobs, rows, filename, render, template, processes = None):
+    """
+    Render footprints, see Generate () for the arguments; rows are
+    the results of the geometry function for the jobs.
+
+    The footprints are rendered by a pool of processes. The footprints
+    the template function gives a key are filled into a template compiled
+    once for every key in every process, which takes a fraction of the
+    time it takes to build and format a footprint model.
+
+    Returns a list of tuples (file name, text, error, bounding boxes,
+    (geometry time, render time, format time)) for every job.
+    """
+    # Compute the geometry of every family of footprints at once
+    geoms = [None] * len (jobs)
+    gtimes = [0] * len (jobs)
+    families = {}
+    for i in xrange (len (jobs)):
+        func, row = rows [i]
+        families.setdefault (func, []).append ((i, row))
+    for func, family in families.items ():
+        # The geometry time is shared by the whole family
+        t = time.time ()
+        vector = Vectorize (func, [x [1] for x in family])
+        t = (time.time () - t) / len (family)
+        for (i, row), geom in zip (family, vector):
+            geoms [i] = geom
+            gtimes [i] = t
+
+    if processes is None:
+        processes = multiprocessing.cpu_count ()
+    processes = min (processes, len (jobs))
+
+    args = [(filename, render, template, jobs [i], geoms [i])
+        for i in xrange (len (jobs))]
+    if processes <= 1:
+        res = [_Render (x) for x in args]
+    else:
+        pool = multiprocessing.Pool (processes)
+        res = pool.map (_Render, args,
+            (len (args) + processes - 1) / processes)
+        pool.close ()
+        pool.join ()
+
+    return [(fn, text, error, boxes, (gtimes [i],) + times [1:])
+        for i, (fn, text, error, boxes, times) in enumerate (res)]
+
+
+# The footprints rendered by this process: footprint hash ->
+# (file name, text, error, bounding boxes, times), see RenderJobs ()
+rendered = {}
+
+# The footprints written by this process, for the test board:
+# file name -> (text, bounding boxes)
+footprints = {}
+
+
+def Generate (what, jobs, filename, geometry, render, template,
+              processes = None, manifest = None):
+    """
+    Generate the footprint files.
+
+    what -- the kind of the footprints, for messages.
+    jobs -- the list of footprints to generate, as tuples
+        (dirmod, dir3d, dim, mod, part, pads).
+    filename -- a function returning the name of the footprint file
+        for a job.
+    geometry -- a function returning the Vectorize () arguments
+        for a job: (function, row). The jobs with the same function
+        make a family, their geometry is computed at once.
+    render -- a function taking a job and its geometry and returning
+        a tuple (file name, Footprint object, error message); the
+        footprint is None if the job can't be rendered.
+    template -- a function taking a job and its geometry and returning
+        a tuple (key, texts). The strings in the texts dictionary (names,
+        descriptions etc) are added to the geometry, so that all the
+        values render uses come from there. Footprints with the same key
+        must be drawn the same way, up to these values: such footprints
+        are not rendered one by one, but filled into a template (see
+        CompileTemplate ()). Hence render may only negate the values and
+        pass them on to the footprint model helpers. The key is None for
+        the jobs which have to be rendered.
+    processes -- the number of processes rendering the footprints
+        (default is number of CPUs).
+    manifest -- if given, the footprints are rendered only if the hash
+        of their table data and of the generator code differs from
+        the one recorded in the manifest, or if the file is missing.
+        The manifest is updated with the hashes of the written footprints,
+        and the footprints of the same libraries which are not among
+        the jobs any more are removed from it.
+
+    Since the jobs are just data and rendering has no side effects,
+    the rendered footprints are remembered by their hash, so calling
+    Generate () again in the same process doesn't render them again.
+
+    The time spent on every written footprint is added to the report.
+
+    Returns the number of written footprints.
+    """
+    start = time.time ()
+    rows = [geometry (job) for job in jobs]
+    funcs = sorted (set ([func for func, row in rows]), key = lambda x: x.__name__)
+    version = CodeVersion (*([filename, geometry, render, template] + funcs +
+        list (model_code)))
+    keys = [hashlib.sha1 (version + Canonical (job)).hexdigest () for job in jobs]
+
+    if not (manifest is None):
+        # Forget the footprints which are not generated any more: those
+        # in the same libraries as the jobs, and those which are gone
+        current = set ([filename (job) for job in jobs])
+        dirs = set ([os.path.dirname (fn) for fn in current])
+        for fn in manifest.keys ():
+            if fn.endswith (".kicad_mod") and not (fn in current) and \
+               ((os.path.dirname (fn) in dirs) or not os.path.exists (fn)):
+                del manifest [fn]
+
+        todo = []
+        for job, row, key in zip (jobs, rows, keys):
+            fn = filename (job)
+            if (manifest.get (fn) != key) or not os.path.exists (fn):
+                manifest.pop (fn, None)
+                todo.append ((job, row, key))
+        if len (todo) < len (jobs):
+            print ("%d %s footprints are up to date" % (len (jobs) - len (todo), what))
+            report ["totals"]["up_to_date"] += len (jobs) - len (todo)
+        jobs = [x [0] for x in todo]
+        rows = [x [1] for x in todo]
+        keys = [x [2] for x in todo]
+
+    missing = [i for i in xrange (len (jobs)) if not rendered.has_key (keys [i])]
+    results = RenderJobs ([jobs [i] for i in missing], [rows [i] for i in missing],
+        filename, render, template, processes)
+    for i, res in zip (missing, results):
+        rendered [keys [i]] = res
+
+    written = 0
+    totals = report ["totals"]
+    for key in keys:
+        fn, text, error, boxes, times = rendered [key]
+        name = os.path.splitext (os.path.basename (fn)) [0]
+        print ("Generating %s %s" % (what, name))
+        if text is None:
+            print (error)
+            totals ["errors"] += 1
+            continue
+
+        t = time.time ()
+        f = open (fn, "w")
+        f.write (text)
+        f.close ()
+        t = time.time () - t
+        written += 1
+        footprints [os.path.normpath (fn)] = (text, boxes)
+
+        item = {"name": name, "file": fn, "geometry": times [0],
+            "render": times [1], "serialize": times [2], "write": t,
+            "bytes": len (text)}
+        report ["footprints"].append (item)
+        for x in ("geometry", "render", "serialize", "write", "bytes"):
+            totals [x] += item [x]
+        totals ["footprints"] += 1
+
+        if not (manifest is None):
+            manifest [fn] = key
+
+    Stage ("generate", time.time () - start)
+    return written
+
+
+# --- === Test board === --- #
+
+def LibraryFootprints (dn):
+    """
+    Return the list of (file name, text, bounding boxes) of all footprints
+    in a .pretty directory, sorted by name; see FootprintBoxes (). The
+    footprints written by Generate () are taken from memory, the others
+    are read from disk.
+    """
+    try:
+        names = [x for x in os.listdir (dn) if x.endswith (".kicad_mod")]
+    except OSError:
+        return []
+    names.sort ()
+
+    mods = []
+    for name in names:
+        modfn = os.path.join (dn, name)
+        text, boxes = footprints.get (os.path.normpath (modfn), (None, None))
+        if text is None:
+            f = open (modfn, "r")
+            text = f.read ()
+            f.close ()
+            fp = kicad.Footprint ()
+            try:
+                fp.Parse (text)
+                boxes = FootprintBoxes (fp)
+            except ValueError:
+                pass
+        if (boxes is None) or (boxes [0] is None):
+            boxes = ((0, 0, 0, 0), (0, 0, 0, 0))
+        mods.append ((modfn, text, boxes))
+    return mods
+
+
+def PlaceModule (text, cx, cy):
+    """
+    Return the footprint text placed at the given position on a board.
+    """
+    i = text.find ("\n") + 1
+    return "%s  (at %s %s)\n%s" % (text [:i],
+        kicad.FormatNumber (cx), kicad.FormatNumber (cy), text [i:])
+
+
+def ShelfPack (sizes, gap):
+    """
+    Pack rectangles of the given (width, height) sizes into shelves:
+    the rectangles are sorted by decreasing height and put left to right
+    on a shelf until it is full, then a new shelf is started below.
+    The shelf width is chosen to make the result roughly square.
+    Returns the list of the (x, y) top left corners of the rectangles,
+    and the (width, height) of the whole pack.
+    """
+    if not len (sizes):
+        return [], (0, 0)
+    area = sum ([(w + gap) * (h + gap) for w, h in sizes])
+    width = max (max ([w for w, h in sizes]), math.sqrt (area))
+
+    order = sorted (xrange (len (sizes)), key = lambda i: -sizes [i][1])
+    pos = [None] * len (sizes)
+    x = y = 0
+    shelf = 0
+    packw = 0
+    for i in order:
+        w, h = sizes [i]
+        if (x > 0) and (x + w > width):
+            # Start a new shelf
+            y += shelf + gap
+            x = shelf = 0
+        pos [i] = (x, y)
+        packw = max (packw, x + w)
+        x += w + gap
+        shelf = max (shelf, h)
+    return pos, (packw, y + shelf)
+
+
+# The kinds of footprints, in the order they are placed in a group
+board_columns = (("_Reflow.", "Reflow", 0), ("_Flow.", "Flow", 1),
+    ("_Wave.", "Wave", 1), ("_Hand.", "Hand", 2),
+    ("_Most.", "Most", 3), ("_Nominal.", "Nominal", 4), ("_Least.", "Least", 5))
+
+
+def GenerateTestBoard (ifn, ofn, others = False, gap = 1, spacing = 2):
+    """
+    Generate the test board from a template. Every line of the template
+    starting with '@' is replaced by all the footprints of the .pretty
+    library whose name follows the '@'.
+
+    The variants of a part (Reflow, then Flow or Wave, then Hand, and
+    the IPC-7351 density levels if there are any) are put in a row with
+    their courtyards gap mm apart. These groups are then packed onto
+    the board with ShelfPack (), spacing mm apart, which leaves room for
+    the reference texts above the courtyards. If others is true,
+    footprints of other kinds are placed alone, otherwise they are
+    skipped.
+
+    The board is built in memory and written at once, with the number
+    of modules and the area they cover filled into the general section.
+    """
+    iff = file (ifn, "r")
+    lines = iff.readlines ()
+    iff.close ()
+
+    # Make the groups of footprint variants: [(name, [(col, mod)...])...]
+    groups = []
+    names = {}
+    for l in lines:
+        if l [0] == '@':
+            # Special mark where the content of a pretty lib should be inserted
+            for mod in LibraryFootprints (l.strip () [1:]):
+                modfn = mod [0]
+                for tag, kind, col in board_columns:
+                    if modfn.find (tag) >= 0:
+                        compn = modfn.replace (kind, "")
+                        break
+                else:
+                    if not others:
+                        # Don't know what is this, ignore
+                        continue
+                    col = 0
+                    compn = modfn
+                if not names.has_key (compn):
+                    names [compn] = len (groups)
+                    groups.append ((compn, []))
+                groups [names [compn]][1].append ((col, mod))
+
+    # Put the variants in a row, aligning the tops of the courtyards
+    sizes = []
+    for compn, mods in groups:
+        mods.sort (key = lambda x: x [0])
+        w = h = 0
+        for col, (modfn, text, boxes) in mods:
+            x1, y1, x2, y2 = boxes [1]
+            w += x2 - x1 + gap
+            h = max (h, y2 - y1)
+        sizes.append ((w - gap, h))
+
+    pos, size = ShelfPack (sizes, spacing)
+
+    placed = []
+    area = None
+    for (compn, mods), (x, y) in zip (groups, pos):
+        x += 20
+        y += 20
+        for col, (modfn, text, boxes) in mods:
+            x1, y1, x2, y2 = boxes [1]
+            cx = round (x - x1, 3)
+            cy = round (y - y1, 3)
+            x += x2 - x1 + gap
+            placed.append ((modfn, PlaceModule (text, cx, cy)))
+
+            b = boxes [0]
+            b = (cx + b [0], cy + b [1], cx + b [2], cy + b [3])
+            if area is None:
+                area = b
+            else:
+                area = (min (area [0], b [0]), min (area [1], b [1]),
+                    max (area [2], b [2]), max (area [3], b [3]))
+    placed.sort ()
+
+    out = []
+    general = {}
+    section = None
+    for l in lines:
+        if l [0] == '@':
+            # The footprints are written in library order
+            lib = l.strip () [1:]
+            out.extend ([text for modfn, text in placed
+                if os.path.dirname (modfn) == lib])
+        else:
+            # Remember where the general section counters are
+            w = l.split ()
+            if w [:1] == ["(general"]:
+                section = "general"
+            elif w [:1] == [")"]:
+                section = None
+            elif (section == "general") and (w [:1] in (["(modules"], ["(area"])):
+                general [w [0][1:]] = (len (out), l [:len (l) - len (l.lstrip ())])
+            out.append (l)
+
+    if general.has_key ("modules"):
+        i, indent = general ["modules"]
+        out [i] = "%s(modules %d)\n" % (indent, len (placed))
+    if general.has_key ("area") and not (area is None):
+        i, indent = general ["area"]
+        out [i] = "%s(area %s)\n" % (indent,
+            " ".join ([kicad.FormatNumber (round (x, 3)) for x in area]))
+
+    out = "".join (out)
+    off = file (ofn, "w")
+    off.write (out)
+    off.close ()
+    report ["totals"]["board_bytes"] += len (out)
+
+
+def UpdateTestBoard (ifn, ofn, manifest, changed, others = False):
+    """
+    Generate the test board with GenerateTestBoard () if any footprint
+    was written, or if the template or the board code changed.
+    """
+    key = hashlib.sha1 (CodeVersion (LibraryFootprints, _BoxTerms, _TermValue,
+        FootprintBox, FootprintBoxes, PlaceModule, ShelfPack, GenerateTestBoard) +
+        Canonical ((board_columns, others)) +
+        file (ifn, "r").read ()).hexdigest ()
+    if changed or (manifest.get (ofn) != key) or not os.path.exists (ofn):
+        start = time.time ()
+        GenerateTestBoard (ifn, ofn, others)
+        Stage ("board", time.time () - start)
+        manifest [ofn] = key
+
+
+# --- === Instrumentation === --- #
+
+# The report of the current run, written by Main () as JSON:
+#   stages -- seconds spent loading tables, generating footprints, building
+#       the test board and in total.
+#   footprints -- a list with the seconds spent computing the geometry,
+#       rendering the footprint model, serializing and writing it, and
+#       the size of the file for every written footprint.
+#   totals -- the sums of the above, the number of written, up to date
+#       and failed footprints, and the size of the test board.
+report = {
+    "stages": {},
+    "footprints": [],
+    "totals": {
+        "footprints": 0, "up_to_date": 0, "errors": 0,
+        "geometry": 0, "render": 0, "serialize": 0, "write": 0,
+        "bytes": 0, "board_bytes": 0,
+    },
+}
+
+
+def Stage (name, t):
+    """
+    Add the time spent in a stage of the generator to the report.
+    """
+    stages = report ["stages"]
+    stages [name] = stages.get (name, 0) + t
+
+
+def SaveReport (fn):
+    """
+    Write the report as JSON.
+    """
+    report ["generator"] = os.path.basename (sys.argv [0])
+    report ["argv"] = sys.argv [1:]
+    report ["numpy"] = not (numpy is None)
+    f = open (fn, "w")
+    json.dump (report, f, indent = 1, sort_keys = True)
+    f.write ("\n")
+    f.close ()
+
+
+def Main (main):
+    """
+    Parse the command line and run the generator: main (options, args).
+    Writes the report if --report is given. With --profile the generator
+    runs under cProfile and the statistics are saved for pstats; only
+    the main process is profiled, so use it with -j 1.
+    """
+    (options, args) = OptionParser ().parse_args ()
+
+    start = time.time ()
+    if options.profile:
+        prof = cProfile.Profile ()
+        prof.runcall (main, options, args)
+        prof.dump_stats (options.profile)
+    else:
+        main (options, args)
+    Stage ("total", time.time () - start)
+
+    if options.report:
+        SaveReport (options.report)
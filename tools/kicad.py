@@ -6,8 +6,403 @@ This library provides a set of classes to deal with KiCad files.
 import sys
 import re
 import time
+import mmap
+import struct
+import tempfile
+import multiprocessing
+import threading
+import hashlib
+import marshal
 import os, os.path
 
+# The size of the I/O buffers used when streaming through large libraries
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+# Use the on-disk index caches by default when loading libraries. They are
+# kept as hidden files next to the libraries, so this is off unless asked for
+INDEX_CACHE = False
+
+
+def SplitLines (s):
+    """
+    Split a string into a list of lines, exactly like file.readlines () does.
+    """
+    lines = s.split ("\n")
+    last = lines.pop ()
+    lines = [l + "\n" for l in lines]
+    if last:
+        lines.append (last)
+    return lines
+
+
+class LineTokenizer:
+    """
+    A prefix-dispatch tokenizer for the lines outside of blocks in legacy
+    library files. Lines are dispatched on their first byte to the short
+    list of keywords starting with that byte, which are then compared as
+    plain string prefixes, so the regular expression engine is not involved.
+    """
+
+    def __init__(self, keywords):
+        """
+        keywords -- a sequence of line keywords. Keywords ending with
+            a space must be followed by an argument word.
+        """
+        self.dispatch = {}
+        for kw in keywords:
+            self.dispatch.setdefault (kw [0], []).append (
+                (kw, len (kw), kw.rstrip (" "), kw.endswith (" ")))
+        # Check longer keywords first
+        for x in self.dispatch.values ():
+            x.sort (key = lambda k: k [1], reverse = True)
+
+
+    def Match (self, l):
+        """
+        Find the keyword at the start of the line.
+        Returns a tuple (keyword, argument), where argument is the first word
+        after the keyword for keywords that need it, or the rest of the line.
+        If no keyword matches, returns (None, None).
+        """
+        for prefix, n, kw, needarg in self.dispatch.get (l [:1], ()):
+            if l [:n] == prefix:
+                if not needarg:
+                    return (kw, l [n:])
+                arg = l.split (None, 2)
+                if len (arg) > 1:
+                    return (kw, arg [1])
+        return (None, None)
+
+
+    def Encoding (self, rest):
+        """
+        Parse the rest of a comment line. Returns the encoding name
+        if this is a "# encoding NAME" line, or None.
+        """
+        rest = rest.lstrip (" ")
+        if rest.startswith ("encoding"):
+            rest = rest [8:].lstrip (" ").rstrip ()
+            if rest:
+                return rest.split (" ", 1) [0]
+        return None
+
+
+class MappedFile:
+    """
+    A read-only memory map of a library file.
+    Lazily loaded components keep a reference to this object and
+    read their content from it when it is first needed.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        # The file stays open for Copy (), even if it is replaced meanwhile
+        self.f = open (fn, "rb")
+        st = os.fstat (self.f.fileno ())
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        if self.size > 0:
+            self.data = mmap.mmap (self.f.fileno (), 0, access = mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+
+    def Read (self, offset, length):
+        return self.data [offset:offset + length]
+
+
+    def Copy (self, f, offset, length):
+        """
+        Write a byte range of the file to another file in chunks of
+        STREAM_BUFFER_SIZE bytes. The range is read from the file rather
+        than from the memory map, since every page of the map that is
+        touched stays in the memory of the process.
+        """
+        self.f.seek (offset)
+        while length > 0:
+            data = self.f.read (min (length, STREAM_BUFFER_SIZE))
+            if not data:
+                break
+            f.write (data)
+            length -= len (data)
+
+
+class AtomicFile:
+    """
+    A file which is written in place of an existing file without ever
+    leaving a truncated or half-written file behind. The data is written
+    through a large buffer to a temporary file in the same directory,
+    which on Commit () is flushed to disk and atomically renamed to the
+    destination file name. The old file is kept as a backup copy with
+    a '~' appended to its name.
+    """
+
+    def __init__(self, fn, backup = True):
+        self.fn = fn
+        self.backup = backup
+        fd, self.tfn = tempfile.mkstemp (prefix = ".%s." % os.path.basename (fn),
+            dir = os.path.dirname (fn) or ".")
+        self.f = os.fdopen (fd, "w", STREAM_BUFFER_SIZE)
+        self.write = self.f.write
+        self.writelines = self.f.writelines
+
+
+    def Commit (self):
+        """
+        Flush the data to disk and replace the destination file.
+        """
+        self.f.flush ()
+        os.fsync (self.f.fileno ())
+
+        if os.path.exists (self.fn):
+            mode = os.stat (self.fn).st_mode & 07777
+        else:
+            mode = os.umask (0)
+            os.umask (mode)
+            mode = 0666 & ~mode
+        os.fchmod (self.f.fileno (), mode)
+        self.f.close ()
+
+        if self.backup and os.path.exists (self.fn):
+            bfn = self.fn + "~"
+            if os.path.exists (bfn):
+                os.unlink (bfn)
+            try:
+                # Keep the old file in place until it is replaced
+                os.link (self.fn, bfn)
+            except OSError:
+                os.rename (self.fn, bfn)
+
+        os.rename (self.tfn, self.fn)
+
+        # Make the rename itself durable
+        try:
+            fd = os.open (os.path.dirname (self.fn) or ".", os.O_RDONLY)
+            os.fsync (fd)
+            os.close (fd)
+        except OSError:
+            pass
+
+
+    def Abort (self):
+        """
+        Drop the data written so far, leaving the destination file intact.
+        """
+        self.f.close ()
+        os.unlink (self.tfn)
+
+
+class RangeWriter:
+    """
+    This class is used to write a sequence of components to a file.
+    Unchanged components are written as byte ranges of the files they
+    were loaded from. Adjacent ranges of the same file are merged, so
+    that long runs of unchanged components are copied in one go (see
+    MappedFile.Copy ()), and strings which are identical to the bytes following the current range
+    in the source file (like the separators between components) are
+    merged into the range too.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.source = None
+        self.start = self.end = 0
+
+
+    def Write (self, s):
+        if not (self.source is None):
+            if self.source.Read (self.end, len (s)) == s:
+                self.end += len (s)
+                return
+            self.Flush ()
+        self.f.write (s)
+
+
+    def Copy (self, source, offset, length):
+        if (source is self.source) and (offset == self.end):
+            self.end += length
+            return
+
+        self.Flush ()
+        self.source = source
+        self.start = offset
+        self.end = offset + length
+
+
+    def Flush (self):
+        if self.source is None:
+            return
+
+        self.source.Copy (self.f, self.start, self.end - self.start)
+        self.source = None
+
+
+class MemoryFile:
+    """
+    An in-memory replacement for MappedFile. It is used to hold the content
+    of components which were passed from another process.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+    def Read (self, offset, length):
+        return self.data [offset:offset + length]
+
+
+    def Copy (self, f, offset, length):
+        f.write (self.data [offset:offset + length])
+
+
+class LibraryIndex:
+    """
+    A sidecar index cache of a library file. It holds the name, offset and
+    length of every block in the file, plus the library header fields,
+    and is valid as long as the path, modification time and size of the
+    library file stay the same. The index for "dir/name.mod" is kept
+    in the file "dir/.name.mod.idx".
+
+    The index is stored in a compact binary format (all integers are
+    little-endian):
+
+        magic "KCIX", version (u16)
+        library mtime (double), size (u64), path length (u32), path
+        field count (u8), then for every field:
+            name length (u8), name, value length (u32), value
+        block count (u32), names length (u32), names joined with '\\n',
+        block offsets (u64 * count), block lengths (u64 * count)
+
+    The same format is used to pass indexes between processes, since
+    pickling a long list of tuples is much slower.
+    """
+
+    magic = "KCIX"
+    version = 1
+
+    def __init__(self, fn, fields = None, blocks = None, mtime = None, size = None):
+        self.fn = os.path.realpath (fn)
+        self.fields = fields or {}
+        self.blocks = blocks or []
+        self.mtime = mtime
+        self.size = size
+
+
+    def IndexFile (self):
+        return os.path.join (os.path.dirname (self.fn),
+            ".%s.idx" % os.path.basename (self.fn))
+
+
+    def Valid (self, mtime, size):
+        """
+        Check if the index describes the given version of the library file.
+        """
+        return (self.mtime == mtime) and (self.size == size)
+
+
+    def Pack (self):
+        """
+        Return the index in its binary format.
+        """
+        data = [struct.pack ("<4sHdQI", self.magic, self.version,
+            self.mtime, self.size, len (self.fn)), self.fn]
+
+        data.append (chr (len (self.fields)))
+        for name, value in self.fields.items ():
+            data.extend ([chr (len (name)), name,
+                struct.pack ("<I", len (value)), value])
+
+        names = "\n".join (b [0] for b in self.blocks)
+        data.extend ([struct.pack ("<II", len (self.blocks), len (names)), names,
+            struct.pack ("<%dQ" % len (self.blocks), *[b [1] for b in self.blocks]),
+            struct.pack ("<%dQ" % len (self.blocks), *[b [2] for b in self.blocks])])
+        return "".join (data)
+
+
+    def Unpack (self, data):
+        """
+        Set the index from its binary format.
+        Returns False if the data is not a valid index of the same file.
+        """
+        try:
+            magic, version, mtime, size, plen = struct.unpack_from ("<4sHdQI", data)
+            if (magic != self.magic) or (version != self.version):
+                return False
+            pos = struct.calcsize ("<4sHdQI")
+            if data [pos:pos + plen] != self.fn:
+                return False
+            pos += plen
+
+            fields = {}
+            count = ord (data [pos])
+            pos += 1
+            for i in range (count):
+                nlen = ord (data [pos])
+                name = data [pos + 1:pos + 1 + nlen]
+                pos += 1 + nlen
+                vlen, = struct.unpack_from ("<I", data, pos)
+                fields [name] = data [pos + 4:pos + 4 + vlen]
+                pos += 4 + vlen
+
+            count, nlen = struct.unpack_from ("<II", data, pos)
+            pos += 8
+            names = data [pos:pos + nlen].split ("\n") if count else []
+            pos += nlen
+            offsets = struct.unpack_from ("<%dQ" % count, data, pos)
+            pos += 8 * count
+            lengths = struct.unpack_from ("<%dQ" % count, data, pos)
+        except (struct.error, IndexError):
+            return False
+
+        self.mtime, self.size = mtime, size
+        self.fields = fields
+        self.blocks = zip (names, offsets, lengths)
+        return True
+
+
+    def __getstate__ (self):
+        return self.Pack ()
+
+
+    def __setstate__ (self, data):
+        head = struct.calcsize ("<4sHdQI")
+        plen = struct.unpack_from ("<4sHdQI", data) [4]
+        self.fn = data [head:head + plen]
+        self.Unpack (data)
+
+
+    def Load (self, mtime, size):
+        """
+        Load the index from disk.
+        Returns False if there's no index, or if it is stale.
+        """
+        try:
+            f = open (self.IndexFile (), "rb")
+            data = f.read ()
+            f.close ()
+        except (IOError, OSError):
+            return False
+
+        return self.Unpack (data) and self.Valid (mtime, size)
+
+
+    def Save (self):
+        """
+        Write the index to disk. Errors are silently ignored,
+        since the index is just a cache.
+        """
+        ifn = self.IndexFile ()
+        tfn = "%s.%d" % (ifn, os.getpid ())
+        try:
+            f = open (tfn, "wb")
+            f.write (self.Pack ())
+            f.close ()
+            os.rename (tfn, ifn)
+        except (IOError, OSError):
+            if os.path.exists (tfn):
+                os.unlink (tfn)
+
+
 class KiCadLibrary:
     """
     Common ancestors for all library classes.
@@ -17,6 +412,10 @@ class KiCadLibrary:
         self.name = None
         self.path = ""
         self.components = {}
+        # If not None, the LibraryIndex objects of the library files by
+        # their real path: ScanIndexed () uses those which are valid and
+        # adds the ones it builds (see LoadLibraries ())
+        self.indexes = None
 
 
     def Fail (self, msg):
@@ -44,6 +443,24 @@ class KiCadLibrary:
             self.components [name] = c
 
 
+    def WriteFile (self, fn, write, *args):
+        """
+        Safely replace a library file, using an AtomicFile.
+        The old file is kept with a '~' appended to its name.
+
+        write -- a function called as write (f, *args) to write the file.
+        """
+        f = AtomicFile (fn)
+        try:
+            write (f, *args)
+        except:
+            f.Abort ()
+            raise
+        f.Commit ()
+
+        return True
+
+
     def CheckBackup (self, fn):
         if os.path.exists (fn):
             bfn = fn + "~"
@@ -52,20 +469,257 @@ class KiCadLibrary:
             os.rename (fn, bfn)
 
 
-class PCBNewComponent:
+    def ScanIndexed (self, fn, parse, unfinished, fields, cache = None):
+        """
+        Memory map a library file and find all blocks in it with ScanMapped.
+        If cache is True (by default, if INDEX_CACHE is True), the block list
+        and the header fields set while parsing the file are taken from the
+        on-disk index when it is valid. Otherwise the index is rebuilt.
+        The indexes in self.indexes, if any, are used before the on-disk one.
+
+        fields -- the names of the object fields set by parse.
+
+        Returns a tuple (MappedFile, list of (name, offset, length) tuples).
+        """
+        if cache is None:
+            cache = INDEX_CACHE
+
+        mf = MappedFile (fn)
+        idx = LibraryIndex (fn)
+        if not (self.indexes is None) and self.indexes.has_key (idx.fn):
+            idx = self.indexes [idx.fn]
+            if not idx.Valid (mf.mtime, mf.size):
+                idx = LibraryIndex (fn)
+        if idx.Valid (mf.mtime, mf.size) or (cache and idx.Load (mf.mtime, mf.size)):
+            for name, value in idx.fields.items ():
+                setattr (self, name, value)
+            return (mf, idx.blocks)
+
+        # Record only the fields that are set by this file
+        saved = {}
+        for name in fields:
+            saved [name] = getattr (self, name)
+            setattr (self, name, None)
+
+        blocks = list (self.ScanMapped (mf, parse, unfinished))
+
+        values = {}
+        for name in fields:
+            value = getattr (self, name)
+            if value is None:
+                setattr (self, name, saved [name])
+            else:
+                values [name] = value
+
+        idx = LibraryIndex (fn, values, blocks, mf.mtime, mf.size)
+        if cache:
+            idx.Save ()
+        if not (self.indexes is None):
+            self.indexes [idx.fn] = idx
+
+        return (mf, blocks)
+
+
+    def ScanLines (self, f, parse, unfinished):
+        """
+        Split a library file into blocks of lines.
+
+        f -- an open library file.
+        parse -- a function which is called for every line outside of
+            a block. It returns None for lines that do not start a block,
+            or a tuple (name, endtag) otherwise. Blocks with a name of None
+            are skipped.
+        unfinished -- error message format for a block without an end tag.
+
+        Yields a tuple (name, lines) for every named block.
+        """
+        it = iter (f)
+        for l in it:
+            blk = parse (l)
+            if blk is None:
+                continue
+
+            name, end = blk
+            if name is None:
+                for l in it:
+                    if l.startswith (end):
+                        break
+                else:
+                    self.Fail (unfinished % name)
+                continue
+
+            lines = [l]
+            append = lines.append
+            for l in it:
+                append (l)
+                if l.startswith (end):
+                    break
+            else:
+                self.Fail (unfinished % name)
+
+            yield (name, lines)
+
+
+    def ScanMapped (self, mf, parse, unfinished):
+        """
+        Same as ScanLines, but instead of returning the lines of every
+        block it finds just the block boundaries in a memory mapped file.
+        Only the lines outside of blocks (library headers and the first
+        lines of blocks) go through parse and its tokenizer; the end of
+        a block is found with a single string search, so the lines inside
+        blocks are never looked at by the Python code.
+
+        mf -- a MappedFile object.
+
+        Yields a tuple (name, offset, length) for every named block.
+        """
+        data = mf.data
+        find = data.find
+        pos = 0
+        end = len (data)
+        while pos < end:
+            eol = find ("\n", pos, end)
+            eol = end if eol < 0 else eol + 1
+
+            blk = parse (data [pos:eol])
+            if blk is None:
+                pos = eol
+                continue
+
+            name, tag = blk
+            tail = find ("\n" + tag, eol - 1, end)
+            if tail < 0:
+                self.Fail (unfinished % name)
+
+            tail = find ("\n", tail + 1, end)
+            tail = end if tail < 0 else tail + 1
+            if not (name is None):
+                yield (name, pos, tail - pos)
+            pos = tail
+
+
+class Component (object):
+    """
+    The common part of library components. The component text is kept
+    as a single string (body), or as a byte range of a MappedFile for
+    components which were not read into memory yet. The list of lines
+    (content) is only built when it is asked for, since a list of short
+    strings takes several times more memory than the text itself.
+    """
+    __slots__ = ("name", "source", "offset", "length", "body", "lines", "dirty")
 
-    def __init__(self, name):
+    def __init__(self, name, source = None, offset = 0, length = 0, body = None):
+        """
+        Create a new component. If source is not None, the component
+        content is lazily loaded from the given MappedFile when needed.
+        Otherwise body is the component text, if known.
+
+        A component is dirty if its content may differ from its source.
+        Clean components are saved by copying their source bytes as is.
+        Since the list of lines (content) may be modified in place, once
+        it was asked for the component is saved from it as if it was dirty.
+        """
         self.name = name
-        self.content = []
-        self.doc = []
+        self.source = source
+        self.offset = offset
+        self.length = length
+        self.body = body
+        self.lines = None
+        self.dirty = source is None
+        if (source is None) and (body is None):
+            self.body = ""
+
+
+    def GetContent (self):
+        if self.lines is None:
+            self.lines = SplitLines (self.Body ())
+            # From now on the list of lines holds the content
+            self.body = None
+        return self.lines
+
+
+    def SetContent (self, lines):
+        self.lines = lines
+        self.body = None
+        self.dirty = True
+
+
+    content = property (GetContent, SetContent)
+
+
+    def Body (self):
+        """
+        Return the component text as a single string.
+        """
+        if not (self.lines is None):
+            return "".join (self.lines)
+        if not (self.body is None):
+            return self.body
+        return self.source.Read (self.offset, self.length)
+
+
+    def Fetch (self):
+        """
+        Read the component text into memory.
+        """
+        if (self.lines is None) and (self.body is None):
+            self.body = self.source.Read (self.offset, self.length)
+
+
+    def __getstate__ (self):
+        # Memory maps can't be pickled, and pickling long lists of short
+        # strings is slow, so pass the whole content as a single string
+        return (self.name, self.Body ())
+
+
+    def __setstate__ (self, state):
+        self.name, self.body = state
+        self.source = MemoryFile (self.body)
+        self.offset = 0
+        self.length = len (self.body)
+        self.lines = None
+        self.dirty = False
+
+
+    def Touch (self):
+        self.content
+        self.dirty = True
 
 
     def Append (self, l):
         self.content.append (l)
+        self.dirty = True
+
+
+    def IsDirty (self):
+        """
+        Check if the component must be written from its content rather
+        than copied from its source.
+        """
+        return self.dirty or not (self.lines is None)
+
+
+    def Write (self, w):
+        """
+        Write the component to a RangeWriter.
+        """
+        if self.IsDirty ():
+            w.Write (self.Body ())
+        else:
+            w.Copy (self.source, self.offset, self.length)
 
 
     def Save (self, f):
-        f.writelines (self.content)
+        w = RangeWriter (f)
+        self.Write (w)
+        w.Flush ()
+
+
+class PCBNewComponent (Component):
+    """
+    A module of a PCBNew library.
+    """
+    __slots__ = ()
 
 
 class PCBNewLibrary (KiCadLibrary):
@@ -75,6 +729,9 @@ class PCBNewLibrary (KiCadLibrary):
     """
     type = "PCBNew"
 
+    tokens = LineTokenizer (("PCBNEW-LibModule", "$INDEX", "$EndLIBRARY",
+        "$MODULE ", "#", "Units "))
+
 
     def __init__(self):
         KiCadLibrary.__init__ (self);
@@ -83,74 +740,109 @@ class PCBNewLibrary (KiCadLibrary):
         self.units = None
 
 
-    def Load (self, fn):
+    def Load (self, fn, lazy = False, cache = None):
         """
         Load a .MOD library.
 
         fn -- the full path to the library file.
+        lazy -- if True, only the module names and their locations in the
+            file are recorded at load time. Module bodies are read from a
+            memory map of the file when they are first accessed.
+        cache -- use the on-disk library index (see LibraryIndex) to skip
+            parsing the library if it did not change since last time.
+            By default this is controlled by the INDEX_CACHE variable.
         """
+        if cache is None:
+            cache = INDEX_CACHE
+
+        if not (lazy or cache):
+            for comp in self.Stream (fn):
+                self.components [comp.name] = comp
+            return True
+
         self.name = os.path.basename (fn)
         self.path = os.path.dirname (fn)
 
-        f = file (fn, "r")
+        mf, blocks = self.ScanIndexed (fn, self.ParseLine,
+            "unfinished component \"%s\"",
+            ("headline", "encoding", "units"), cache)
+        for name, offset, length in blocks:
+            comp = PCBNewComponent (name, mf, offset, length)
+            if not lazy:
+                comp.Fetch ()
+            self.components [name] = comp
 
-        s0re = re.compile (r"^(PCBNEW-LibModule|\$INDEX|\$EndLIBRARY|\$MODULE +([^ ]+)|# *encoding *([^ ]+)|#|Units +([^ ]+)).*")
-
-        state = 0
-        for l in f.readlines ():
-            if state == 0:
-                sl = l.rstrip ()
-                mr = s0re.match (sl)
-                if mr is None:
-                    return self.Fail ("unexpected input line:\n	%s" % sl)
-
-                g = mr.groups ()
-                if g [0][0] == '#':
-                    # encoding ?
-                    if not (g [2] is None):
-                        self.encoding = g [2]
-                    # ignore comments
-                elif g [0] == "PCBNEW-LibModule":
-                    self.headline = l
-                elif g [0].startswith ("Units"):
-                    self.units = g [3]
-                elif g [0].startswith ("$INDEX"):
-                    state = 2
-                    # skip the index
-                elif g [0].startswith ("$EndLIBRARY"):
-                    pass
-                    # ignore this directive
-                elif g [0].startswith ("$MODULE"):
-                    state = 1
-                    comp = PCBNewComponent (g [1])
-                    comp.Append (l)
-
-            elif state == 1:
-                comp.Append (l)
-                if l.startswith ("$EndMODULE"):
-                    state = 0
-                    self.components [comp.name] = comp
-                    comp = None
-
-            elif state == 2:
-                if l.startswith ("$EndINDEX"):
-                    state = 0
-
-        if comp != None:
-            return self.Fail ("unfinished component \"%s\"" % comp.name)
+        return True
+
+
+    def Stream (self, fn):
+        """
+        Iterate over the modules of a .MOD library in a single pass,
+        without keeping the whole file in memory. The file is read through
+        a large buffer, and every module is yielded as a PCBNewComponent
+        as soon as its $EndMODULE line is seen, so the memory usage is
+        bounded by the largest module rather than by the library size.
+        Library header fields (headline, encoding, units) are stored into
+        the object as they are encountered.
+
+        fn -- the full path to the library file.
+        """
+        self.name = os.path.basename (fn)
+        self.path = os.path.dirname (fn)
+
+        f = open (fn, "r", STREAM_BUFFER_SIZE)
+
+        for name, lines in self.ScanLines (f, self.ParseLine,
+            "unfinished component \"%s\""):
+            yield PCBNewComponent (name, body = "".join (lines))
 
         f.close ()
-        return True
+
+
+    def ParseLine (self, l):
+        """
+        Parse a library line outside of a module.
+        Header fields are stored into the object.
+        """
+        kw, arg = self.tokens.Match (l)
+        if kw == "$MODULE":
+            return (arg, "$EndMODULE")
+        elif kw == "#":
+            # encoding ?
+            if "encoding" in arg:
+                enc = self.tokens.Encoding (arg)
+                if not (enc is None):
+                    self.encoding = enc
+            # ignore comments
+            return None
+        elif kw == "$INDEX":
+            # skip the index
+            return (None, "$EndINDEX")
+        elif kw == "$EndLIBRARY":
+            # ignore this directive
+            return None
+        elif kw == "PCBNEW-LibModule":
+            self.headline = l
+            return None
+        elif kw == "Units":
+            self.units = arg
+            return None
+
+        self.Fail ("unexpected input line:\n	%s" % l.rstrip ())
 
 
     def Save (self, fn):
         """
         Save a PCBNew library to a file.
-        The old file will be overwritten.
+        The old file will be replaced atomically.
         """
-        self.CheckBackup (fn)
+        return self.WriteFile (fn, self.Write)
 
-        f = file (fn, "w")
+
+    def Write (self, f):
+        """
+        Write the library to an open file.
+        """
         if self.headline is None:
             f.write ("PCBNEW-LibModule-V1  %s\n" % time.strftime ("%c"))
         else:
@@ -171,40 +863,133 @@ class PCBNewLibrary (KiCadLibrary):
         f.writelines ("%s\n" % cn for cn in k)
         f.write ("$EndINDEX\n");
 
+        w = RangeWriter (f)
         for cn in k:
-            self.components [cn].Save (f)
+            self.components [cn].Write (w)
+        w.Flush ()
 
         f.write ("$EndLIBRARY\n")
 
-        f.close ()
 
-        return True
+class EESchemaComponent (Component):
+    """
+    A component of an EESchema library. The component documentation
+    from the .DCM file is kept the same way as the component text,
+    either as a single string (doc_body) or as a byte range of a
+    MappedFile, and it may be attached lazily later with SetDocSource.
 
+    Same as the component text, clean documentation is saved by copying
+    its source bytes, unless its list of lines (doc) was asked for.
+    """
+    __slots__ = ("doc_source", "doc_offset", "doc_length", "doc_body",
+        "doc_lines", "doc_dirty")
 
-class EESchemaComponent:
+    def __init__(self, name, source = None, offset = 0, length = 0, body = None):
+        Component.__init__ (self, name, source, offset, length, body)
+        self.doc_source = None
+        self.doc_offset = self.doc_length = 0
+        self.doc_body = ""
+        self.doc_lines = None
+        self.doc_dirty = True
 
-    def __init__(self, name):
-        self.name = name
-        self.content = []
-        self.doc = []
 
+    def GetDoc (self):
+        if self.doc_lines is None:
+            self.doc_lines = SplitLines (self.DocBody ())
+            self.doc_body = None
+        return self.doc_lines
 
-    def Append (self, l):
-        self.content.append (l)
+
+    def SetDoc (self, lines):
+        self.doc_lines = lines
+        self.doc_body = None
+        self.doc_dirty = True
+
+
+    doc = property (GetDoc, SetDoc)
+
+
+    def DocBody (self):
+        """
+        Return the component documentation as a single string.
+        """
+        if not (self.doc_lines is None):
+            return "".join (self.doc_lines)
+        if not (self.doc_body is None):
+            return self.doc_body
+        return self.doc_source.Read (self.doc_offset, self.doc_length)
+
+
+    def FetchDoc (self):
+        """
+        Read the component documentation into memory.
+        """
+        if (self.doc_lines is None) and (self.doc_body is None):
+            self.doc_body = self.doc_source.Read (self.doc_offset, self.doc_length)
+
+
+    def __getstate__ (self):
+        return (self.name, self.Body (), self.DocBody ())
+
+
+    def __setstate__ (self, state):
+        Component.__setstate__ (self, state [:2])
+        self.doc_body = state [2]
+        self.doc_source = MemoryFile (self.doc_body)
+        self.doc_offset = 0
+        self.doc_length = len (self.doc_body)
+        self.doc_lines = None
+        self.doc_dirty = False
+
+
+    def Touch (self):
+        self.content
+        self.doc
+        self.dirty = self.doc_dirty = True
 
 
     def AppendDoc (self, l):
         self.doc.append (l)
+        self.doc_dirty = True
 
 
-    def Save (self, f):
-        f.writelines (["#\n", "# %s\n" % self.name, "#\n"])
-        f.writelines (self.content)
+    def SetDocSource (self, source, offset, length):
+        """
+        Lazily load the component documentation from a MappedFile.
+        """
+        self.doc_source = source
+        self.doc_offset = offset
+        self.doc_length = length
+        self.doc_body = self.doc_lines = None
+        self.doc_dirty = False
+
+
+    def Write (self, w):
+        """
+        Write the component to a RangeWriter.
+        """
+        w.Write ("#\n# %s\n#\n" % self.name)
+        Component.Write (self, w)
+
+
+    def WriteDoc (self, w):
+        """
+        Write the component documentation to a RangeWriter.
+        """
+        if self.doc_dirty or not (self.doc_lines is None):
+            doc = self.DocBody ()
+            if len (doc):
+                w.Write ("#\n")
+                w.Write (doc)
+        elif self.doc_length:
+            w.Write ("#\n")
+            w.Copy (self.doc_source, self.doc_offset, self.doc_length)
+
 
     def SaveDoc (self, f):
-        if len (self.doc):
-            f.write ("#\n")
-            f.writelines (self.doc)
+        w = RangeWriter (f)
+        self.WriteDoc (w)
+        w.Flush ()
 
 
 class EESchemaLibrary (KiCadLibrary):
@@ -214,25 +999,35 @@ class EESchemaLibrary (KiCadLibrary):
     """
     type = "EESchema"
 
+    lib_tokens = LineTokenizer (("EESchema-LIBRARY", "DEF ", "#"))
+    dcm_tokens = LineTokenizer (("EESchema-DOCLIB", "$CMP ", "#"))
+
     def __init__ (self):
         KiCadLibrary.__init__ (self);
         self.lib_headline = None
         self.dcm_headline = None
         self.encoding = None
 
-    def Load (self, fn):
+    def Load (self, fn, lazy = False, cache = None):
         """
         Load a PCBNew library.
 
         fn -- A path to the file with the .LIB extension (main library file).
+        lazy -- if True, only the component names and their locations in the
+            files are recorded at load time. Component bodies and their
+            documentation are read from memory maps of the files when they
+            are first accessed.
+        cache -- use the on-disk library index (see LibraryIndex) to skip
+            parsing the library if it did not change since last time.
+            By default this is controlled by the INDEX_CACHE variable.
         """
         self.name = os.path.basename (fn)
         self.path = os.path.dirname (fn)
 
-        if not self.LoadLIB (fn):
+        if not self.LoadLIB (fn, lazy, cache):
             return False
 
-        if not self.LoadDCM ("%s.dcm" % os.path.splitext (fn) [0]):
+        if not self.LoadDCM ("%s.dcm" % os.path.splitext (fn) [0], lazy, cache):
             return False
 
         return True
@@ -241,7 +1036,7 @@ class EESchemaLibrary (KiCadLibrary):
     def Save (self, fn):
         """
         Save the content of the object to a PCBNew library.
-        The old file will be overwritten.
+        The old file will be replaced atomically.
         """
 
         k = self.components.keys ()
@@ -256,93 +1051,120 @@ class EESchemaLibrary (KiCadLibrary):
         return True
 
 
-    def LoadLIB (self, fn):
+    def ParseLIBLine (self, l):
+        """
+        Parse a .LIB line outside of a component definition.
+        Header fields are stored into the object.
+        """
+        kw, arg = self.lib_tokens.Match (l)
+        if kw == "#":
+            # encoding ?
+            if "encoding" in arg:
+                enc = self.lib_tokens.Encoding (arg)
+                if not (enc is None):
+                    self.encoding = enc
+            # ignore comments
+            return None
+        elif kw == "DEF":
+            return (arg, "ENDDEF")
+        elif kw == "EESchema-LIBRARY":
+            self.lib_headline = l
+            return None
+
+        self.Fail ("unexpected input line:\n	%s" % l.rstrip ())
+
+
+    def ParseDCMLine (self, l):
+        """
+        Parse a .DCM line outside of a component documentation block.
+        Header fields are stored into the object.
+        """
+        kw, arg = self.dcm_tokens.Match (l)
+        if kw == "#":
+            # encoding ?
+            if "encoding" in arg:
+                enc = self.dcm_tokens.Encoding (arg)
+                if not (enc is None):
+                    self.encoding = enc
+            # ignore comments
+            return None
+        elif kw == "$CMP":
+            return (arg, "$ENDCMP")
+        elif kw == "EESchema-DOCLIB":
+            self.dcm_headline = l
+            return None
+
+        self.Fail ("unexpected input line:\n	%s" % l.rstrip ())
+
+
+    def LoadLIB (self, fn, lazy = False, cache = None):
+        if cache is None:
+            cache = INDEX_CACHE
+
+        if lazy or cache:
+            mf, blocks = self.ScanIndexed (fn, self.ParseLIBLine,
+                "non-finished component \"%s\"",
+                ("lib_headline", "encoding"), cache)
+            for name, offset, length in blocks:
+                comp = EESchemaComponent (name, mf, offset, length)
+                if not lazy:
+                    comp.Fetch ()
+                self.components [name] = comp
+            return True
+
         f = file (fn, "r")
 
-        s0re = re.compile (r"^(EESchema-LIBRARY|DEF +([^ ]+)|# *encoding *([^ ]+)|#).*")
-
-        state = 0
-        for l in f.readlines ():
-            if state == 0:
-                sl = l.rstrip ()
-                mr = s0re.match (sl)
-                if mr is None:
-                    return self.Fail ("unexpected input line:\n	%s" % sl)
-
-                g = mr.groups ()
-                if g [0][0] == '#':
-                    # encoding ?
-                    if not (g [2] is None):
-                        self.encoding = g [2]
-                    # ignore comments
-                elif g [0] == "EESchema-LIBRARY":
-                    self.lib_headline = l
-                elif g [0].startswith ("DEF"):
-                    state = 1
-                    comp = EESchemaComponent (g [1])
-                    comp.Append (l)
-
-            elif state == 1:
-                comp.Append (l)
-                if l.startswith ('ENDDEF'):
-                    state = 0
-                    self.components [comp.name] = comp
-                    comp = None
-
-        if comp != None:
-            return self.Fail ("non-finished component \"%s\"" % comp.name)
+        for name, lines in self.ScanLines (f, self.ParseLIBLine,
+            "non-finished component \"%s\""):
+            self.components [name] = EESchemaComponent (name,
+                body = "".join (lines))
 
         f.close ()
         return True
 
 
-    def LoadDCM (self, fn):
+    def LoadDCM (self, fn, lazy = False, cache = None):
+        if cache is None:
+            cache = INDEX_CACHE
+
+        if lazy or cache:
+            mf, blocks = self.ScanIndexed (fn, self.ParseDCMLine,
+                "non-finished doc for component \"%s\"",
+                ("dcm_headline", "encoding"), cache)
+            for name, offset, length in blocks:
+                comp = self.components.get (name)
+                if comp is None:
+                    self.Warning ("ignoring non-existent component in DCM: %s" % name)
+                else:
+                    comp.SetDocSource (mf, offset, length)
+                    if not lazy:
+                        comp.FetchDoc ()
+            return True
+
         f = file (fn, "r")
 
-        s0re = re.compile (r"^(EESchema-DOCLIB|\$CMP +([^ ]+)|# *encoding *([^ ]+)|#).*")
-
-        state = 0
-        for l in f.readlines ():
-            if state == 0:
-                sl = l.rstrip ()
-                mr = s0re.match (sl)
-                if mr is None:
-                    return self.Fail ("unexpected input line:\n	%s" % sl)
-
-                g = mr.groups ()
-                if g [0][0] == '#':
-                    # encoding ?
-                    if not (g [2] is None):
-                        self.encoding = g [2]
-                    # ignore comments
-                elif g [0] == "EESchema-DOCLIB":
-                    self.dcm_headline = l
-                elif g [0].startswith ("$CMP"):
-                    state = 1
-                    comp = self.components.get (g [1])
-                    if comp is None:
-                        self.Warning ("ignoring non-existent component in DCM: %s" % g [1])
-                    else:
-                        comp.AppendDoc (l)
-
-            elif state == 1:
-                if not (comp is None):
-                    comp.AppendDoc (l)
-                if l.startswith ('$ENDCMP'):
-                    state = 0
-                    comp = None
-
-        if comp != None:
-            return self.Fail ("non-finished doc for component \"%s\"" % comp.name)
+        for name, lines in self.ScanLines (f, self.ParseDCMLine,
+            "non-finished doc for component \"%s\""):
+            comp = self.components.get (name)
+            if comp is None:
+                self.Warning ("ignoring non-existent component in DCM: %s" % name)
+            else:
+                comp.doc_body = comp.DocBody () + "".join (lines)
+                comp.doc_lines = None
 
         f.close ()
         return True
 
 
     def SaveLIB (self, fn, k):
-        self.CheckBackup (fn)
+        return self.WriteFile (fn, self.WriteLIB, k)
+
+
+    def SaveDCM (self, fn, k):
+        return self.WriteFile (fn, self.WriteDCM, k)
+
 
-        f = file (fn, "w")
+    def WriteLIB (self, f, k):
         if self.lib_headline is None:
             f.write ("EESchema-LIBRARY Version 2.3  Date: %s\n" % time.strftime ("%c"))
         else:
@@ -353,30 +1175,895 @@ class EESchemaLibrary (KiCadLibrary):
         else:
             f.write ("#encoding %s\n" % self.encoding)
 
+        w = RangeWriter (f)
         for cn in k:
-            self.components [cn].Save (f)
+            self.components [cn].Write (w)
+        w.Flush ()
 
         f.writelines (["#\n", "#End Library\n"])
 
-        f.close ()
-
-        return True
-
 
-    def SaveDCM (self, fn, k):
-        self.CheckBackup (fn)
-
-        f = file (fn, "w")
+    def WriteDCM (self, f, k):
         if self.dcm_headline is None:
             f.write ("EESchema-DOCLIB  Version 2.0  Date: %s\n" % time.strftime ("%c"))
         else:
             f.write (self.dcm_headline)
 
+        w = RangeWriter (f)
         for cn in k:
-            self.components [cn].SaveDoc (f)
+            self.components [cn].WriteDoc (w)
+        w.Flush ()
 
         f.writelines (["#\n", "#End Doc Library\n"])
 
+
+sexpr_token = re.compile (r'[()]|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+sexpr_special = re.compile (r'[\s()"\\]')
+sexpr_escape = re.compile (r'\\(.)')
+
+
+def TokenizeSExpr (text):
+    """
+    Split s-expression text into a list of tokens. An opening parenthesis
+    is returned together with the keyword following it ("(pad"), closing
+    parentheses are separate tokens, and quoted strings are returned with
+    their quotes.
+    """
+    if "\\" in text:
+        # Escaped characters in quoted strings, take the slow path
+        return sexpr_token.findall (text)
+
+    # Quoted strings are the odd pieces between the quotes;
+    # everything else is split at parentheses and whitespace.
+    parts = text.split ('"')
+    if (len (parts) & 1) == 0:
+        raise ValueError ("unterminated quoted string")
+    tokens = parts [0].replace ("(", " (").replace (")", " ) ").split ()
+    for i in xrange (1, len (parts), 2):
+        tokens.append ('"%s"' % parts [i])
+        tokens.extend (parts [i + 1].replace ("(", " (").replace (")", " ) ").split ())
+    return tokens
+
+
+def ParseSExpr (text):
+    """
+    Parse s-expression text into nested lists.
+    Every list starts with its keyword; atoms are kept as strings exactly
+    as they were written (quoted strings keep their quotes), so that they
+    can be written back unchanged. Returns the list of top-level lists.
+    """
+    stack = []
+    cur = top = []
+    push = stack.append
+    pop = stack.pop
+    try:
+        for t in TokenizeSExpr (text):
+            if t == ")":
+                cur = pop ()
+            elif t [0] == "(":
+                if len (t) > 1:
+                    n = [t [1:]]
+                else:
+                    n = []
+                cur.append (n)
+                push (cur)
+                cur = n
+            else:
+                cur.append (t)
+    except IndexError:
+        raise ValueError ("unbalanced ')'")
+
+    if len (stack):
+        raise ValueError ("unbalanced '('")
+    return top
+
+
+def FormatSExpr (x):
+    """
+    Format nested lists (as returned by ParseSExpr) on a single line.
+    """
+    if isinstance (x, list):
+        return "(%s)" % " ".join ([FormatSExpr (y) for y in x])
+    return x
+
+
+def Unquote (s):
+    """
+    Convert a string atom to its value.
+    """
+    if s [:1] == '"':
+        s = s [1:-1]
+        if "\\" in s:
+            s = sexpr_escape.sub (r"\1", s)
+    return s
+
+
+def Quote (s):
+    """
+    Convert a string to an atom, quoting it if necessary.
+    """
+    if s and (sexpr_special.search (s) is None):
+        return s
+    return '"%s"' % s.replace ("\\", "\\\\").replace ('"', '\\"')
+
+
+def FormatNumber (v):
+    """
+    Format a number the same way KiCad does.
+    """
+    if (v != 0) and (abs (v) <= 0.0001):
+        return ("%.10f" % v).rstrip ("0")
+    return "%.10g" % v
+
+
+# Converters between the values of footprint item fields and
+# the atoms following the field keyword: (parse, format)
+NUM = (lambda x: float (x [0]),
+       lambda v: [FormatNumber (v)])
+XY = (lambda x: tuple ([float (y) for y in x]),
+      lambda v: [FormatNumber (y) for y in v])
+XYZ = (lambda x: tuple ([float (y) for y in x [0][1:]]),
+       lambda v: [["xyz"] + [FormatNumber (y) for y in v]])
+STR = (lambda x: Unquote (x [0]),
+       lambda v: [Quote (v)])
+STRS = (lambda x: [Unquote (y) for y in x],
+        lambda v: [Quote (y) for y in v])
+RAW = (lambda x: x,
+       lambda v: list (v))
+
+
+def _ArgProperty (index, quoted):
+    """
+    A property for the atom at the given index of the item expression.
+    """
+    if quoted:
+        return property (lambda self: Unquote (self.node [index]),
+            lambda self, v: self.node.__setitem__ (index, Quote (v)))
+    return property (lambda self: self.node [index],
+        lambda self, v: self.node.__setitem__ (index, v))
+
+
+def _FieldProperty (keyword, conv):
+    """
+    A property for the "(keyword ...)" sub-expression of the item
+    expression. The value is None if there's no such sub-expression,
+    and setting it to None removes it.
+    """
+    parse, format = conv
+
+    def get (self):
+        for x in self.node:
+            if isinstance (x, list) and (x [:1] == [keyword]):
+                return parse (x [1:])
+        return None
+
+    def set (self, v):
+        node = self.node
+        for i in xrange (len (node)):
+            x = node [i]
+            if isinstance (x, list) and (x [:1] == [keyword]):
+                if v is None:
+                    del node [i]
+                else:
+                    node [i] = [keyword] + format (v)
+                return
+        if not (v is None):
+            self.Insert ([keyword] + format (v))
+
+    return property (get, set)
+
+
+class FpItem (object):
+    """
+    The base class of footprint items. An item is a view of its parsed
+    s-expression (node): the attributes listed in the args and fields
+    tables are read from and written to the node, converting them to
+    and from numbers and strings on the fly. This way the parts of the
+    item which were not changed are written back exactly as they were.
+
+    args -- (name, index, quoted) for the atoms following the keyword.
+    fields -- (name, converter) for the "(name ...)" sub-expressions,
+        in the order they are written.
+    """
+    __slots__ = ("node",)
+    keyword = None
+    args = ()
+    fields = ()
+
+    def __init__(self, node = None, **kw):
+        if node is None:
+            node = [self.keyword] + ["\"\""] * len (self.args)
+        self.node = node
+        if kw:
+            for name, index, quoted in self.args:
+                if kw.has_key (name):
+                    setattr (self, name, kw [name])
+            for name, conv in self.fields:
+                if kw.has_key (name):
+                    setattr (self, name, kw [name])
+
+
+    def Insert (self, x):
+        """
+        Add a new sub-expression to the item, before the sub-expressions
+        which follow it in the fields table.
+        """
+        names = [name for name, conv in self.fields]
+        if x [0] in names:
+            names = names [names.index (x [0]) + 1:]
+            node = self.node
+            for i in xrange (len (node)):
+                if isinstance (node [i], list) and (node [i][0] in names):
+                    node.insert (i, x)
+                    return
+        self.node.append (x)
+
+
+    def Format (self):
+        """
+        Format the item as it is written in a .kicad_mod file.
+        """
+        return FormatSExpr (self.node)
+
+
+class FpLine (FpItem):
+    """
+    A graphic line: (fp_line (start X Y) (end X Y) (layer L) (width W))
+    """
+    __slots__ = ()
+    keyword = "fp_line"
+    fields = (("start", XY), ("end", XY), ("layer", STR), ("width", NUM))
+
+
+class FpArc (FpItem):
+    """
+    A graphic arc around the start point, beginning at the end point:
+    (fp_arc (start X Y) (end X Y) (angle A) (layer L) (width W))
+    """
+    __slots__ = ()
+    keyword = "fp_arc"
+    fields = (("start", XY), ("end", XY), ("angle", NUM), ("layer", STR),
+        ("width", NUM))
+
+
+class FpText (FpItem):
+    """
+    A text: (fp_text reference|value|user TEXT (at X Y [ROT]) (layer L) [hide]
+        (effects ...))
+    """
+    __slots__ = ()
+    keyword = "fp_text"
+    args = (("kind", 1, False), ("text", 2, True))
+    fields = (("at", XY), ("layer", STR), ("effects", RAW))
+
+
+    def GetHide (self):
+        return "hide" in self.node
+
+
+    def SetHide (self, hide):
+        if hide != self.hide:
+            if hide:
+                self.Insert ("hide")
+            else:
+                self.node.remove ("hide")
+
+
+    hide = property (GetHide, SetHide)
+
+
+    def Insert (self, x):
+        # Effects are always last
+        node = self.node
+        if isinstance (node [-1], list) and (node [-1][0] == "effects"):
+            node.insert (len (node) - 1, x)
+        else:
+            FpItem.Insert (self, x)
+
+
+    def Format (self):
+        node = self.node
+        if isinstance (node [-1], list) and (node [-1][0] == "effects"):
+            return "(%s\n    %s\n  )" % (" ".join ([FormatSExpr (x) for x in node [:-1]]),
+                FormatSExpr (node [-1]))
+        return FormatSExpr (node)
+
+
+class Pad (FpItem):
+    """
+    A pad: (pad NUMBER TYPE SHAPE (at X Y [ROT]) (size W H) [(drill ...)]
+        (layers L...))
+    The drill is kept as a list of atoms.
+    """
+    __slots__ = ()
+    keyword = "pad"
+    args = (("number", 1, True), ("type", 2, False), ("shape", 3, False))
+    fields = (("at", XY), ("size", XY), ("drill", RAW), ("layers", STRS))
+
+
+class Model (FpItem):
+    """
+    A 3D model: (model PATH (at (xyz X Y Z)) (scale (xyz X Y Z))
+        (rotate (xyz X Y Z)))
+    """
+    __slots__ = ()
+    keyword = "model"
+    args = (("path", 1, True),)
+    fields = (("at", XYZ), ("scale", XYZ), ("rotate", XYZ))
+
+
+    def Format (self):
+        node = self.node
+        return "(%s\n  )" % "\n    ".join ([" ".join (node [:2])] +
+            [FormatSExpr (x) for x in node [2:]])
+
+
+# Make properties out of the item field tables
+for cls in (FpLine, FpArc, FpText, Pad, Model):
+    for name, index, quoted in cls.args:
+        setattr (cls, name, _ArgProperty (index, quoted))
+    for name, conv in cls.fields:
+        setattr (cls, name, _FieldProperty (name, conv))
+
+
+class Footprint (object):
+    """
+    A KiCad footprint (the 'module' expression of a .kicad_mod file).
+
+    The items of the footprint are kept in the items list in file order.
+    Pads, lines, arcs, texts and 3D models are Pad, FpLine, FpArc, FpText
+    and Model objects; all other items (descr, tags, attr, fp_circle etc)
+    are kept as parsed s-expressions. The header list holds the atoms and
+    expressions written on the first line (layer, tedit, locked etc).
+
+    A footprint loaded from a file keeps the source text and is written
+    back as is, unless it is dirty. Dirty footprints are formatted the
+    same way KiCad does it. Since the items and the header may be modified
+    in place, they are only built from the parsed expressions when they
+    are asked for, and from then on the footprint is dirty, same as after
+    Touch () or changing its name.
+    """
+    keyword = "module"
+    item_types = {
+        "pad": Pad,
+        "fp_line": FpLine,
+        "fp_arc": FpArc,
+        "fp_text": FpText,
+        "model": Model,
+    }
+    header_keywords = ("layer", "tedit", "tstamp")
+
+    def __init__(self, name = "", layer = "F.Cu"):
+        self._name = name
+        self._header = [["layer", layer]]
+        self._items = []
+        # The parsed expressions the items are not built from yet
+        self._state = None
+        self.source = None
+        self.dirty = True
+
+
+    def GetName (self):
+        return self._name
+
+
+    def SetName (self, name):
+        self._name = name
+        self.dirty = True
+
+
+    def GetHeader (self):
+        self._Build ()
+        # The header may be modified in place from now on
+        self.dirty = True
+        return self._header
+
+
+    def SetHeader (self, header):
+        self._Build ()
+        self._header = header
+        self.dirty = True
+
+
+    def GetItems (self):
+        self._Build ()
+        # The items may be modified in place from now on
+        self.dirty = True
+        return self._items
+
+
+    def SetItems (self, items):
+        self._Build ()
+        self._items = items
+        self.dirty = True
+
+
+    name = property (GetName, SetName)
+    header = property (GetHeader, SetHeader)
+    items = property (GetItems, SetItems)
+
+
+    def _Build (self):
+        """
+        Build the item objects from the parsed expressions.
+        """
+        if self._state is None:
+            return
+        self._name, self._header, items = self._state
+        self._state = None
+        self._items = []
+        types = self.item_types
+        for y in items:
+            cls = types.get (y [0])
+            if cls is None:
+                self._items.append (y)
+            else:
+                self._items.append (cls (y))
+
+
+    def Parse (self, text):
+        """
+        Parse the text of a .kicad_mod file.
+        """
+        top = ParseSExpr (text)
+        if (len (top) != 1) or (top [0][:1] != [self.keyword]) or (len (top [0]) < 2):
+            raise ValueError ("not a footprint")
+        x = top [0]
+
+        header = []
+        items = []
+        for y in x [2:]:
+            if isinstance (y, list) and not (y [0] in self.header_keywords):
+                items.append (y)
+            else:
+                header.append (y)
+
+        self.SetState ((Unquote (x [1]), header, items), text)
+
+
+    def GetState (self):
+        """
+        Return the footprint as a tuple (name, header, items) of strings
+        and nested lists only, with items being the parsed s-expressions,
+        so that it can be stored with marshal.
+        """
+        if not (self._state is None):
+            return self._state
+        return (self._name, self._header,
+            [x.node if isinstance (x, FpItem) else x for x in self._items])
+
+
+    def SetState (self, state, source = None):
+        """
+        Set up the footprint from a tuple returned by GetState ().
+        source -- the text of the footprint, if it was not modified.
+        """
+        self._name = state [0]
+        self._state = state
+        self.source = source
+        self.dirty = source is None
+        if source is None:
+            self._Build ()
+
+
+    def Load (self, fn):
+        """
+        Load a footprint from a .kicad_mod file.
+        """
+        f = open (fn, "r")
+        text = f.read ()
         f.close ()
+        try:
+            self.Parse (text)
+        except ValueError, e:
+            raise ValueError ("%s: %s" % (fn, e))
+
+
+    def Touch (self):
+        """
+        Mark the footprint as modified, so that it is formatted from
+        the items rather than written from the source text.
+        """
+        self.dirty = True
+
+
+    def Items (self, cls):
+        """
+        Return the list of footprint items of the given class.
+        """
+        return [x for x in self.items if isinstance (x, cls)]
+
+
+    def Find (self, keyword):
+        """
+        Find the first header expression or item with the given keyword.
+        Returns None if there's none.
+        """
+        for x in self.header + self.items:
+            if isinstance (x, FpItem):
+                if x.keyword == keyword:
+                    return x
+            elif isinstance (x, list) and (x [0] == keyword):
+                return x
+        return None
+
+
+    def Format (self):
+        """
+        Format the footprint as KiCad writes it to a .kicad_mod file.
+        """
+        self._Build ()
+        s = ["(%s %s" % (self.keyword, Quote (self._name))]
+        for x in self._header:
+            s.append (" " + FormatSExpr (x))
+        s.append ("\n")
+        for x in self._items:
+            if isinstance (x, FpItem):
+                s.append ("  %s\n" % x.Format ())
+            else:
+                s.append ("  %s\n" % FormatSExpr (x))
+        s.append (")\n")
+        return "".join (s)
+
+
+    def Write (self, f):
+        """
+        Write the footprint to an open file.
+        """
+        if self.dirty or (self.source is None):
+            f.write (self.Format ())
+        else:
+            f.write (self.source)
+
+
+    def Save (self, fn):
+        """
+        Save the footprint to a .kicad_mod file.
+        The old file will be replaced atomically.
+        """
+        f = AtomicFile (fn, False)
+        try:
+            self.Write (f)
+        except:
+            f.Abort ()
+            raise
+        f.Commit ()
+
+
+def ReadFiles (fns, threads = 1):
+    """
+    Read many whole files, using the given number of threads to overlap
+    the waits for the disk. Returns a list of file contents in the same
+    order as fns. IOError is raised if any of the files can't be read.
+    """
+    texts = [None] * len (fns)
+    errors = []
+
+    def Read (first):
+        for i in xrange (first, len (fns), threads):
+            try:
+                f = open (fns [i], "rb")
+                texts [i] = f.read ()
+                f.close ()
+            except IOError, e:
+                errors.append (e)
+
+    if threads <= 1:
+        Read (0)
+    else:
+        workers = [threading.Thread (target = Read, args = (i,)) for i in range (threads)]
+        for t in workers:
+            t.start ()
+        for t in workers:
+            t.join ()
+
+    if len (errors):
+        raise errors [0]
+    return texts
+
+
+def _ParseFootprint (args):
+    """
+    Parse a footprint in a worker process for PrettyLibrary.Load.
+    Returns the footprint state, or an error message string.
+    """
+    fn, text = args
+    fp = Footprint ()
+    try:
+        fp.Parse (text)
+    except ValueError, e:
+        return "%s: %s" % (fn, e)
+    return fp.GetState ()
+
+
+class PrettyLibrary (KiCadLibrary):
+    """
+    This class allows to load, manipulate and save KiCad footprint
+    libraries. These are .pretty directories with a .kicad_mod file
+    per footprint; the components are Footprint objects, named after
+    the files.
+
+    The footprint files may be read by several threads and parsed with
+    a pool of worker processes. The parsed footprints are cached in
+    a sidecar file keyed by the hash of the file content, so files which
+    did not change since the last load are not parsed again. The cache
+    for "dir/name.pretty" is kept in the file "dir/.name.pretty.idx".
+    """
+    type = "Pretty"
+
+    cache_magic = "KCPC"
+    cache_version = 1
+
+    # Don't start worker processes to parse less footprint text than this:
+    # parsing it takes about as long as starting the pool and passing
+    # the parsed footprints back
+    min_parallel_size = 4 * 1024 * 1024
+
+
+    def CacheFile (self, dn):
+        dn = os.path.realpath (dn)
+        return os.path.join (os.path.dirname (dn), ".%s.idx" % os.path.basename (dn))
+
+
+    def LoadCache (self, dn):
+        """
+        Load the footprint cache of a library.
+        Returns a dictionary mapping content hashes to footprint states.
+        """
+        try:
+            f = open (self.CacheFile (dn), "rb")
+            magic, version, states = marshal.load (f)
+            f.close ()
+            if (magic == self.cache_magic) and (version == self.cache_version):
+                return states
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        return {}
+
+
+    def SaveCache (self, dn, states):
+        """
+        Save the footprint cache of a library.
+        Errors are ignored, since the cache is not essential.
+        """
+        fn = self.CacheFile (dn)
+        tfn = "%s.%d" % (fn, os.getpid ())
+        try:
+            f = open (tfn, "wb")
+            marshal.dump ((self.cache_magic, self.cache_version, states), f)
+            f.close ()
+            os.rename (tfn, fn)
+        except (IOError, OSError):
+            try:
+                os.unlink (tfn)
+            except OSError:
+                pass
+
+
+    def Load (self, dn, processes = None, cache = None):
+        """
+        Load a .pretty footprint library.
+
+        dn -- the path to the library directory.
+        processes -- the number of threads reading the files and of worker
+            processes parsing them (default is 1). The worker processes are
+            only started for min_parallel_size bytes or more of new and
+            changed footprints.
+        cache -- use the footprint cache to skip parsing the files which
+            did not change since last time. By default this is controlled
+            by the INDEX_CACHE variable.
+        """
+        if cache is None:
+            cache = INDEX_CACHE
+        if processes is None:
+            # Passing the parsed footprints back from the workers takes
+            # about as long as parsing them, so the pool rarely pays off
+            processes = 1
+
+        self.name = os.path.basename (os.path.normpath (dn))
+        self.path = os.path.dirname (os.path.normpath (dn))
+
+        try:
+            fns = [os.path.join (dn, x) for x in os.listdir (dn)
+                if x.endswith (".kicad_mod")]
+        except OSError, e:
+            self.Fail ("cannot read library %s: %s" % (dn, e.strerror))
+        fns.sort ()
+
+        try:
+            texts = ReadFiles (fns, min (processes, len (fns) / 16 + 1))
+        except IOError, e:
+            self.Fail ("cannot read footprint %s: %s" % (e.filename, e.strerror))
+
+        keys = [hashlib.sha1 (text).hexdigest () for text in texts]
+        if cache:
+            states = self.LoadCache (dn)
+        else:
+            states = {}
+
+        # Parse the new and changed footprints
+        missing = []
+        mkeys = []
+        size = 0
+        for fn, text, key in zip (fns, texts, keys):
+            if not states.has_key (key):
+                missing.append ((fn, text))
+                mkeys.append (key)
+                size += len (text)
+        if (processes > 1) and (size >= self.min_parallel_size):
+            pool = multiprocessing.Pool (min (processes, len (missing)))
+            parsed = pool.map (_ParseFootprint, missing,
+                (len (missing) + processes - 1) / processes)
+            pool.close ()
+            pool.join ()
+        else:
+            parsed = [_ParseFootprint (x) for x in missing]
+
+        for key, state in zip (mkeys, parsed):
+            if isinstance (state, str):
+                self.Fail (state)
+            states [key] = state
+
+        used = set ()
+        for fn, text, key in zip (fns, texts, keys):
+            state = states [key]
+            if key in used:
+                # Identical files must not share the parsed expressions
+                state = marshal.loads (marshal.dumps (state))
+            used.add (key)
+            fp = Footprint ()
+            fp.SetState (state, text)
+            self.components [os.path.splitext (os.path.basename (fn)) [0]] = fp
+
+        # Drop the footprints which are gone from the cache
+        if cache and (len (missing) or (len (states) != len (used))):
+            self.SaveCache (dn, dict ([(key, states [key]) for key in used]))
+
+        return True
+
+
+    def Save (self, dn):
+        """
+        Save the footprints which were changed, or which are missing
+        from the directory, to a .pretty directory.
+        """
+        if not os.path.isdir (dn):
+            os.mkdir (dn, 0755)
+
+        for cn, fp in self.components.items ():
+            fn = os.path.join (dn, "%s.kicad_mod" % cn)
+            if fp.dirty or (fp.source is None) or not os.path.exists (fn):
+                fp.Save (fn)
 
         return True
+
+
+def NewLibrary (fn):
+    """
+    Create a new library object, choosing library type by filename extension.
+    """
+    ext = os.path.splitext (fn) [1].lower ()
+    if (ext == ".mod") or (ext == ".emp"):
+        return PCBNewLibrary ()
+    elif (ext == ".lib"):
+        return EESchemaLibrary ()
+
+    sys.stderr.write ("ERROR: cannot determine library type from its extension:\n	%s\n" % fn)
+
+
+def _ScanLibrary (args):
+    """
+    Find the components of a single library in a worker process
+    for LoadLibraries. Returns the indexes of the library files.
+    """
+    fn, cache = args
+    lib = NewLibrary (fn)
+    if lib is None:
+        return None
+
+    lib.indexes = {}
+    try:
+        lib.Load (fn, True, cache)
+    except SystemExit:
+        # The error message has been already displayed by Fail ()
+        return None
+
+    return lib.indexes
+
+
+# Don't start worker processes for less library data than this
+MIN_PARALLEL_SIZE = 16 * 1024 * 1024
+
+
+def LoadLibraries (fns, processes = None, cache = None):
+    """
+    Load many libraries lazily (see Load), finding their components
+    in parallel with a pool of worker processes. The workers send back
+    just the library indexes (see LibraryIndex), so the calling process
+    only has to map the files and create the components. Libraries
+    smaller than MIN_PARALLEL_SIZE in total are loaded sequentially,
+    since it takes longer to start the workers.
+    Execution is aborted if any of the libraries fails to load.
+
+    fns -- a list of library file names.
+    processes -- the number of worker processes (default is number of CPUs).
+    cache -- whether to use the library index cache (see Load).
+
+    Returns a list of library objects, in the same order as fns.
+    """
+    if cache is None:
+        cache = INDEX_CACHE
+
+    if processes is None:
+        processes = multiprocessing.cpu_count ()
+    processes = min (processes, len (fns))
+
+    indexes = [None] * len (fns)
+    if processes > 1:
+        size = 0
+        for fn in fns:
+            if os.path.exists (fn):
+                size += os.path.getsize (fn)
+        if size >= MIN_PARALLEL_SIZE:
+            pool = multiprocessing.Pool (processes)
+            indexes = pool.map (_ScanLibrary, [(fn, cache) for fn in fns], 1)
+            pool.close ()
+            pool.join ()
+            if None in indexes:
+                sys.exit (-1)
+
+    libs = []
+    for fn, idx in zip (fns, indexes):
+        lib = NewLibrary (fn)
+        if lib is None:
+            sys.exit (-1)
+        lib.indexes = idx
+        lib.Load (fn, True, cache)
+        lib.indexes = None
+        libs.append (lib)
+
+    return libs
+
+
+def MergeLibraries (libs, conflict = "first"):
+    """
+    Merge the components of several libraries of the same type into
+    a new library. Library headers are taken from the first library.
+
+    libs -- a list of library objects.
+    conflict -- what to do if a component is present in several libraries:
+        "first" to keep the component from the earliest library,
+        "last" to keep the component from the latest library,
+        "error" to abort with an error message.
+
+    Returns the new library object.
+    """
+    if conflict not in ("first", "last", "error"):
+        raise ValueError ("unknown conflict resolution rule: %s" % conflict)
+
+    olib = libs [0].__class__ ()
+    for attr in ("headline", "encoding", "units", "lib_headline", "dcm_headline"):
+        if hasattr (libs [0], attr):
+            setattr (olib, attr, getattr (libs [0], attr))
+
+    origin = {}
+    for lib in libs:
+        if lib.type != olib.type:
+            olib.Fail ("cannot merge %s library %s with %s libraries" % \
+                (lib.type, lib.name, olib.type))
+        if getattr (lib, "units", None) != getattr (olib, "units", None):
+            olib.Fail ("%s is using units %s while %s is using %s" % \
+                (lib.name, lib.units, libs [0].name, olib.units))
+
+        for cn in lib.components.keys ():
+            if olib.HasComponent (cn):
+                if conflict == "first":
+                    continue
+                elif conflict == "error":
+                    olib.Fail ("component %s is present in both %s and %s" % \
+                        (cn, origin [cn], lib.name))
+
+            olib.CopyComponent (cn, lib)
+            origin [cn] = lib.name
+
+    return olib
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""
+Tests for the build manifest, the table loader and the test board
+packing of the footprint generators: run with "python tools/test_fpgen.py".
+"""
+
+import os, sys, shutil, tempfile, imp, json
+import unittest
+import StringIO
+
+top = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, os.path.join (top, "tools"))
+import fpgen
+
+go = imp.load_source ("capacitors_go", os.path.join (top, "Capacitors_gen", "go.py"))
+
+
+class ManifestTest (unittest.TestCase):
+    def setUp (self):
+        self.cwd = os.getcwd ()
+        self.tmpdir = tempfile.mkdtemp ()
+        os.chdir (self.tmpdir)
+        self.pmofs = go.PMOFS
+
+        table = dict ([(dim, go.tantalum_chip_capacitors [dim])
+            for dim in ("EIA-3216-18", "EIA-7343-31")])
+        self.jobs = go.CapacitorJobs (table, "Test")
+        self.manifest = {}
+
+    def tearDown (self):
+        go.PMOFS = self.pmofs
+        os.chdir (self.cwd)
+        shutil.rmtree (self.tmpdir)
+
+    def Generate (self):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO ()
+        try:
+            return fpgen.Generate ("capacitor", self.jobs, go.CapacitorFile,
+                go.CapacitorRow, go.RenderCapacitor, go.CapacitorTemplate,
+                1, self.manifest)
+        finally:
+            sys.stdout = stdout
+
+    def Texts (self):
+        texts = {}
+        for job in self.jobs:
+            fn = go.CapacitorFile (job)
+            f = open (fn, "r")
+            texts [fn] = f.read ()
+            f.close ()
+        return texts
+
+    def testUnchanged (self):
+        self.assertEqual (self.Generate (), len (self.jobs))
+        self.assertEqual (self.Generate (), 0)
+
+    def testConstantChanged (self):
+        self.assertEqual (self.Generate (), len (self.jobs))
+        before = self.Texts ()
+
+        # The polarity mark moves with the offset from the pads
+        go.PMOFS = self.pmofs + 0.1
+        self.assertEqual (self.Generate (), len (self.jobs))
+        after = self.Texts ()
+        for fn in before.keys ():
+            self.assertNotEqual (before [fn], after [fn], fn)
+
+        self.assertEqual (self.Generate (), 0)
+
+    def testJobsRemoved (self):
+        os.mkdir ("Other.pretty")
+        f = open ("Other.pretty/Kept.kicad_mod", "w")
+        f.close ()
+        self.manifest ["Other.pretty/Kept.kicad_mod"] = "x"
+        self.manifest ["Other.pretty/Gone.kicad_mod"] = "x"
+        self.manifest ["Test.kicad_pcb"] = "x"
+
+        self.assertEqual (self.Generate (), len (self.jobs))
+        removed = self.jobs [::2]
+        self.jobs = self.jobs [1::2]
+        self.assertEqual (self.Generate (), 0)
+
+        for job in removed:
+            self.assertFalse (self.manifest.has_key (go.CapacitorFile (job)))
+        self.assertEqual (sorted (self.manifest.keys ()),
+            sorted ([go.CapacitorFile (job) for job in self.jobs] +
+                ["Other.pretty/Kept.kicad_mod", "Test.kicad_pcb"]))
+
+
+class TableSchemaTest (unittest.TestCase):
+    csv = """\
+Name,L,W,Size,Pol,Reflow.Z,Reflow.G,Reflow.X,Reflow.Y,Reflow.C
+EIA-3216-18,3.2,1.6,Kemet-A,yes,4.6,0.8,1.4,1.9,2.7
+0603,1.6,0.8,,,2.2,0.6,0.8,0.8,1.4
+"""
+
+    def setUp (self):
+        self.tmpdir = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.tmpdir)
+
+    def Write (self, name, text):
+        fn = os.path.join (self.tmpdir, name)
+        f = open (fn, "w")
+        f.write (text)
+        f.close ()
+        return fn
+
+    def testCSV (self):
+        table = go.capacitor_schema.Load (self.Write ("t.csv", self.csv), False)
+        self.assertEqual (sorted (table.keys ()), ["0603", "EIA-3216-18"])
+        self.assertEqual (table ["EIA-3216-18"]["Pol"], True)
+        self.assertEqual (table ["EIA-3216-18"]["Size"], "Kemet-A")
+        self.assertEqual (table ["0603"]["Reflow"],
+            { 'Z': 2.2, 'G': 0.6, 'X': 0.8, 'Y': 0.8, 'C': 1.4 })
+        self.assertFalse (table ["0603"].has_key ("Pol"))
+
+    def testJSON (self):
+        table = go.capacitor_schema.Load (self.Write ("t.csv", self.csv), False)
+        json_table = go.capacitor_schema.Load (self.Write ("t.json",
+            json.dumps (table)), False)
+        self.assertEqual (json_table, table)
+
+    def testCache (self):
+        fn = self.Write ("t.csv", self.csv)
+        table = go.capacitor_schema.Load (fn)
+        self.assertTrue (os.path.exists (go.capacitor_schema.CacheFile (fn)))
+        self.assertEqual (go.capacitor_schema.Load (fn), table)
+
+        # A changed table is loaded again
+        self.Write ("t.csv", self.csv.replace ("3.2,1.6", "3.3,1.6"))
+        self.assertEqual (go.capacitor_schema.Load (fn) ["EIA-3216-18"]["L"], 3.3)
+
+    def testErrors (self):
+        fn = self.Write ("t.csv", self.csv.replace ("4.6,0.8", "4.7,0.8").
+            replace ("0603,1.6", "0603,"))
+        try:
+            go.capacitor_schema.Load (fn, False)
+        except ValueError, e:
+            errors = str (e).split ("\n")
+        else:
+            self.fail ("no errors reported")
+        self.assertEqual (len (errors), 2)
+        self.assertTrue ("0603: missing L" in errors [0], errors)
+        self.assertTrue ("EIA-3216-18 Reflow: G + Y*2 != Z" in errors [1], errors)
+
+
+class ShelfPackTest (unittest.TestCase):
+    def testPack (self):
+        sizes = [(1 + (i * 7) % 5, 1 + (i * 3) % 4) for i in range (40)]
+        pos, (pw, ph) = fpgen.ShelfPack (sizes, 0.5)
+        boxes = [(x, y, x + w, y + h) for (x, y), (w, h) in zip (pos, sizes)]
+        for i in range (len (boxes)):
+            x1, y1, x2, y2 = boxes [i]
+            self.assertTrue ((x1 >= 0) and (y1 >= 0) and (x2 <= pw) and (y2 <= ph))
+            for j in range (i):
+                a1, b1, a2, b2 = boxes [j]
+                self.assertTrue ((x2 + 0.5 <= a1) or (a2 + 0.5 <= x1) or
+                    (y2 + 0.5 <= b1) or (b2 + 0.5 <= y1), (i, j))
+
+        # Roughly square
+        self.assertTrue (0.5 < float (pw) / ph < 2, (pw, ph))
+
+    def testEmpty (self):
+        self.assertEqual (fpgen.ShelfPack ([], 1), ([], (0, 0)))
+
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+"""
+Tests for the library classes of kicad.py: loading (streamed, lazy and
+from the index cache), saving unchanged components as byte ranges,
+merging, the s-expression parser and the .pretty libraries.
+Run with "python tools/test_kicad.py".
+"""
+
+import os, sys, shutil, tempfile
+import unittest
+import StringIO
+
+top = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, os.path.join (top, "tools"))
+import kicad
+
+
+def ModLibrary (names):
+    """
+    Return the text of a PCBNew library with the given modules,
+    as PCBNewLibrary.Save () writes it.
+    """
+    s = ["PCBNEW-LibModule-V1  Sat 01 Jan 2000 00:00:00\n",
+        "# encoding utf-8\n", "Units mm\n", "$INDEX\n"]
+    s.extend (["%s\n" % name for name in sorted (names)])
+    s.append ("$EndINDEX\n")
+    for name in sorted (names):
+        s.append ("$MODULE %s\nPo 0 0 0 15 00000000 00000000 ~~\nLi %s\n"
+            "DS -1 -1 1 -1 0.15 21\n$PAD\nSh \"1\" R 1 1 0 0 0\n$EndPAD\n"
+            "$EndMODULE %s\n" % (name, name, name))
+    s.append ("$EndLIBRARY\n")
+    return "".join (s)
+
+
+def SchLibrary (names, docs):
+    """
+    Return the texts of an EESchema library (.lib and .dcm) with
+    the given components, as EESchemaLibrary.Save () writes them.
+    Only the components in docs have documentation.
+    """
+    lib = ["EESchema-LIBRARY Version 2.3  Date: Sat 01 Jan 2000 00:00:00\n",
+        "#encoding utf-8\n"]
+    dcm = ["EESchema-DOCLIB  Version 2.0  Date: Sat 01 Jan 2000 00:00:00\n"]
+    for name in sorted (names):
+        lib.append ("#\n# %s\n#\nDEF %s U 0 40 Y Y 1 F N\n"
+            "F0 \"U\" 0 150 50 H V C CNN\nENDDEF\n" % (name, name))
+        if name in docs:
+            dcm.append ("#\n$CMP %s\nD Component %s\nK test\n$ENDCMP\n" % (name, name))
+    lib.append ("#\n#End Library\n")
+    dcm.append ("#\n#End Doc Library\n")
+    return "".join (lib), "".join (dcm)
+
+
+class LibraryTestCase (unittest.TestCase):
+    def setUp (self):
+        self.tmpdir = tempfile.mkdtemp ()
+        self.stderr = sys.stderr
+        sys.stderr = StringIO.StringIO ()
+
+    def tearDown (self):
+        sys.stderr = self.stderr
+        shutil.rmtree (self.tmpdir)
+
+    def Path (self, name):
+        return os.path.join (self.tmpdir, name)
+
+    def Write (self, name, text):
+        f = open (self.Path (name), "w")
+        f.write (text)
+        f.close ()
+        return self.Path (name)
+
+    def Read (self, name):
+        f = open (self.Path (name), "r")
+        text = f.read ()
+        f.close ()
+        return text
+
+    def Load (self, fn, lazy = False, cache = False):
+        lib = kicad.NewLibrary (fn)
+        lib.Load (fn, lazy, cache)
+        return lib
+
+
+class LegacyLibraryTest (LibraryTestCase):
+    modes = ((False, False), (True, False), (False, True), (True, True))
+
+    def setUp (self):
+        LibraryTestCase.setUp (self)
+        self.mod = ModLibrary (["A", "B", "C_1"])
+        self.lib, self.dcm = SchLibrary (["A", "B", "C_1"], ["A", "C_1"])
+        self.Write ("t.mod", self.mod)
+        self.Write ("t.lib", self.lib)
+        self.Write ("t.dcm", self.dcm)
+
+    def testRoundTrip (self):
+        for lazy, cache in self.modes:
+            self.Load (self.Path ("t.mod"), lazy, cache).Save (self.Path ("o.mod"))
+            self.assertEqual (self.Read ("o.mod"), self.mod, (lazy, cache))
+
+            self.Load (self.Path ("t.lib"), lazy, cache).Save (self.Path ("o.lib"))
+            self.assertEqual (self.Read ("o.lib"), self.lib, (lazy, cache))
+            self.assertEqual (self.Read ("o.dcm"), self.dcm, (lazy, cache))
+
+    def testSameComponents (self):
+        ref = self.Load (self.Path ("t.lib"))
+        for lazy, cache in self.modes:
+            lib = self.Load (self.Path ("t.lib"), lazy, cache)
+            self.assertEqual (sorted (lib.components.keys ()), ["A", "B", "C_1"])
+            for name, comp in lib.components.items ():
+                self.assertEqual (comp.Body (), ref.components [name].Body ())
+                self.assertEqual (comp.DocBody (), ref.components [name].DocBody ())
+        self.assertEqual (ref.components ["B"].DocBody (), "")
+        self.assertEqual (ref.components ["A"].doc [1], "D Component A\n")
+
+    def testIndexCache (self):
+        fn = self.Path ("t.mod")
+        self.Load (fn, True, True)
+        self.assertTrue (os.path.exists (kicad.LibraryIndex (fn).IndexFile ()))
+
+        # A valid index is used instead of scanning the library
+        lib = kicad.PCBNewLibrary ()
+        lib.ScanMapped = None
+        lib.Load (fn, True, True)
+        self.assertEqual (sorted (lib.components.keys ()), ["A", "B", "C_1"])
+        self.assertEqual (lib.units, "mm")
+
+        # A stale one is not
+        self.Write ("t.mod", ModLibrary (["A", "B", "C_1", "D"]))
+        lib = self.Load (fn, True, True)
+        self.assertEqual (sorted (lib.components.keys ()), ["A", "B", "C_1", "D"])
+        self.assertTrue (lib.components ["D"].Body ().startswith ("$MODULE D\n"))
+
+    def testEditOne (self):
+        size = kicad.STREAM_BUFFER_SIZE
+        # Copy the unchanged modules in many chunks
+        kicad.STREAM_BUFFER_SIZE = 7
+        try:
+            lib = self.Load (self.Path ("t.mod"), True, True)
+            lib.components ["B"].content.insert (-1, "DS 0 -1 0 1 0.15 21\n")
+            lib.Save (self.Path ("t.mod"))
+        finally:
+            kicad.STREAM_BUFFER_SIZE = size
+        self.assertEqual (self.Read ("t.mod"), self.mod.replace ("$EndMODULE B\n",
+            "DS 0 -1 0 1 0.15 21\n$EndMODULE B\n"))
+        self.assertEqual (self.Read ("t.mod~"), self.mod)
+
+    def testEditDoc (self):
+        lib = self.Load (self.Path ("t.lib"), True, True)
+        lib.components ["A"].doc [1] = "D Changed\n"
+        lib.Save (self.Path ("t.lib"))
+        self.assertEqual (self.Read ("t.lib"), self.lib)
+        self.assertEqual (self.Read ("t.dcm"),
+            self.dcm.replace ("D Component A\n", "D Changed\n"))
+
+    def testUnfinished (self):
+        self.Write ("bad.mod", self.mod.replace ("$EndMODULE C_1\n", ""))
+        for lazy, cache in self.modes:
+            self.assertRaises (SystemExit, self.Load, self.Path ("bad.mod"), lazy, cache)
+
+
+class MergeTest (LibraryTestCase):
+    def setUp (self):
+        LibraryTestCase.setUp (self)
+        self.Write ("a.mod", ModLibrary (["A", "B"]))
+        self.Write ("b.mod", ModLibrary (["B", "C"]).replace ("Li B\n", "Li B2\n"))
+        self.libs = [self.Load (self.Path ("a.mod"), True),
+            self.Load (self.Path ("b.mod"), True)]
+
+    def testFirst (self):
+        lib = kicad.MergeLibraries (self.libs, "first")
+        self.assertEqual (sorted (lib.components.keys ()), ["A", "B", "C"])
+        self.assertTrue ("Li B\n" in lib.components ["B"].Body ())
+
+    def testLast (self):
+        lib = kicad.MergeLibraries (self.libs, "last")
+        self.assertTrue ("Li B2\n" in lib.components ["B"].Body ())
+        lib.Save (self.Path ("o.mod"))
+        self.assertEqual (sorted (self.Load (self.Path ("o.mod")).components.keys ()),
+            ["A", "B", "C"])
+
+    def testError (self):
+        self.assertRaises (SystemExit, kicad.MergeLibraries, self.libs, "error")
+        lib = kicad.MergeLibraries ([self.libs [0], self.libs [0]], "first")
+        self.assertEqual (sorted (lib.components.keys ()), ["A", "B"])
+
+    def testTypes (self):
+        lib, dcm = SchLibrary (["A"], [])
+        self.Write ("c.lib", lib)
+        self.Write ("c.dcm", dcm)
+        self.assertRaises (SystemExit, kicad.MergeLibraries,
+            self.libs + [self.Load (self.Path ("c.lib"))])
+        self.assertRaises (ValueError, kicad.MergeLibraries, self.libs, "middle")
+
+
+class LoadLibrariesTest (LibraryTestCase):
+    def testParallel (self):
+        fns = []
+        for i in range (3):
+            fns.append (self.Write ("l%d.mod" % i, ModLibrary (["M%d_%d" % (i, j)
+                for j in range (20)])))
+        lib, dcm = SchLibrary (["A", "B"], ["B"])
+        fns.append (self.Write ("s.lib", lib))
+        self.Write ("s.dcm", dcm)
+
+        size = kicad.MIN_PARALLEL_SIZE
+        kicad.MIN_PARALLEL_SIZE = 0
+        try:
+            parallel = kicad.LoadLibraries (fns, 2, False)
+        finally:
+            kicad.MIN_PARALLEL_SIZE = size
+        serial = kicad.LoadLibraries (fns, 1, False)
+
+        for a, b in zip (parallel, serial):
+            self.assertEqual (a.type, b.type)
+            self.assertEqual (sorted (a.components.keys ()), sorted (b.components.keys ()))
+            for name, comp in a.components.items ():
+                self.assertEqual (comp.Body (), b.components [name].Body ())
+        self.assertEqual (parallel [3].components ["B"].DocBody (),
+            serial [3].components ["B"].DocBody ())
+        self.assertEqual (parallel [0].units, "mm")
+
+
+class SExprTest (unittest.TestCase):
+    def Footprints (self):
+        for dn in ("Choke_SMD/Choke_SMD.pretty", "Connectors_JST/Connectors_JST.pretty"):
+            dn = os.path.join (top, dn)
+            for fn in sorted (os.listdir (dn)):
+                f = open (os.path.join (dn, fn), "r")
+                text = f.read ()
+                f.close ()
+                yield fn, text
+
+    def testParse (self):
+        self.assertEqual (kicad.ParseSExpr ('(a (b "c d") e)\n(f)'),
+            [["a", ["b", '"c d"'], "e"], ["f"]])
+        self.assertEqual (kicad.ParseSExpr ('(a "x\\\\\\"y")'), [["a", '"x\\\\\\"y"']])
+        self.assertRaises (ValueError, kicad.ParseSExpr, "(a (b)")
+        self.assertRaises (ValueError, kicad.ParseSExpr, '(a "b)')
+
+    def testQuote (self):
+        for s in ("abc", "a b", "", 'a"b', "a\\b", "(x)"):
+            self.assertEqual (kicad.Unquote (kicad.Quote (s)), s)
+        self.assertEqual (kicad.Quote ("abc"), "abc")
+        self.assertEqual (kicad.Quote ("a b"), '"a b"')
+
+    def testRoundTrip (self):
+        count = 0
+        for fn, text in self.Footprints ():
+            fp = kicad.Footprint ()
+            fp.Parse (text)
+            self.assertEqual (fp.Format (), text, fn)
+            self.assertFalse (fp.dirty)
+            count += 1
+        self.assertTrue (count > 100)
+
+    def testEdit (self):
+        fn, text = self.Footprints ().next ()
+        fp = kicad.Footprint ()
+        fp.Parse (text)
+        pad = fp.Items (kicad.Pad) [0]
+        self.assertTrue (fp.dirty)
+        pad.at = (9, 9.5)
+        self.assertEqual (pad.at, (9, 9.5))
+
+        out = StringIO.StringIO ()
+        fp.Write (out)
+        self.assertTrue ("(pad %s %s %s (at 9 9.5)" % (pad.node [1], pad.type, pad.shape)
+            in out.getvalue (), out.getvalue ())
+
+        # Everything else is written as it was
+        a = text.splitlines ()
+        b = out.getvalue ().splitlines ()
+        self.assertEqual (len (a), len (b))
+        self.assertEqual (len ([1 for x, y in zip (a, b) if x != y]), 1)
+
+
+class PrettyLibraryTest (LibraryTestCase):
+    def setUp (self):
+        LibraryTestCase.setUp (self)
+        self.dn = self.Path ("Choke_SMD.pretty")
+        shutil.copytree (os.path.join (top, "Choke_SMD", "Choke_SMD.pretty"), self.dn)
+        self.parse = kicad._ParseFootprint
+        self.parsed = []
+
+    def tearDown (self):
+        kicad._ParseFootprint = self.parse
+        LibraryTestCase.tearDown (self)
+
+    def Parse (self, args):
+        self.parsed.append (os.path.basename (args [0]))
+        return self.parse (args)
+
+    def Text (self, name):
+        return self.Read (os.path.join ("Choke_SMD.pretty", name + ".kicad_mod"))
+
+    def testCache (self):
+        lib = kicad.PrettyLibrary ()
+        lib.Load (self.dn, 1, True)
+        count = len (lib.components)
+        self.assertTrue (os.path.exists (lib.CacheFile (self.dn)))
+
+        names = sorted (lib.components.keys ())
+        f = open (os.path.join (self.dn, names [0] + ".kicad_mod"), "a")
+        f.write ("\n")
+        f.close ()
+
+        # Only the changed footprint is parsed again
+        kicad._ParseFootprint = self.Parse
+        lib = kicad.PrettyLibrary ()
+        lib.Load (self.dn, 1, True)
+        self.assertEqual (self.parsed, [names [0] + ".kicad_mod"])
+        self.assertEqual (len (lib.components), count)
+        for name in names:
+            self.assertEqual (lib.components [name].Format (), self.Text (name).rstrip ("\n") + "\n")
+
+    def testSave (self):
+        lib = kicad.PrettyLibrary ()
+        lib.Load (self.dn, 1, False)
+        names = sorted (lib.components.keys ())
+        before = dict ([(name, self.Text (name)) for name in names])
+
+        lib.components [names [0]].Items (kicad.Pad) [0].at = (9, 9)
+        lib.components [names [1]].items.append (kicad.FpLine (start = (0, 0),
+            end = (1, 1), layer = "F.SilkS", width = 0.15))
+        lib.components [names [2]].Format ()
+        lib.Save (self.dn)
+
+        changed = [name for name in names if self.Text (name) != before [name]]
+        self.assertEqual (changed, names [:2])
+        self.assertTrue ("(fp_line (start 0 0) (end 1 1) (layer F.SilkS) (width 0.15))"
+            in self.Text (names [1]))
+
+
+if __name__ == "__main__":
+    unittest.main ()